@@ -0,0 +1,122 @@
+import logging
+from functools import wraps
+from uuid import UUID
+
+from asgiref.sync import sync_to_async
+from django.contrib.auth.views import redirect_to_login
+from django.core.exceptions import ObjectDoesNotExist, MultipleObjectsReturned
+from django.http import Http404
+from django.shortcuts import render, redirect
+from django.utils.timezone import now, localtime
+
+from . import views
+from .models import Menu
+from .slackapi import notify
+
+
+# This retrieves a Python logging instance (or creates it)
+logger = logging.getLogger(__name__)
+
+# Views used when the app runs under ASGI (settings/asgi.py sets ASYNC_VIEWS).
+# Django 3.1 has no async ORM, so queries and template rendering run in the thread of the sync code.
+# The event loop only waits for them, and for Slack, without holding a thread per request
+
+
+def in_thread(func):
+    """Runs blocking code, like queries and templates, in the thread Django runs sync code in.
+
+    It is the thread the database connection belongs to, Django opens and
+    closes it there at the start and end of each request.
+    """
+    return sync_to_async(func, thread_sensitive=True)
+
+
+async def get_user(request):
+    """Loads the user of the session, or returns None for anonymous users."""
+    return await in_thread(lambda: request.user if request.user.is_authenticated else None)()
+
+
+def login_required(view):
+    """Same as django.contrib.auth.decorators.login_required for async views."""
+    @wraps(view)
+    async def wrapper(request, *args, **kwargs):
+        if await get_user(request) is None:
+            return redirect_to_login(request.get_full_path())
+        return await view(request, *args, **kwargs)
+    return wrapper
+
+
+async def home(request):
+    date = localtime(now()).date()
+    menu = None
+    try:
+        # Display today's menu if exists
+        menu = await in_thread(Menu.objects.get)(date=date)
+        logger.info('Menu uuid: %s', menu.uuid)
+    except Exception as e:
+        logger.error("Error: %s", e)
+
+    user = await get_user(request)
+    return await in_thread(render)(request, 'cafeteria/home.html', {
+        'menu': menu,
+        'is_authenticated': user is not None,
+        'is_admin': user is not None and user.role.lower() == 'admin'
+    })
+
+
+@login_required
+async def menu_form(request):
+    if request.method != 'GET' or not request.GET.get('slack') or request.user.role.lower() != 'admin':
+        return await in_thread(views.menu_form)(request)
+
+    slack_error = None
+    try:
+        menu = await in_thread(Menu.objects.get)(date=localtime(now()).date())
+        # The Slack call is awaited here instead of holding a thread
+        await notify(views.menu_notification(menu))
+        menu.notification_sent = True
+        await in_thread(menu.save)()
+        return redirect('menu_form')
+    except (ObjectDoesNotExist, MultipleObjectsReturned):
+        # The sync view tells the admin about it
+        pass
+    except Exception as e:
+        slack_error = e
+    return await in_thread(views.menu_form)(request, slack_error=slack_error)
+
+
+@login_required
+async def redirect_uuid(request):
+    date = localtime(now()).date()
+    pk = 'null'
+    try:
+        menu = await in_thread(Menu.objects.get)(date=date)
+        pk = menu.uuid
+    except ObjectDoesNotExist as e:
+        logger.error(e)
+    except MultipleObjectsReturned as e:
+        logger.error(e)
+    # Employee will be redirected to an url with the uuid menu is exists for the current day
+    return redirect('menu', pk)
+
+
+@login_required
+async def order_uuid(request, pk):
+    if request.method != 'GET':
+        # Orders are saved by the sync view, with its transaction, rate limit and idempotency key
+        return await in_thread(views.order_uuid)(request, pk)
+
+    # In case the menu has not been created or the uuid is not valid, the employee will be aware
+    try:
+        valid_uuid = pk.replace('-', '') == str(UUID(str(pk), version=4)).replace('-', '')
+    except (TypeError, ValueError) as e:
+        logger.error(e)
+        valid_uuid = False
+
+    if not valid_uuid:
+        return await in_thread(views.order_not_found)(request)
+
+    menu = await in_thread(Menu.objects.filter(pk=pk).first)()
+    if menu is None:
+        raise Http404('No Menu matches the given query.')
+    return await in_thread(views.order)(request, request.user, menu, pk)
@@ -0,0 +1,14 @@
+from django.db.backends.sqlite3 import base
+
+
+class DatabaseWrapper(base.DatabaseWrapper):
+    """SQLite backend that starts the transactions with BEGIN IMMEDIATE.
+
+    SQLite ignores select_for_update. A transaction that reads and then
+    writes can not wait for the write lock, it fails at once with "database
+    is locked". Taking the write lock at BEGIN makes concurrent transactions
+    wait for it, up to the ``timeout`` option, instead.
+    """
+
+    def _start_transaction_under_autocommit(self):
+        self.cursor().execute('BEGIN IMMEDIATE')
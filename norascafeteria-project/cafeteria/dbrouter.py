@@ -0,0 +1,100 @@
+import asyncio
+import contextvars
+from functools import wraps
+
+from django.conf import settings
+from django.db import connections
+from django.utils.deprecation import MiddlewareMixin
+
+
+# Models the reports can read with some lag, users and sessions always come from the primary
+REPLICA_MODELS = {'dish', 'menu', 'menudish', 'order', 'orderchange'}
+PIN_COOKIE = 'primary_pin'
+
+# Whether the current view reads from the replica
+replica_reads_enabled = contextvars.ContextVar('replica_reads_enabled', default=False)
+# {'pinned': bool, 'wrote': bool} of the current request
+request_state = contextvars.ContextVar('request_state', default=None)
+
+
+def is_replicated(model):
+    return model._meta.app_label == 'cafeteria' and model._meta.model_name in REPLICA_MODELS
+
+
+class ReplicaRouter:
+    """Sends the reads of the report views to REPLICA_DATABASE and everything else to the primary.
+
+    A request that wrote, and the requests of the same browser during the
+    next REPLICA_PIN_SECONDS, read from the primary so users see their own
+    changes while the replica catches up.
+    """
+
+    def db_for_read(self, model, **hints):
+        replica = settings.REPLICA_DATABASE
+        if not replica or not replica_reads_enabled.get() or not is_replicated(model):
+            return 'default'
+        state = request_state.get()
+        if state is not None and (state['pinned'] or state['wrote']):
+            return 'default'
+        return replica
+
+    def db_for_write(self, model, **hints):
+        state = request_state.get()
+        if state is not None and is_replicated(model):
+            state['wrote'] = True
+        return 'default'
+
+    def allow_relation(self, obj1, obj2, **hints):
+        # The replica has the same data
+        return True
+
+    def allow_migrate(self, db, app_label, model_name=None, **hints):
+        # The replica is read only and gets the schema from the primary, only its test database is migrated
+        if db == 'default':
+            return True
+        settings_dict = connections[db].settings_dict
+        return settings_dict['NAME'] == settings_dict['TEST'].get('NAME')
+
+
+def replica_reads(view):
+    """Lets the reads of a report view go to the replica.
+
+    Only for GET, the reads of a post decide what it writes.
+    """
+    @wraps(view)
+    def wrapper(request, *args, **kwargs):
+        if request.method not in ('GET', 'HEAD'):
+            return view(request, *args, **kwargs)
+        token = replica_reads_enabled.set(True)
+        try:
+            return view(request, *args, **kwargs)
+        finally:
+            replica_reads_enabled.reset(token)
+    return wrapper
+
+
+class ReplicaPinMiddleware(MiddlewareMixin):
+    """Pins the browser to the primary for REPLICA_PIN_SECONDS after a request that wrote."""
+
+    def __call__(self, request):
+        if asyncio.iscoroutinefunction(self.get_response):
+            return self.__acall__(request)
+        token = request_state.set({'pinned': PIN_COOKIE in request.COOKIES, 'wrote': False})
+        try:
+            response = self.get_response(request)
+            return self.pin(response)
+        finally:
+            request_state.reset(token)
+
+    async def __acall__(self, request):
+        token = request_state.set({'pinned': PIN_COOKIE in request.COOKIES, 'wrote': False})
+        try:
+            response = await self.get_response(request)
+            return self.pin(response)
+        finally:
+            request_state.reset(token)
+
+    def pin(self, response):
+        if request_state.get()['wrote']:
+            response.set_cookie(PIN_COOKIE, '1', max_age=settings.REPLICA_PIN_SECONDS, httponly=True, samesite='Lax')
+        return response
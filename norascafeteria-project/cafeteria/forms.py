@@ -1,14 +1,14 @@
 from django import forms
 from django.utils.timezone import now, localtime
 
-from .models import Dish, Menu, Order
+from .models import Dish, Menu, MenuDish, Order
 
 
 class DishForm(forms.ModelForm):
     class Meta:
         model = Dish
-        fields = ['name']
-        labels = {'name': 'Dish name'}
+        fields = ['name', 'photo']
+        labels = {'name': 'Dish name', 'photo': 'Dish photo'}
 
 
 class MenuForm(forms.ModelForm):
@@ -33,6 +33,25 @@ class MenuForm(forms.ModelForm):
         fields = ['date', 'detail', 'dishes']
         labels = {'date': 'Pick a date to create a menu', 'detail': 'Message to employees', 'dishes': 'Options'}
 
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        capacities = {}
+        if self.instance.pk:
+            capacities = dict(self.instance.menudish_set.values_list('dish_id', 'capacity'))
+        # Portions of each dish, only the ones of the chosen dishes are saved
+        for dish in self.fields['dishes'].queryset:
+            self.fields[f'capacity_{dish.id}'] = forms.IntegerField(
+                label=f'{dish.name} portions',
+                min_value=0,
+                required=False,
+                initial=capacities.get(dish.id)
+            )
+
+    def _save_m2m(self):
+        super()._save_m2m()
+        for dish in self.cleaned_data['dishes']:
+            MenuDish.set_capacity(self.instance, dish, self.cleaned_data.get(f'capacity_{dish.id}'))
+
 
 class OrderForm(forms.ModelForm):
     class Meta:
@@ -0,0 +1,88 @@
+import logging
+import time
+from datetime import timedelta
+from functools import wraps
+
+from django.conf import settings
+from django.http import HttpResponse
+from django.utils.timezone import now
+
+from . import metrics
+from .models import IdempotencyKey
+
+
+# This retrieves a Python logging instance (or creates it)
+logger = logging.getLogger(__name__)
+
+# Hidden field rendered by {% idempotency_field %} in the forms
+IDEMPOTENCY_FIELD = 'idempotency_key'
+
+
+def idempotency_key(request):
+    """Cache key of the token posted with the form, or None if there is no token."""
+    token = request.POST.get(IDEMPOTENCY_FIELD, '')[:64]
+    if not token or not request.user.is_authenticated:
+        return None
+    return f'idempotency:{request.user.pk}:{request.path}:{token}'
+
+
+def stored_response(key):
+    return IdempotencyKey.objects.filter(key=key).values_list('status', 'content_type', 'content').first()
+
+
+def replay(key):
+    """Answers a repeated post with the stored response of the first one.
+
+    If the first one is still running, waits up to IDEMPOTENCY_WAIT seconds for it.
+    """
+    deadline = time.monotonic() + settings.IDEMPOTENCY_WAIT
+    stored = stored_response(key)
+    while stored is not None and stored[0] is None and time.monotonic() < deadline:
+        time.sleep(0.05)
+        stored = stored_response(key)
+
+    if stored is None or stored[0] is None:
+        metrics.inc('cafeteria_order_replays_total', result='in_progress')
+        response = HttpResponse('Your order is being processed, please reload the page',
+                                status=409, content_type='text/plain')
+        response['Retry-After'] = settings.IDEMPOTENCY_WAIT
+        return response
+
+    metrics.inc('cafeteria_order_replays_total', result='replayed')
+    status, content_type, content = stored
+    response = HttpResponse(bytes(content), status=status, content_type=content_type)
+    response['Idempotent-Replayed'] = 'true'
+    return response
+
+
+def idempotent(view):
+    """Runs a form post once per idempotency token.
+
+    The response is kept IDEMPOTENCY_KEY_TTL seconds, double clicks and
+    network retries get it back without running the view again. Only
+    successes and redirects are kept, rate limited posts and server errors
+    can be retried with the same token. Put it before the rate limit,
+    replays do not take tokens.
+    """
+    @wraps(view)
+    def wrapper(request, *args, **kwargs):
+        key = idempotency_key(request) if request.method == 'POST' else None
+        if key is None:
+            return view(request, *args, **kwargs)
+
+        if not IdempotencyKey.claim(key, now() - timedelta(seconds=settings.IDEMPOTENCY_KEY_TTL)):
+            logger.info("Replaying %s", key)
+            return replay(key)
+
+        try:
+            response = view(request, *args, **kwargs)
+        except Exception:
+            IdempotencyKey.objects.filter(key=key).delete()
+            raise
+        if response.status_code < 400 and not response.streaming:
+            IdempotencyKey.objects.filter(key=key).update(
+                status=response.status_code, content_type=response['Content-Type'], content=response.content)
+        else:
+            IdempotencyKey.objects.filter(key=key).delete()
+        return response
+    return wrapper
@@ -0,0 +1,31 @@
+import os
+from io import BytesIO
+
+from PIL import Image
+
+
+# Extension -> Pillow format of the resized copies
+IMAGE_FORMATS = {'webp': 'WEBP', 'jpg': 'JPEG'}
+
+
+def image_variant_name(name, width, extension):
+    """Name of a resized copy of an image, e.g. images/home_img-480w.webp"""
+    root, _ = os.path.splitext(name)
+    return f'{root}-{width}w.{extension}'
+
+
+def resize_image(file, width, extension):
+    """Returns the bytes of the image resized to the width, it is never enlarged."""
+    image = Image.open(file)
+    image.thumbnail((width, image.height))
+    output = BytesIO()
+    if IMAGE_FORMATS[extension] == 'JPEG':
+        image.convert('RGB').save(output, 'JPEG', quality=80, optimize=True, progressive=True)
+    else:
+        image.save(output, IMAGE_FORMATS[extension], quality=80)
+    return output.getvalue()
+
+
+def resize_image_content(content, width, extension):
+    """Same as resize_image but from bytes, so it can run in another process."""
+    return resize_image(BytesIO(content), width, extension)
@@ -0,0 +1,160 @@
+import asyncio
+import atexit
+import contextvars
+import json
+import logging
+import os
+import queue
+import random
+import threading
+import uuid
+from logging.handlers import QueueHandler, QueueListener
+
+from django.core.signals import request_finished
+from django.utils.deprecation import MiddlewareMixin
+
+
+# Id of the request being handled, it is added to every log record
+request_id = contextvars.ContextVar('request_id', default=None)
+
+
+def clear_request_id(**kwargs):
+    request_id.set(None)
+
+
+# Django logs the 4xx and 5xx responses (django.request) after the middlewares return,
+# so the id is kept until the response is closed
+request_finished.connect(clear_request_id, dispatch_uid='clear_request_id')
+
+
+class RequestIdMiddleware(MiddlewareMixin):
+    """Takes the request id from the X-Request-ID header or creates one, and returns it in the response."""
+
+    def __call__(self, request):
+        # MiddlewareMixin makes it a coroutine function under ASGI
+        if asyncio.iscoroutinefunction(self.get_response):
+            return self.__acall__(request)
+        _id = request.META.get('HTTP_X_REQUEST_ID') or uuid.uuid4().hex
+        request_id.set(_id)
+        response = self.get_response(request)
+        response['X-Request-ID'] = _id
+        return response
+
+    async def __acall__(self, request):
+        _id = request.META.get('HTTP_X_REQUEST_ID') or uuid.uuid4().hex
+        request_id.set(_id)
+        response = await self.get_response(request)
+        response['X-Request-ID'] = _id
+        return response
+
+
+class RequestIdFilter(logging.Filter):
+
+    def filter(self, record):
+        record.request_id = request_id.get()
+        return True
+
+
+class SamplingFilter(logging.Filter):
+    """Keeps only a fraction of the records of some message types.
+
+    ``rates`` maps a message template (the string before the arguments are
+    applied, e.g. 'Menu uuid: %s') to the fraction of records to keep.
+    Warnings and errors are always kept.
+    """
+
+    def __init__(self, rates=None):
+        super().__init__()
+        self.rates = dict(rates or {})
+
+    def filter(self, record):
+        if record.levelno >= logging.WARNING:
+            return True
+        rate = self.rates.get(record.msg)
+        return rate is None or random.random() < rate
+
+
+class JsonFormatter(logging.Formatter):
+
+    def format(self, record):
+        data = {
+            'time': self.formatTime(record),
+            'level': record.levelname,
+            'logger': record.name,
+            'message': record.getMessage(),
+            'request_id': getattr(record, 'request_id', None),
+        }
+        if record.exc_info:
+            record.exc_text = self.formatException(record.exc_info)
+        if record.exc_text:
+            data['exception'] = record.exc_text
+        return json.dumps(data, default=str)
+
+
+class BlockingStopQueueListener(QueueListener):
+
+    def enqueue_sentinel(self):
+        # Waits for room in a full queue so the listener always gets the sentinel
+        self.queue.put(self._sentinel)
+
+
+class QueueLogHandler(QueueHandler):
+    """Puts the records in a bounded queue that a background listener writes to the stream.
+
+    Views never wait for the stream: if the queue is full the record is
+    dropped and counted in ``dropped``. The listener is started by the first
+    record of each process, the thread of the process that loaded the
+    settings does not survive the fork of the workers (gunicorn --preload).
+    """
+
+    def __init__(self, stream=None, queue_size=10000):
+        super().__init__(queue.Queue(queue_size))
+        self.target = logging.StreamHandler(stream)
+        self.target.setFormatter(JsonFormatter())
+        self.queue_size = queue_size
+        self.dropped = 0
+        self.listener = None
+        self._pid = None
+        self._start_lock = threading.Lock()
+        self._stopped = False
+        atexit.register(self.stop)
+
+    def start(self):
+        """Starts the listener of this process, with a queue of its own."""
+        with self._start_lock:
+            if self._pid == os.getpid():
+                return
+            self.queue = queue.Queue(self.queue_size)
+            self.listener = BlockingStopQueueListener(self.queue, self.target)
+            self.listener.start()
+            self._pid = os.getpid()
+            self._stopped = False
+
+    def prepare(self, record):
+        # Only the message is rendered here, the JSON is built by the listener thread
+        record = logging.makeLogRecord(record.__dict__)
+        record.msg = record.getMessage()
+        record.args = None
+        if record.exc_info:
+            record.exc_text = logging.Formatter().formatException(record.exc_info)
+            record.exc_info = None
+        return record
+
+    def enqueue(self, record):
+        if self._pid != os.getpid() and not self._stopped:
+            self.start()
+        try:
+            self.queue.put_nowait(record)
+        except queue.Full:
+            self.dropped += 1
+
+    def stop(self):
+        """Writes the records left in the queue and stops the listener."""
+        with self._start_lock:
+            if not self._stopped and self._pid == os.getpid():
+                self.listener.stop()
+            self._stopped = True
+
+    def close(self):
+        self.stop()
+        super().close()
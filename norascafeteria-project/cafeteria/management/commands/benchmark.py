@@ -0,0 +1,146 @@
+import http.client
+import os
+import socket
+import subprocess
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+from django.conf import settings
+from django.core.management.base import BaseCommand, CommandError
+
+
+def process_tree(pid):
+    """The pid and the pids of all its children, read from /proc."""
+    pids = [pid]
+    for _pid in pids:
+        try:
+            with open(f'/proc/{_pid}/task/{_pid}/children') as file:
+                pids.extend(int(child) for child in file.read().split())
+        except OSError:
+            pass
+    return pids
+
+
+def rss(pid):
+    """Resident memory in bytes of a process and its children (the gunicorn and uvicorn workers)."""
+    total = 0
+    for _pid in process_tree(pid):
+        try:
+            with open(f'/proc/{_pid}/status') as file:
+                for line in file:
+                    if line.startswith('VmRSS:'):
+                        total += int(line.split()[1]) * 1024
+        except OSError:
+            pass
+    return total
+
+
+def wait_ready(port, timeout=30):
+    deadline = time.monotonic() + timeout
+    while time.monotonic() < deadline:
+        try:
+            socket.create_connection(('127.0.0.1', port), timeout=1).close()
+            return
+        except OSError:
+            time.sleep(0.2)
+    raise CommandError(f'The server did not start on port {port}')
+
+
+class Command(BaseCommand):
+    help = 'Compares requests/sec and memory per connection of the WSGI (gunicorn) and ASGI (uvicorn) servers'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--path', default='/', help='Page requested by every connection')
+        parser.add_argument('--cookie', default='', help="Cookie header, e.g. 'sessionid=...' for the order page")
+        parser.add_argument('--connections', type=int, default=50, help='Keep-alive connections open at the same time')
+        parser.add_argument('--duration', type=float, default=10, help='Seconds of load for each server')
+        parser.add_argument('--workers', type=int, default=2, help='Processes of each server')
+        parser.add_argument('--threads', type=int, default=8, help='Threads of each gunicorn worker')
+        parser.add_argument('--port', type=int, default=8765)
+        parser.add_argument('--servers', nargs='+', default=['wsgi', 'asgi'], choices=['wsgi', 'asgi'])
+
+    def handle(self, *args, **options):
+        port = options['port']
+        commands = {
+            'wsgi': ['gunicorn', 'settings.wsgi', '--workers', str(options['workers']),
+                     '--threads', str(options['threads']), '--bind', f'127.0.0.1:{port}'],
+            'asgi': ['uvicorn', 'settings.asgi:application', '--workers', str(options['workers']),
+                     '--port', str(port), '--no-access-log'],
+        }
+        self.stdout.write(f"{options['connections']} connections to {options['path']} for {options['duration']}s")
+        self.stdout.write('server  req/s    p50 ms  p99 ms  errors  idle MB  peak MB  KB/connection')
+        for server in options['servers']:
+            result = self.run_server(commands[server], options)
+            self.stdout.write(
+                f"{server:<8}{result['rps']:<9.1f}{result['p50']:<8.1f}{result['p99']:<8.1f}{result['errors']:<8}"
+                f"{result['idle'] / 2 ** 20:<9.1f}{result['peak'] / 2 ** 20:<9.1f}"
+                f"{(result['peak'] - result['idle']) / 1024 / options['connections']:.1f}"
+            )
+
+    def run_server(self, command, options):
+        env = dict(os.environ, DJANGO_SETTINGS_MODULE='settings.settings')
+        try:
+            process = subprocess.Popen(command, cwd=str(settings.BASE_DIR), env=env,
+                                       stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+        except FileNotFoundError:
+            raise CommandError(f'{command[0]} is not installed, run pip install gunicorn uvicorn')
+        try:
+            wait_ready(options['port'])
+            # The first requests load the templates and open the database in each worker
+            self.load(options, duration=1)
+            idle = rss(process.pid)
+            result = self.load(options, duration=options['duration'], memory_of=process.pid)
+            result['idle'] = idle
+            return result
+        finally:
+            process.terminate()
+            process.wait()
+
+    def load(self, options, duration, memory_of=None):
+        deadline = time.monotonic() + duration
+        headers = {'Cookie': options['cookie']} if options['cookie'] else {}
+        peak = [0]
+        done = threading.Event()
+
+        def sample_memory():
+            while not done.wait(0.2):
+                peak[0] = max(peak[0], rss(memory_of))
+
+        def client(_):
+            latencies = []
+            errors = 0
+            connection = http.client.HTTPConnection('127.0.0.1', options['port'], timeout=30)
+            while time.monotonic() < deadline:
+                start = time.perf_counter()
+                try:
+                    connection.request('GET', options['path'], headers=headers)
+                    response = connection.getresponse()
+                    response.read()
+                    if response.status == 200:
+                        latencies.append(time.perf_counter() - start)
+                    else:
+                        errors += 1
+                    if response.will_close:
+                        connection.close()
+                except (OSError, http.client.HTTPException):
+                    errors += 1
+                    connection.close()
+            connection.close()
+            return latencies, errors
+
+        if memory_of is not None:
+            sampler = threading.Thread(target=sample_memory, daemon=True)
+            sampler.start()
+        with ThreadPoolExecutor(max_workers=options['connections']) as executor:
+            results = list(executor.map(client, range(options['connections'])))
+        done.set()
+
+        latencies = sorted(latency for _latencies, _ in results for latency in _latencies)
+        return {
+            'rps': len(latencies) / duration,
+            'p50': latencies[len(latencies) // 2] * 1000 if latencies else 0,
+            'p99': latencies[int(len(latencies) * 0.99)] * 1000 if latencies else 0,
+            'errors': sum(errors for _, errors in results),
+            'peak': peak[0],
+        }
@@ -0,0 +1,18 @@
+import time
+from datetime import timedelta
+
+from django.conf import settings
+from django.core.management.base import BaseCommand
+from django.utils.timezone import now
+
+from cafeteria.models import IdempotencyKey, RateLimitBucket
+
+
+class Command(BaseCommand):
+    help = 'Removes the rate limit buckets that are full again and the expired idempotency keys'
+
+    def handle(self, *args, **options):
+        buckets = RateLimitBucket.clear_expired(time.time())
+        keys, _ = IdempotencyKey.objects.filter(
+            created_at__lt=now() - timedelta(seconds=settings.IDEMPOTENCY_KEY_TTL)).delete()
+        self.stdout.write(f'{buckets} rate limit buckets and {keys} idempotency keys removed')
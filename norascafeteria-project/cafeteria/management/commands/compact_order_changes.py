@@ -0,0 +1,21 @@
+from datetime import timedelta
+
+from django.conf import settings
+from django.core.management.base import BaseCommand
+from django.utils.timezone import now
+
+from cafeteria.models import OrderChange
+
+
+class Command(BaseCommand):
+    help = 'Keeps only the last change of each order in the order change feed for the old changes'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--days', type=int, default=settings.ORDER_CHANGES_COMPACT_DAYS,
+                            help='Changes older than these days are compacted')
+
+    def handle(self, *args, **options):
+        # Changes of a worker that died before publishing them
+        OrderChange.publish()
+        removed = OrderChange.compact(now() - timedelta(days=options['days']))
+        self.stdout.write(f'{removed} order changes removed')
@@ -0,0 +1,14 @@
+from django.core.management.base import BaseCommand
+
+from cafeteria.models import Dish
+from cafeteria.thumbnails import create_variants, has_current_variants
+
+
+class Command(BaseCommand):
+    help = 'Creates the resized copies missing from the dish photos, like those of a worker that stopped before'
+
+    def handle(self, *args, **options):
+        missing = [dish.id for dish in Dish.objects.all() if not has_current_variants(dish)]
+        for dish_id in missing:
+            create_variants(dish_id)
+        self.stdout.write(f'{len(missing)} dish photos updated')
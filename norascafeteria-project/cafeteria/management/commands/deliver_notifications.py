@@ -0,0 +1,18 @@
+from django.conf import settings
+from django.core.management.base import BaseCommand
+
+from cafeteria import metrics
+from cafeteria.models import Notification
+from cafeteria.notifications import deliver_pending
+
+
+class Command(BaseCommand):
+    help = 'Sends the pending Slack notifications of the employees, failed ones once their retry delay passed'
+
+    def handle(self, *args, **options):
+        deliver_pending()
+        unsent = Notification.objects.filter(sent_at__isnull=True)
+        pending = unsent.filter(attempts__lt=settings.NOTIFICATION_MAX_ATTEMPTS).count()
+        given_up = unsent.filter(attempts__gte=settings.NOTIFICATION_MAX_ATTEMPTS).count()
+        self.stdout.write(f'{pending} notifications pending, {given_up} given up')
+        metrics.registry.flush(force=True)
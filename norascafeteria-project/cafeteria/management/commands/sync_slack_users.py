@@ -0,0 +1,120 @@
+import time
+from collections import defaultdict
+
+from asgiref.sync import async_to_sync
+from django.conf import settings
+from django.contrib.auth.hashers import make_password
+from django.core.management.base import BaseCommand
+from django.db import transaction
+
+from cafeteria.models import User
+from cafeteria.slackapi import list_users
+
+
+# The username is only set when the user is created, it is the login
+UPDATE_FIELDS = ['slack_id', 'first_name', 'last_name', 'email', 'is_active']
+
+
+def member_fields(member):
+    profile = member.get('profile', {})
+    return {
+        'slack_id': member['id'],
+        'first_name': (profile.get('first_name') or profile.get('real_name') or member['name'])[:150],
+        'last_name': (profile.get('last_name') or '')[:100] or None,
+        'email': profile.get('email', ''),
+        'is_active': not member.get('deleted', False),
+    }
+
+
+class Command(BaseCommand):
+    help = 'Creates, updates and deactivates the users from the members of the Slack workspace'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--page-size', type=int, default=settings.SLACK_USERS_PAGE_SIZE,
+                            help='Members asked in each users.list page')
+        parser.add_argument('--batch-size', type=int, default=settings.SLACK_SYNC_BATCH_SIZE,
+                            help='Users saved in each query')
+
+    def handle(self, *args, **options):
+        start = time.monotonic()
+        members = [
+            member for member in async_to_sync(list_users)(options['page_size'])
+            if not member.get('is_bot') and member['id'] != 'USLACKBOT'
+        ]
+        with transaction.atomic():
+            created, updated, deactivated, skipped = self.sync(members, options['batch_size'])
+        self.stdout.write(
+            f'{len(members)} Slack members: {created} users created, {updated} updated, '
+            f'{deactivated} deactivated, {skipped} skipped in {time.monotonic() - start:.1f}s'
+        )
+
+    def sync(self, members, batch_size):
+        """Diffs the members against all the users in memory and saves the differences in batches.
+
+        Members are linked to a user by Slack id, or by email only if Slack
+        confirmed it. Slack handles are chosen by the members and reused over
+        time, so a member whose handle is the username of an unlinked user is
+        reported instead of linked.
+        """
+        users = list(User.objects.only('username', *UPDATE_FIELDS))
+        by_slack_id = {user.slack_id: user for user in users if user.slack_id}
+        # Users created by hand or from the dump, an email shared by several of them links none
+        by_email = defaultdict(list)
+        for user in users:
+            if user.email and not user.slack_id:
+                by_email[user.email.lower()].append(user)
+        usernames = {user.username for user in users}
+
+        new_users = []
+        changed_users = []
+        seen = set()
+        updated = deactivated = skipped = 0
+        for member in members:
+            fields = member_fields(member)
+            seen.add(fields['slack_id'])
+            user = by_slack_id.get(fields['slack_id'])
+
+            if user is None:
+                if not fields['is_active']:
+                    continue
+                same_email = by_email.get(fields['email'].lower(), [])
+                if same_email and (len(same_email) > 1 or not member.get('is_email_confirmed')):
+                    self.stderr.write(f"Slack member {member['id']} has the email of users "
+                                      f"{', '.join(user.username for user in same_email)} but it can not be "
+                                      f"linked, it is not confirmed or not unique. Set their slack_id by hand")
+                    skipped += 1
+                    continue
+                if same_email:
+                    user = same_email[0]
+                    # A user is linked to one member only
+                    del by_email[fields['email'].lower()]
+                elif member['name'] in usernames:
+                    self.stderr.write(f"Username {member['name']} is taken by a user not linked to Slack, "
+                                      f"Slack member {member['id']} skipped")
+                    skipped += 1
+                    continue
+                else:
+                    usernames.add(member['name'])
+                    new_users.append(User(username=member['name'], password=make_password(None), role='employee', **fields))
+                    continue
+
+            if all(getattr(user, field) == value for field, value in fields.items()):
+                continue
+            if user.is_active and not fields['is_active']:
+                deactivated += 1
+            else:
+                updated += 1
+            for field, value in fields.items():
+                setattr(user, field, value)
+            changed_users.append(user)
+
+        # Members that left the workspace
+        for user in by_slack_id.values():
+            if user.slack_id not in seen and user.is_active:
+                user.is_active = False
+                changed_users.append(user)
+                deactivated += 1
+
+        User.objects.bulk_create(new_users, batch_size=batch_size)
+        User.objects.bulk_update(changed_users, UPDATE_FIELDS, batch_size=batch_size)
+        return len(new_users), updated, deactivated, skipped
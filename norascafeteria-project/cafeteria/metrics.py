@@ -0,0 +1,265 @@
+import asyncio
+import atexit
+import fcntl
+import hmac
+import json
+import logging
+import os
+import tempfile
+import time
+from bisect import bisect_left
+from collections import defaultdict
+from contextlib import ExitStack
+
+from django.conf import settings
+from django.db import connections
+from django.http import HttpResponse
+from django.utils.deprecation import MiddlewareMixin
+
+
+# This retrieves a Python logging instance (or creates it)
+logger = logging.getLogger(__name__)
+
+# Name -> (type, help) of every metric exposed in /metrics
+METRICS = {
+    'cafeteria_request_duration_seconds': ('histogram', 'Request latency by view'),
+    'cafeteria_requests_total': ('counter', 'Requests by view and status code'),
+    'cafeteria_db_queries_total': ('counter', 'Database queries by view'),
+    'cafeteria_orders_placed_total': ('counter', 'Orders placed by employees'),
+    'cafeteria_orders_updated_total': ('counter', 'Orders changed by employees'),
+    'cafeteria_order_rejections_total': ('counter', 'Orders rejected by reason'),
+    'cafeteria_order_replays_total': ('counter', 'Repeated order posts answered from the idempotency store'),
+    'cafeteria_requests_rejected_total': ('counter', 'Requests rejected by rate limits and admission control'),
+    'cafeteria_menu_notifications_total': ('counter', 'Slack menu notifications by result'),
+    'cafeteria_employee_notifications_total': ('counter', 'Slack messages to employees by result'),
+}
+
+LATENCY_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+
+
+def dump(counters, histograms):
+    return {
+        'counters': [[name, dict(labels), value] for (name, labels), value in counters.items()],
+        'histograms': [[name, dict(labels), values] for (name, labels), values in histograms.items()],
+    }
+
+
+class Registry:
+    """Counters and histograms of the current process.
+
+    Each gunicorn worker only writes its own values, and dumps them to its own
+    file in METRICS_DIR, so workers never share a lock. The /metrics view adds
+    up the files of all the workers.
+    """
+
+    def __init__(self):
+        self.counters = defaultdict(float)
+        # (name, labels) -> bucket counts followed by the sum and the count
+        self.histograms = {}
+        self.last_flush = 0
+
+    def inc(self, name, amount=1, **labels):
+        self.counters[(name, tuple(sorted(labels.items())))] += amount
+
+    def observe(self, name, value, **labels):
+        key = (name, tuple(sorted(labels.items())))
+        histogram = self.histograms.get(key)
+        if histogram is None:
+            histogram = self.histograms[key] = [0] * (len(LATENCY_BUCKETS) + 3)
+        # The bucket after the last bound is +Inf
+        histogram[bisect_left(LATENCY_BUCKETS, value)] += 1
+        histogram[-2] += value
+        histogram[-1] += 1
+
+    def dump(self):
+        return dump(self.counters, self.histograms)
+
+    def flush(self, force=False):
+        """Writes this process values to METRICS_DIR at most every METRICS_FLUSH_INTERVAL seconds."""
+        _now = time.monotonic()
+        if not force and _now - self.last_flush < settings.METRICS_FLUSH_INTERVAL:
+            return
+        self.last_flush = _now
+        directory = str(settings.METRICS_DIR)
+        try:
+            os.makedirs(directory, exist_ok=True)
+            fd, tmp_path = tempfile.mkstemp(dir=directory, suffix='.tmp')
+            with os.fdopen(fd, 'w') as file:
+                json.dump(self.dump(), file)
+            # Readers never see a half written file
+            os.replace(tmp_path, os.path.join(directory, f'{os.getpid()}.json'))
+        except OSError as e:
+            logger.error("Error writing metrics: %s", e)
+
+
+registry = Registry()
+# The values of the last seconds, and those of the commands and background threads outside requests
+atexit.register(registry.flush, force=True)
+
+
+def inc(name, amount=1, **labels):
+    registry.inc(name, amount, **labels)
+
+
+def observe(name, value, **labels):
+    registry.observe(name, value, **labels)
+
+
+def is_alive(pid):
+    try:
+        os.kill(pid, 0)
+    except ProcessLookupError:
+        return False
+    except PermissionError:
+        # It exists, it belongs to another user
+        pass
+    return True
+
+
+def add_up(paths):
+    """Adds up the counters and histograms of the metrics files."""
+    counters = defaultdict(float)
+    histograms = {}
+    for path in paths:
+        try:
+            with open(path) as file:
+                data = json.load(file)
+        except FileNotFoundError:
+            # Archived by another worker
+            continue
+        except (OSError, ValueError) as e:
+            logger.error("Error reading metrics %s: %s", path, e)
+            continue
+        for name, labels, value in data['counters']:
+            counters[(name, tuple(sorted(labels.items())))] += value
+        for name, labels, values in data['histograms']:
+            key = (name, tuple(sorted(labels.items())))
+            if key not in histograms:
+                histograms[key] = [0] * len(values)
+            histograms[key] = [total + value for total, value in zip(histograms[key], values)]
+    return counters, histograms
+
+
+def archive_dead_workers(directory):
+    """Moves the values of the workers that exited to archive.json and removes their files.
+
+    The counters keep their totals after a worker restarts, and there is only
+    one file per live worker.
+    """
+    with open(os.path.join(directory, 'archive.lock'), 'w') as lock:
+        # Only one worker archives at a time, each dead file is added once
+        fcntl.flock(lock, fcntl.LOCK_EX)
+        dead = [
+            entry.path for entry in os.scandir(directory)
+            if entry.name.endswith('.json') and entry.name[:-5].isdigit() and not is_alive(int(entry.name[:-5]))
+        ]
+        if not dead:
+            return
+        archive_path = os.path.join(directory, 'archive.json')
+        counters, histograms = add_up([archive_path] + dead)
+        fd, tmp_path = tempfile.mkstemp(dir=directory, suffix='.tmp')
+        with os.fdopen(fd, 'w') as file:
+            json.dump(dump(counters, histograms), file)
+        os.replace(tmp_path, archive_path)
+        for path in dead:
+            os.remove(path)
+
+
+def collect():
+    """Adds up the values written by every worker, and the archived values of the workers that exited."""
+    registry.flush(force=True)
+    directory = str(settings.METRICS_DIR)
+    try:
+        archive_dead_workers(directory)
+        paths = [entry.path for entry in os.scandir(directory) if entry.name.endswith('.json')]
+    except OSError as e:
+        logger.error("Error reading metrics: %s", e)
+        paths = []
+    return add_up(paths)
+
+
+def format_labels(labels, **extra):
+    labels = list(labels) + list(extra.items())
+    if not labels:
+        return ''
+    values = ','.join('{}="{}"'.format(key, str(value).replace('\\', '\\\\').replace('"', '\\"'))
+                      for key, value in labels)
+    return f'{{{values}}}'
+
+
+def render_metrics():
+    """Renders all the metrics in the Prometheus text format."""
+    counters, histograms = collect()
+    lines = []
+    for name, (_type, _help) in METRICS.items():
+        lines.append(f'# HELP {name} {_help}')
+        lines.append(f'# TYPE {name} {_type}')
+        for (sample, labels), value in sorted(counters.items()):
+            if sample == name:
+                lines.append(f'{name}{format_labels(labels)} {value}')
+        for (sample, labels), values in sorted(histograms.items()):
+            if sample != name:
+                continue
+            cumulative = 0
+            for bound, count in zip(LATENCY_BUCKETS + ('+Inf',), values):
+                cumulative += count
+                lines.append(f'{name}_bucket{format_labels(labels, le=bound)} {cumulative}')
+            lines.append(f'{name}_sum{format_labels(labels)} {values[-2]}')
+            lines.append(f'{name}_count{format_labels(labels)} {values[-1]}')
+    return '\n'.join(lines) + '\n'
+
+
+def metrics_allowed(request):
+    # Prometheus sends one of the METRICS_TOKENS, admins can use their session
+    authorization = request.META.get('HTTP_AUTHORIZATION', '')
+    if authorization.startswith('Bearer '):
+        token = authorization[len('Bearer '):]
+        return any(hmac.compare_digest(token, allowed) for allowed in settings.METRICS_TOKENS)
+    return request.user.is_authenticated and request.user.role.lower() == 'admin'
+
+
+def metrics_view(request):
+    if not metrics_allowed(request):
+        return HttpResponse('Not allowed', status=403, content_type='text/plain')
+    return HttpResponse(render_metrics(), content_type='text/plain; version=0.0.4; charset=utf-8')
+
+
+class MetricsMiddleware(MiddlewareMixin):
+    """Records latency, status and database queries of every request by view.
+
+    The queries of the async views run in other threads, they are not counted.
+    """
+
+    def __call__(self, request):
+        if asyncio.iscoroutinefunction(self.get_response):
+            return self.__acall__(request)
+        queries = [0]
+
+        def count_query(execute, sql, params, many, context):
+            queries[0] += 1
+            return execute(sql, params, many, context)
+
+        start = time.perf_counter()
+        with ExitStack() as stack:
+            # The report views read from the replica
+            for alias in connections:
+                stack.enter_context(connections[alias].execute_wrapper(count_query))
+            response = self.get_response(request)
+        self.record(request, response, time.perf_counter() - start, queries[0])
+        return response
+
+    async def __acall__(self, request):
+        start = time.perf_counter()
+        response = await self.get_response(request)
+        self.record(request, response, time.perf_counter() - start)
+        return response
+
+    def record(self, request, response, duration, queries=None):
+        match = request.resolver_match
+        view = match.url_name if match is not None and match.url_name else 'unknown'
+        if view != 'metrics':
+            observe('cafeteria_request_duration_seconds', duration, view=view)
+            inc('cafeteria_requests_total', view=view, status=response.status_code)
+            if queries is not None:
+                inc('cafeteria_db_queries_total', queries, view=view)
+            registry.flush()
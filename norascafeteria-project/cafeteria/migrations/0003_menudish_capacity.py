@@ -0,0 +1,44 @@
+from django.db import migrations, models
+import django.db.models.deletion
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('cafeteria', '0002_order_created_at_indexes'),
+    ]
+
+    operations = [
+        # Menu.dishes keeps its table, it only gets a model to add the capacity columns
+        migrations.SeparateDatabaseAndState(
+            state_operations=[
+                migrations.CreateModel(
+                    name='MenuDish',
+                    fields=[
+                        ('id', models.AutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                        ('dish', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, to='cafeteria.dish')),
+                        ('menu', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, to='cafeteria.menu')),
+                    ],
+                    options={
+                        'db_table': 'cafeteria_menu_dishes',
+                        'unique_together': {('menu', 'dish')},
+                    },
+                ),
+                migrations.AlterField(
+                    model_name='menu',
+                    name='dishes',
+                    field=models.ManyToManyField(through='cafeteria.MenuDish', to='cafeteria.Dish'),
+                ),
+            ],
+        ),
+        migrations.AddField(
+            model_name='menudish',
+            name='capacity',
+            field=models.PositiveIntegerField(blank=True, null=True),
+        ),
+        migrations.AddField(
+            model_name='menudish',
+            name='remaining',
+            field=models.PositiveIntegerField(blank=True, null=True),
+        ),
+    ]
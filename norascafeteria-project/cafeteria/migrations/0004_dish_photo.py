@@ -0,0 +1,23 @@
+# Generated by Django 3.1.5 on 2026-10-19 12:13
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('cafeteria', '0003_menudish_capacity'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='dish',
+            name='photo',
+            field=models.ImageField(blank=True, null=True, upload_to='dishes'),
+        ),
+        migrations.AddField(
+            model_name='dish',
+            name='photo_variants',
+            field=models.JSONField(blank=True, default=dict),
+        ),
+    ]
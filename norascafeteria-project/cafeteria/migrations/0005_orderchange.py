@@ -0,0 +1,33 @@
+# Generated by Django 3.1.5 on 2026-10-19 12:31
+
+from django.conf import settings
+from django.db import migrations, models
+import django.db.models.deletion
+import django.utils.timezone
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('cafeteria', '0004_dish_photo'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='OrderChange',
+            fields=[
+                ('id', models.AutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('order_id', models.IntegerField()),
+                ('action', models.CharField(choices=[('created', 'Created'), ('updated', 'Updated'), ('deleted', 'Deleted')], max_length=8)),
+                ('customizations', models.CharField(blank=True, default='', max_length=256, null=True)),
+                ('date', models.DateField()),
+                ('changed_at', models.DateTimeField(default=django.utils.timezone.now)),
+                ('dish', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, to='cafeteria.dish')),
+                ('employee', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, to=settings.AUTH_USER_MODEL)),
+            ],
+        ),
+        migrations.AddIndex(
+            model_name='orderchange',
+            index=models.Index(fields=['changed_at'], name='orderchange_changed_at_idx'),
+        ),
+    ]
@@ -0,0 +1,18 @@
+# Generated by Django 3.1.5 on 2026-10-19 12:33
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('cafeteria', '0005_orderchange'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='user',
+            name='slack_id',
+            field=models.CharField(blank=True, max_length=32, null=True, unique=True),
+        ),
+    ]
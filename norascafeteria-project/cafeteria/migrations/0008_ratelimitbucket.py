@@ -0,0 +1,24 @@
+# Generated by Django 3.1.5 on 2026-10-19 12:56
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('cafeteria', '0007_notification'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='RateLimitBucket',
+            fields=[
+                ('key', models.CharField(max_length=200, primary_key=True, serialize=False)),
+                ('full_at', models.FloatField()),
+            ],
+        ),
+        migrations.AddIndex(
+            model_name='ratelimitbucket',
+            index=models.Index(fields=['full_at'], name='ratelimitbucket_full_at_idx'),
+        ),
+    ]
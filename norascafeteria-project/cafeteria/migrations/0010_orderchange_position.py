@@ -0,0 +1,54 @@
+from django.conf import settings
+from django.db import migrations, models
+from django.db.models import F, OuterRef, Subquery
+import django.db.models.deletion
+
+
+def fill_names_and_positions(apps, schema_editor):
+    OrderChange = apps.get_model('cafeteria', 'OrderChange')
+    User = apps.get_model('cafeteria', 'User')
+    Dish = apps.get_model('cafeteria', 'Dish')
+    # The consumers keep their cursors, the ids become the positions
+    OrderChange.objects.update(
+        employee_username=Subquery(User.objects.filter(id=OuterRef('employee_id')).values('username')[:1]),
+        dish_name=Subquery(Dish.objects.filter(id=OuterRef('dish_id')).values('name')[:1]),
+        position=F('id'),
+    )
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('cafeteria', '0009_idempotencykey'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='orderchange',
+            name='employee_username',
+            field=models.CharField(default='', max_length=150),
+            preserve_default=False,
+        ),
+        migrations.AddField(
+            model_name='orderchange',
+            name='dish_name',
+            field=models.CharField(default='', max_length=256),
+            preserve_default=False,
+        ),
+        migrations.AddField(
+            model_name='orderchange',
+            name='position',
+            field=models.PositiveBigIntegerField(blank=True, null=True, unique=True),
+        ),
+        migrations.AlterField(
+            model_name='orderchange',
+            name='employee',
+            field=models.ForeignKey(blank=True, null=True, on_delete=django.db.models.deletion.SET_NULL, to=settings.AUTH_USER_MODEL),
+        ),
+        migrations.AlterField(
+            model_name='orderchange',
+            name='dish',
+            field=models.ForeignKey(blank=True, null=True, on_delete=django.db.models.deletion.SET_NULL, to='cafeteria.dish'),
+        ),
+        migrations.RunPython(fill_names_and_positions, migrations.RunPython.noop),
+    ]
@@ -0,0 +1,31 @@
+# Generated by Django 3.1.5 on 2026-10-19 18:05
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('cafeteria', '0010_orderchange_position'),
+    ]
+
+    operations = [
+        migrations.RemoveIndex(
+            model_name='notification',
+            name='notification_pending_idx',
+        ),
+        migrations.AddField(
+            model_name='notification',
+            name='claimed_by',
+            field=models.UUIDField(blank=True, null=True),
+        ),
+        migrations.AddField(
+            model_name='notification',
+            name='next_attempt_at',
+            field=models.DateTimeField(blank=True, null=True),
+        ),
+        migrations.AddIndex(
+            model_name='notification',
+            index=models.Index(fields=['sent_at', 'attempts', 'id'], name='notification_pending_idx'),
+        ),
+    ]
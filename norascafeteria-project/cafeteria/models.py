@@ -1,8 +1,12 @@
 import uuid as uuid
 
 from django.contrib.auth.models import UserManager, AbstractUser, PermissionsMixin
-from django.db import models
-from django.utils.timezone import now, localtime
+from django.db import IntegrityError, models, transaction
+from django.db.models import Count, F, Max, OuterRef, Q, Subquery, Value
+from django.db.models.functions import Coalesce, Greatest
+from django.db.models.signals import post_delete, pre_delete
+from django.dispatch import receiver
+from django.utils.timezone import localdate, now
 
 
 ROLES = (
@@ -10,11 +14,19 @@ ROLES = (
     ('employee', "Employee"),
 )
 
+ORDER_ACTIONS = (
+    ('created', "Created"),
+    ('updated', "Updated"),
+    ('deleted', "Deleted"),
+)
+
 
 class User(AbstractUser):
     last_name = models.CharField(max_length=100, blank=True, null=True)
     password = models.CharField(max_length=100)
     role = models.CharField(max_length=8, choices=ROLES, default='employee')
+    # Member id in the Slack workspace, set by sync_slack_users
+    slack_id = models.CharField(max_length=32, unique=True, blank=True, null=True)
 
     objects = UserManager()
 
@@ -24,15 +36,53 @@ class User(AbstractUser):
 
 class Dish(models.Model):
     name = models.CharField(max_length=256, unique=True)
+    photo = models.ImageField(upload_to='dishes', blank=True, null=True)
+    # Resized copies of the photo by extension and width, created by cafeteria.thumbnails
+    photo_variants = models.JSONField(default=dict, blank=True)
 
     def __str__(self):
         return self.name
 
+    def photo_srcset(self, extension):
+        variants = self.photo_variants.get(extension, {})
+        return ', '.join(f'{self.photo.storage.url(name)} {width}w' for width, name in variants.items())
+
+    @property
+    def webp_srcset(self):
+        return self.photo_srcset('webp')
+
+    @property
+    def jpg_srcset(self):
+        return self.photo_srcset('jpg')
+
+    def delete_photo_variants(self, variants=None, keep=None):
+        """Deletes the files of the resized copies, by default the ones saved in the dish.
+
+        The files also named in the ``keep`` variants are not deleted.
+        """
+        kept = {name for names in (keep or {}).values() for name in names.values()}
+        for names in (self.photo_variants if variants is None else variants).values():
+            for name in names.values():
+                if name not in kept:
+                    self.photo.storage.delete(name)
+
+    def delete_photo_files(self):
+        """Deletes the photo and its resized copies."""
+        self.delete_photo_variants()
+        if self.photo:
+            self.photo.storage.delete(self.photo.name)
+
+
+@receiver(post_delete, sender=Dish)
+def delete_dish_photo_files(sender, instance, **kwargs):
+    # The files are only deleted once the delete is committed
+    transaction.on_commit(instance.delete_photo_files)
+
 
 class Menu(models.Model):
     date = models.DateField(unique=True)
     detail = models.TextField()
-    dishes = models.ManyToManyField(Dish)
+    dishes = models.ManyToManyField(Dish, through='MenuDish')
     uuid = models.UUIDField(primary_key=True, default=uuid.uuid4, editable=False)
     notification_sent = models.BooleanField(default=False)
 
@@ -40,14 +90,318 @@ class Menu(models.Model):
         return f'{self.date} {self.detail}'
 
 
+class MenuDish(models.Model):
+    menu = models.ForeignKey(Menu, on_delete=models.CASCADE)
+    dish = models.ForeignKey(Dish, on_delete=models.CASCADE)
+    # Portions the kitchen can make, empty means there is no limit
+    capacity = models.PositiveIntegerField(blank=True, null=True)
+    # Portions left to order, only changed with conditional updates
+    remaining = models.PositiveIntegerField(blank=True, null=True)
+
+    class Meta:
+        # Same table Django created for Menu.dishes before it had a through model
+        db_table = 'cafeteria_menu_dishes'
+        unique_together = ('menu', 'dish',)
+
+    def __str__(self):
+        return f'{self.menu.date} {self.dish.name} {self.remaining}/{self.capacity}'
+
+    @classmethod
+    def reserve(cls, menu, dish, portions=1):
+        """Takes portions of the dish in a single UPDATE.
+
+        Returns False if the dish is not in the menu or there are not enough portions left.
+        """
+        return cls.objects.filter(
+            Q(remaining__isnull=True) | Q(remaining__gte=portions),
+            menu=menu,
+            dish=dish,
+        ).update(remaining=F('remaining') - portions) == 1
+
+    @classmethod
+    def release(cls, menu, dish):
+        """Gives back one portion of the dish."""
+        cls.objects.filter(
+            menu=menu,
+            dish=dish,
+            remaining__isnull=False,
+            remaining__lt=F('capacity'),
+        ).update(remaining=F('remaining') + 1)
+
+    @classmethod
+    def set_capacity(cls, menu, dish, capacity):
+        """Sets the capacity, what is left is the capacity minus the orders already placed."""
+        remaining = None
+        if capacity is not None:
+            ordered = Order.objects.filter(
+                dish=OuterRef('dish'),
+                created_at=menu.date,
+            ).values('dish').annotate(count=Count('id')).values('count')
+            remaining = Greatest(Value(capacity) - Coalesce(Subquery(ordered), 0), 0)
+        cls.objects.filter(menu=menu, dish=dish).update(capacity=capacity, remaining=remaining)
+
+
 class Order(models.Model):
     dish = models.ForeignKey(Dish, on_delete=models.CASCADE)
     employee = models.ForeignKey(User, on_delete=models.CASCADE)
     customizations = models.CharField(max_length=256, default='', blank=True, null=True)
-    created_at = models.DateField(default=localtime(now()).date().strftime("%Y-%m-%d"))
+    # The callable is evaluated on each insert, so every order gets the local date it was placed
+    created_at = models.DateField(default=localdate)
 
     class Meta:
         unique_together = ('employee', 'created_at',)
+        indexes = [
+            # Daily listing used by see_orders
+            models.Index(fields=['created_at'], name='order_created_at_idx'),
+            # Per dish reports for a given day
+            models.Index(fields=['dish', 'created_at'], name='order_dish_created_at_idx'),
+        ]
 
     def __str__(self):
         return f'{self.created_at}  {self.employee.username} {self.dish.name}'
+
+
+class OrderChange(models.Model):
+    """Append only log of the order changes, read by payroll and the kitchen display.
+
+    It is written in the same transaction as the order. The position, the
+    cursor of the feed, is given after the commit, in commit order, so a
+    transaction that commits late is never skipped by the consumers.
+    """
+    # Not a foreign key, the changes of deleted orders are kept
+    order_id = models.IntegerField()
+    action = models.CharField(max_length=8, choices=ORDER_ACTIONS)
+    # The history is kept when a user or a dish is deleted, with the names they had
+    employee = models.ForeignKey(User, on_delete=models.SET_NULL, blank=True, null=True)
+    employee_username = models.CharField(max_length=150)
+    dish = models.ForeignKey(Dish, on_delete=models.SET_NULL, blank=True, null=True)
+    dish_name = models.CharField(max_length=256)
+    customizations = models.CharField(max_length=256, default='', blank=True, null=True)
+    date = models.DateField()
+    changed_at = models.DateTimeField(default=now)
+    # Empty until publish() numbers it
+    position = models.PositiveBigIntegerField(blank=True, null=True, unique=True)
+
+    class Meta:
+        indexes = [
+            # Compaction by age
+            models.Index(fields=['changed_at'], name='orderchange_changed_at_idx'),
+        ]
+
+    def __str__(self):
+        return f'{self.id} {self.action} order {self.order_id}'
+
+    @classmethod
+    def record(cls, orders, action):
+        """Logs the current state of the orders, call it in the transaction that changed them."""
+        orders = list(orders)
+        usernames = dict(User.objects.filter(id__in={order.employee_id for order in orders}).values_list('id', 'username'))
+        dish_names = dict(Dish.objects.filter(id__in={order.dish_id for order in orders}).values_list('id', 'name'))
+        cls.objects.bulk_create([cls(
+            order_id=order.id,
+            action=action,
+            employee_id=order.employee_id,
+            employee_username=usernames.get(order.employee_id, ''),
+            dish_id=order.dish_id,
+            dish_name=dish_names.get(order.dish_id, ''),
+            customizations=order.customizations,
+            date=order.created_at,
+        ) for order in orders])
+        transaction.on_commit(cls.publish)
+
+    @classmethod
+    def publish(cls):
+        """Gives the committed changes without a position the next positions, by id.
+
+        It runs after each commit that records changes, and picks up the
+        changes of any commit that could not publish. Positions are unique,
+        so concurrent publishers can not give the same one: the one that
+        fails retries after the other one commits.
+        """
+        for _ in range(3):
+            try:
+                with transaction.atomic():
+                    pending = list(cls.objects.select_for_update().filter(
+                        position__isnull=True).order_by('id').values_list('id', flat=True))
+                    if not pending:
+                        return
+                    last = cls.objects.aggregate(last=Max('position'))['last'] or 0
+                    cls.objects.bulk_update([
+                        cls(id=_id, position=last + i) for i, _id in enumerate(pending, 1)
+                    ], ['position'])
+                return
+            except IntegrityError:
+                continue
+
+    @classmethod
+    def compact(cls, before):
+        """Removes the changes before ``before`` that are not the last change of their order.
+
+        Consumers that far behind still get the current state of every order,
+        the delete of a deleted order is kept so they remove it too. Returns
+        the number of changes removed.
+        """
+        old = cls.objects.filter(changed_at__lt=before)
+        last = cls.objects.values('order_id').annotate(last_id=Max('id')).values('last_id')
+        removed, _ = old.exclude(id__in=Subquery(last)).delete()
+        return removed
+
+
+@receiver(pre_delete, sender=User)
+@receiver(pre_delete, sender=Dish)
+def record_cascade_deleted_orders(sender, instance, **kwargs):
+    # The orders deleted with their employee or dish are deleted in the feed too
+    field = 'employee' if sender is User else 'dish'
+    OrderChange.record(Order.objects.filter(**{field: instance}), 'deleted')
+    # The changes keep the name, the row being deleted is not referenced
+    OrderChange.objects.filter(**{field: instance}).update(**{field: None})
+
+
+class Notification(models.Model):
+    """Slack message to an employee, sent in batches in the background.
+
+    Rows are added in the transaction of the change they tell about, so a
+    message is never sent for a change that was rolled back. A worker claims
+    a batch until ``next_attempt_at``, sends it outside of any transaction and
+    records the results, failed ones wait twice as long after each attempt.
+    """
+    user = models.ForeignKey(User, on_delete=models.CASCADE)
+    message = models.TextField()
+    created_at = models.DateTimeField(default=now)
+    sent_at = models.DateTimeField(blank=True, null=True)
+    attempts = models.PositiveSmallIntegerField(default=0)
+    claimed_by = models.UUIDField(blank=True, null=True)
+    next_attempt_at = models.DateTimeField(blank=True, null=True)
+
+    class Meta:
+        indexes = [
+            # Pending notifications, fewest attempts first
+            models.Index(fields=['sent_at', 'attempts', 'id'], name='notification_pending_idx'),
+        ]
+
+    def __str__(self):
+        return f'{self.user.username} {self.message[:50]}'
+
+    @classmethod
+    def claim(cls, size, max_attempts, timeout):
+        """Claims up to ``size`` pending notifications for ``timeout`` and returns them.
+
+        Notifications with ``max_attempts`` are given up. The claim ends
+        after the timeout, so the batch of a worker that died is sent again.
+        """
+        token = uuid.uuid4()
+        current = now()
+        claimable = Q(sent_at__isnull=True, attempts__lt=max_attempts) & (
+            Q(next_attempt_at__isnull=True) | Q(next_attempt_at__lte=current))
+        with transaction.atomic():
+            ids = list(cls.objects.filter(claimable).order_by('attempts', 'id').values_list(
+                'id', flat=True)[:size])
+            # The conditions are checked again, rows claimed meanwhile by another worker are left
+            cls.objects.filter(claimable, id__in=ids).update(
+                claimed_by=token, next_attempt_at=current + timeout)
+        return list(cls.objects.filter(claimed_by=token, sent_at__isnull=True).select_related(
+            'user').order_by('attempts', 'id'))
+
+    @classmethod
+    def record_delivery(cls, sent, failed, retry_delay):
+        """Marks the ``sent`` notifications and delays the ``failed`` ones.
+
+        Failed ones wait ``retry_delay`` doubled for each attempt, those
+        claimed meanwhile by another worker are left to it.
+        """
+        current = now()
+        with transaction.atomic():
+            cls.objects.filter(id__in=[notification.id for notification in sent]).update(
+                sent_at=current, claimed_by=None)
+            for attempts in sorted({notification.attempts for notification in failed}):
+                cls.objects.filter(
+                    claimed_by=failed[0].claimed_by,
+                    id__in=[notification.id for notification in failed if notification.attempts == attempts]
+                ).update(
+                    attempts=attempts + 1, claimed_by=None,
+                    next_attempt_at=current + retry_delay * 2 ** attempts)
+
+
+class RateLimitBucket(models.Model):
+    """Token bucket of a rate limit, shared by all the workers.
+
+    It only stores the time it is full again (generic cell rate algorithm),
+    so a token is taken with a single conditional UPDATE and concurrent
+    requests can never take the same token.
+    """
+    key = models.CharField(max_length=200, primary_key=True)
+    # Unix time when all the tokens are back, buckets full before now can be removed
+    full_at = models.FloatField()
+
+    class Meta:
+        indexes = [
+            models.Index(fields=['full_at'], name='ratelimitbucket_full_at_idx'),
+        ]
+
+    def __str__(self):
+        return f'{self.key} {self.full_at}'
+
+    @classmethod
+    def take(cls, key, rate, burst, _now):
+        """Takes one token, the bucket holds up to ``burst`` tokens and gets ``rate`` tokens per second.
+
+        Returns 0 if a token was taken, or the seconds to wait for one.
+        Rejected requests do not write, they do not delay the refill.
+        """
+        interval = 1 / rate
+        for _ in range(2):
+            # There is a token while the bucket is full before burst - 1 more intervals
+            if cls.objects.filter(key=key, full_at__lte=_now + (burst - 1) * interval).update(
+                    full_at=Greatest(F('full_at'), _now) + interval):
+                return 0
+            try:
+                with transaction.atomic():
+                    cls.objects.create(key=key, full_at=_now + interval)
+                return 0
+            except IntegrityError:
+                # It exists, or another request created it meanwhile
+                pass
+        full_at = cls.objects.filter(key=key).values_list('full_at', flat=True).first() or _now
+        return max(full_at - (burst - 1) * interval - _now, interval / 100)
+
+    @classmethod
+    def clear_expired(cls, _now):
+        """Removes the full buckets, they are the same as no bucket."""
+        deleted, _ = cls.objects.filter(full_at__lt=_now).delete()
+        return deleted
+
+
+class IdempotencyKey(models.Model):
+    """Response of the first post with an idempotency token, repeated posts get it back.
+
+    The request that inserts the key runs the view, the primary key makes
+    the insert of any other request with the same key fail.
+    """
+    key = models.CharField(max_length=255, primary_key=True)
+    created_at = models.DateTimeField(default=now)
+    # Empty while the first request is running
+    status = models.PositiveSmallIntegerField(blank=True, null=True)
+    content_type = models.CharField(max_length=100, blank=True)
+    content = models.BinaryField(blank=True, default=b'')
+
+    class Meta:
+        indexes = [
+            models.Index(fields=['created_at'], name='idempotencykey_created_at_idx'),
+        ]
+
+    def __str__(self):
+        return f'{self.key} {self.status}'
+
+    @classmethod
+    def claim(cls, key, expired_before):
+        """Inserts the key, returns False if another request has it.
+
+        Keys created before ``expired_before`` are replaced.
+        """
+        cls.objects.filter(key=key, created_at__lt=expired_before).delete()
+        try:
+            with transaction.atomic():
+                cls.objects.create(key=key)
+        except IntegrityError:
+            return False
+        return True
@@ -0,0 +1,126 @@
+import atexit
+import logging
+import threading
+import time
+from concurrent.futures import Future, wait
+from datetime import timedelta
+
+from asgiref.sync import async_to_sync
+from django.conf import settings
+from django.db import connection, transaction
+
+from . import metrics
+from .models import Notification
+from .slackapi import post_messages
+
+
+# This retrieves a Python logging instance (or creates it)
+logger = logging.getLogger(__name__)
+
+_worker = None
+_lock = threading.Lock()
+_wakeup = threading.Event()
+_stopping = threading.Event()
+# Futures of the scheduled deliveries, done when a delivery that started after them ends
+_pending = set()
+
+
+def enqueue(messages):
+    """Queues (user, message) notifications, call it in the transaction of the change.
+
+    Users without a Slack id can not be notified. They are delivered in the
+    background once the transaction commits.
+    """
+    notifications = [Notification(user=user, message=message) for user, message in messages if user.slack_id]
+    Notification.objects.bulk_create(notifications)
+    if notifications:
+        transaction.on_commit(schedule_delivery)
+    return len(notifications)
+
+
+def deliver_pending():
+    """Sends the pending notifications in batches of NOTIFICATION_BATCH_SIZE.
+
+    Each batch is claimed and its results recorded in short transactions,
+    Slack is called with none open. Failed ones are retried by a later
+    delivery after NOTIFICATION_RETRY_DELAY, doubled after each attempt.
+    """
+    try:
+        while not _stopping.is_set():
+            batch = Notification.claim(
+                settings.NOTIFICATION_BATCH_SIZE,
+                settings.NOTIFICATION_MAX_ATTEMPTS,
+                timedelta(seconds=settings.NOTIFICATION_CLAIM_TIMEOUT)
+            )
+            if not batch:
+                return
+            results = async_to_sync(post_messages)([
+                (notification.user.slack_id, notification.message) for notification in batch
+            ])
+            sent = [notification for notification, ok in zip(batch, results) if ok]
+            failed = [notification for notification, ok in zip(batch, results) if not ok]
+            Notification.record_delivery(sent, failed, timedelta(seconds=settings.NOTIFICATION_RETRY_DELAY))
+            metrics.inc('cafeteria_employee_notifications_total', len(sent), result='sent')
+            if failed:
+                metrics.inc('cafeteria_employee_notifications_total', len(failed), result='failed')
+    except Exception as e:
+        logger.error("Error delivering notifications: %s", e)
+    finally:
+        # The worker thread has its own database connection
+        connection.close()
+
+
+def work():
+    """Delivers when a delivery is scheduled, and every NOTIFICATION_RETRY_INTERVAL for the failed ones."""
+    while not _stopping.is_set():
+        _wakeup.wait(settings.NOTIFICATION_RETRY_INTERVAL)
+        _wakeup.clear()
+        with _lock:
+            scheduled = list(_pending)
+        if _stopping.is_set():
+            return
+        try:
+            deliver_pending()
+        finally:
+            with _lock:
+                _pending.difference_update(scheduled)
+            for future in scheduled:
+                future.set_result(None)
+
+
+def schedule_delivery():
+    """Delivers the pending notifications in the background and returns the future."""
+    global _worker
+    future = Future()
+    with _lock:
+        _pending.add(future)
+        # Started on the first delivery of each process, forked workers start their own
+        if _worker is None or not _worker.is_alive():
+            _worker = threading.Thread(target=work, name='notifications', daemon=True)
+            _worker.start()
+    _wakeup.set()
+    return future
+
+
+def wait_pending(timeout=None):
+    """Waits for the scheduled deliveries, used by the tests and on exit."""
+    with _lock:
+        pending = list(_pending)
+    wait(pending, timeout=timeout)
+
+
+def stop():
+    """Gives the deliveries NOTIFICATION_EXIT_TIMEOUT seconds on exit.
+
+    The worker is a daemon thread, a batch still being sent after that is
+    claimed again by another worker once its claim expires.
+    """
+    deadline = time.monotonic() + settings.NOTIFICATION_EXIT_TIMEOUT
+    wait_pending(settings.NOTIFICATION_EXIT_TIMEOUT)
+    _stopping.set()
+    _wakeup.set()
+    if _worker is not None:
+        _worker.join(max(0, deadline - time.monotonic()))
+
+
+atexit.register(stop)
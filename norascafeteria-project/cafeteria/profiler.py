@@ -0,0 +1,155 @@
+import asyncio
+import logging
+import os
+import sys
+import threading
+import time
+import uuid
+from collections import Counter
+
+from asgiref.sync import sync_to_async
+from django.conf import settings
+from django.utils.deprecation import MiddlewareMixin
+
+
+# This retrieves a Python logging instance (or creates it)
+logger = logging.getLogger(__name__)
+
+PROFILE_EXTENSION = '.collapsed'
+
+
+class StackSampler:
+    """Samples the stack of one thread and counts the collapsed stacks.
+
+    The output uses the collapsed format ("frame;frame;frame count") read by
+    flamegraph.pl and speedscope.
+    """
+
+    def __init__(self, thread_id, interval):
+        self.thread_id = thread_id
+        self.interval = interval
+        self.stacks = Counter()
+        self._stop = threading.Event()
+        self._thread = threading.Thread(target=self._run, daemon=True)
+
+    def start(self):
+        self._thread.start()
+
+    def stop(self):
+        self._stop.set()
+        self._thread.join()
+
+    def _run(self):
+        while not self._stop.wait(self.interval):
+            frame = sys._current_frames().get(self.thread_id)
+            if frame is None:
+                continue
+            stack = []
+            while frame is not None:
+                code = frame.f_code
+                stack.append(f'{code.co_name} ({os.path.basename(code.co_filename)}:{code.co_firstlineno})')
+                frame = frame.f_back
+            # Root frame first
+            self.stacks[';'.join(reversed(stack))] += 1
+
+    def collapsed(self):
+        return ''.join(f'{stack} {count}\n' for stack, count in self.stacks.items())
+
+
+def profile_dir():
+    return str(settings.PROFILER_DIR)
+
+
+def list_profiles():
+    """Returns the stored profiles, newest first."""
+    try:
+        entries = [entry for entry in os.scandir(profile_dir())
+                   if entry.is_file() and entry.name.endswith(PROFILE_EXTENSION)]
+    except FileNotFoundError:
+        return []
+    entries.sort(key=lambda entry: entry.stat().st_mtime, reverse=True)
+    return [{
+        'name': entry.name,
+        'size': entry.stat().st_size,
+        'created_at': entry.stat().st_mtime,
+    } for entry in entries]
+
+
+def profile_path(name):
+    """Returns the path of a stored profile, or None if the name is not a stored profile."""
+    name = os.path.basename(name)
+    path = os.path.join(profile_dir(), name)
+    if not name.endswith(PROFILE_EXTENSION) or not os.path.isfile(path):
+        return None
+    return path
+
+
+def save_profile(label, content):
+    """Writes a profile and drops the oldest ones beyond PROFILER_MAX_FILES."""
+    directory = profile_dir()
+    os.makedirs(directory, exist_ok=True)
+    label = ''.join(char if char.isalnum() or char in '-_' else '_' for char in label)
+    name = f'{time.strftime("%Y%m%d-%H%M%S")}-{label}-{uuid.uuid4().hex[:8]}{PROFILE_EXTENSION}'
+    with open(os.path.join(directory, name), 'w') as file:
+        file.write(content)
+
+    for profile in list_profiles()[settings.PROFILER_MAX_FILES:]:
+        try:
+            os.remove(os.path.join(directory, profile['name']))
+        except FileNotFoundError:
+            # Another worker already removed it
+            pass
+    return name
+
+
+class ProfilerMiddleware(MiddlewareMixin):
+    """Profiles a request when an admin asks for it.
+
+    Add ``?profile=1`` to the url or send the ``X-Profile`` header. Any other
+    request only pays for the two lookups below. Async requests sample the
+    thread Django runs their views and queries in, not the event loop, the
+    requests served at the same time show up in the profile too.
+    """
+
+    def wants_profile(self, request):
+        return 'profile' in request.GET or 'HTTP_X_PROFILE' in request.META
+
+    def is_admin(self, request):
+        user = request.user
+        return user.is_authenticated and user.role.lower() == 'admin'
+
+    def __call__(self, request):
+        if asyncio.iscoroutinefunction(self.get_response):
+            return self.__acall__(request)
+        if not self.wants_profile(request) or not self.is_admin(request):
+            return self.get_response(request)
+
+        sampler = StackSampler(threading.get_ident(), settings.PROFILER_INTERVAL)
+        sampler.start()
+        try:
+            response = self.get_response(request)
+        finally:
+            sampler.stop()
+        return self.save(request, response, sampler)
+
+    async def __acall__(self, request):
+        if not self.wants_profile(request) or not await sync_to_async(self.is_admin)(request):
+            return await self.get_response(request)
+
+        # The event loop only waits, the sync code of the request runs in this thread
+        thread_id = await sync_to_async(threading.get_ident, thread_sensitive=True)()
+        sampler = StackSampler(thread_id, settings.PROFILER_INTERVAL)
+        sampler.start()
+        try:
+            response = await self.get_response(request)
+        finally:
+            sampler.stop()
+        return self.save(request, response, sampler)
+
+    def save(self, request, response, sampler):
+        try:
+            name = save_profile(request.path.strip('/') or 'home', sampler.collapsed())
+            response['X-Profile'] = name
+        except OSError as e:
+            logger.error("Error saving profile: %s", e)
+        return response
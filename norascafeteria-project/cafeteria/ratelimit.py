@@ -0,0 +1,150 @@
+import asyncio
+import logging
+import math
+import threading
+import time
+from functools import wraps
+
+from django.conf import settings
+from django.db import transaction
+from django.http import HttpResponse
+from django.utils.deprecation import MiddlewareMixin
+
+from . import metrics
+from .models import RateLimitBucket
+
+
+# This retrieves a Python logging instance (or creates it)
+logger = logging.getLogger(__name__)
+
+
+def take_token(key, rate, burst):
+    """Takes one token of the rate limit bucket of ``key``.
+
+    Returns 0 if a token was taken, or the seconds to wait for one.
+    """
+    return take_tokens([(key, rate, burst)])[0]
+
+
+def take_tokens(buckets):
+    """Takes one token of each (key, rate, burst) bucket, or none of them.
+
+    They are taken in one transaction, on SQLite a request waits for the
+    write lock the orders use once instead of once per bucket. Returns
+    (0, None), or the seconds to wait and the key of the empty bucket.
+    """
+    _now = time.time()
+    with transaction.atomic():
+        for key, rate, burst in buckets:
+            wait = RateLimitBucket.take(key, rate, burst, _now)
+            if wait:
+                # The tokens of the other buckets are given back
+                transaction.set_rollback(True)
+                return wait, key
+    return 0, None
+
+
+def client_ip(request):
+    value = request.META.get(settings.RATELIMIT_IP_META, '')
+    # Proxies append the address they got the request from, the last one is the one we trust
+    return value.split(',')[-1].strip()
+
+
+def too_many_requests(retry_after, reason, group):
+    metrics.inc('cafeteria_requests_rejected_total', reason=reason, group=group)
+    response = HttpResponse(
+        f'Too many requests, please try again in {retry_after} seconds',
+        status=429 if reason == 'rate_limited' else 503,
+        content_type='text/plain'
+    )
+    response['Retry-After'] = retry_after
+    return response
+
+
+def ratelimit(group, methods=('POST',), username_field=None):
+    """Limits the requests of a view per user and per IP with the RATELIMITS[group] buckets.
+
+    Anonymous requests, like the login, are limited by the username posted in
+    ``username_field``. Requests over the limit get a 429 with Retry-After,
+    the view is not called.
+    """
+    def decorator(view):
+        @wraps(view)
+        def wrapper(request, *args, **kwargs):
+            limits = settings.RATELIMITS.get(group)
+            if limits and request.method in methods:
+                keys = [('ip', client_ip(request))]
+                if request.user.is_authenticated:
+                    keys.append(('user', request.user.pk))
+                elif username_field and request.POST.get(username_field):
+                    keys.append(('user', request.POST[username_field].lower()[:150]))
+                wait, key = take_tokens([
+                    (f'ratelimit:{group}:{kind}:{value}', *limits[kind]) for kind, value in keys
+                ])
+                if wait:
+                    logger.warning("Rate limited %s", key)
+                    return too_many_requests(math.ceil(wait), 'rate_limited', group)
+            return view(request, *args, **kwargs)
+        return wrapper
+    return decorator
+
+
+class AdmissionControlMiddleware(MiddlewareMixin):
+    """Rejects requests at once when the process is full instead of queueing them.
+
+    Each process handles up to ADMISSION_MAX_CONCURRENT_REQUESTS at the same
+    time, static and media files do not count. The slots are not shared, the
+    site handles up to that many requests per worker. Requests the proxy
+    kept waiting more than ADMISSION_MAX_QUEUE_TIME seconds (X-Request-Start
+    header) are also rejected, the user has probably retried already. Both
+    get a 503 with Retry-After.
+    """
+
+    def __init__(self, get_response):
+        super().__init__(get_response)
+        self.slots = threading.BoundedSemaphore(settings.ADMISSION_MAX_CONCURRENT_REQUESTS)
+
+    def queue_time(self, request):
+        # Heroku and nginx send the time the request arrived, in milliseconds
+        start = request.META.get('HTTP_X_REQUEST_START', '').replace('t=', '')
+        try:
+            return time.time() - float(start) / 1000
+        except ValueError:
+            return 0
+
+    def admit(self, request):
+        """Takes a slot, or returns the response of a rejected request."""
+        if self.queue_time(request) > settings.ADMISSION_MAX_QUEUE_TIME:
+            return too_many_requests(settings.ADMISSION_RETRY_AFTER, 'queue_timeout', 'all')
+        if not self.slots.acquire(blocking=False):
+            return too_many_requests(settings.ADMISSION_RETRY_AFTER, 'overloaded', 'all')
+        return None
+
+    def exempt(self, request):
+        # Static and media files are cheap, and a page needs many of them
+        return request.path.startswith((settings.STATIC_URL, settings.MEDIA_URL))
+
+    def __call__(self, request):
+        if asyncio.iscoroutinefunction(self.get_response):
+            return self.__acall__(request)
+        if self.exempt(request):
+            return self.get_response(request)
+        rejected = self.admit(request)
+        if rejected is not None:
+            return rejected
+        try:
+            return self.get_response(request)
+        finally:
+            self.slots.release()
+
+    async def __acall__(self, request):
+        # Under ASGI the slots are connections being answered by the event loop
+        if self.exempt(request):
+            return await self.get_response(request)
+        rejected = self.admit(request)
+        if rejected is not None:
+            return rejected
+        try:
+            return await self.get_response(request)
+        finally:
+            self.slots.release()
@@ -1,34 +1,111 @@
 import asyncio
 import logging
 
+import aiohttp
+
+from asgiref.sync import async_to_sync
 from django.conf import settings
 from slack import WebClient
 from slack.errors import SlackApiError
 
+from . import metrics
+
 
 # This retrieves a Python logging instance (or creates it)
 logger = logging.getLogger(__name__)
 
 
-def send_async_notification(message):
+async def notify(message):
+    """Posts the message in the Slack channel, the async views await it directly."""
     client = WebClient(
         token=settings.SLACK_API_TOKEN,
+        base_url=settings.SLACK_API_URL,
         run_async=True
     )
-
-    future = client.chat_postMessage(
-        channel=settings.CHANNEL,
-        text=message
-    )
-    loop = asyncio.get_event_loop()
     try:
-        loop.run_until_complete(future)
+        await client.chat_postMessage(
+            channel=settings.CHANNEL,
+            text=message
+        )
+        metrics.inc('cafeteria_menu_notifications_total', result='sent')
     except SlackApiError as e:
-        logger.error(f"Got an error: {e}")
+        logger.error("Got an error: %s", e)
+        metrics.inc('cafeteria_menu_notifications_total', result='failed')
         # This will notify the admin that something is wrong with the slack configuration
         raise e
     except Exception as e:
-        logger.error(f"Error {e}")
+        logger.error("Error %s", e)
+        metrics.inc('cafeteria_menu_notifications_total', result='failed')
         raise e
-    finally:
-        loop.close()
+
+
+def send_async_notification(message):
+    # Sync views have no event loop, asgiref runs the coroutine in one (the server's one under ASGI)
+    async_to_sync(notify)(message)
+
+
+async def call_with_retry(request):
+    """Awaits ``request()`` again after the Retry-After of each 429 answer of Slack.
+
+    Gives up after SLACK_MAX_RETRIES retries.
+    """
+    for retry in range(settings.SLACK_MAX_RETRIES + 1):
+        try:
+            return await request()
+        except SlackApiError as e:
+            if e.response.status_code != 429 or retry == settings.SLACK_MAX_RETRIES:
+                raise e
+            retry_after = int(e.response.headers.get('Retry-After', 1))
+            logger.warning("Slack rate limited, retrying in %s seconds", retry_after)
+            await asyncio.sleep(retry_after)
+
+
+async def list_users(page_size):
+    """Returns the members of the workspace, following the users.list cursor."""
+    members = []
+    # One session keeps the connection open between the pages
+    async with aiohttp.ClientSession() as session:
+        client = WebClient(
+            token=settings.SLACK_API_TOKEN,
+            base_url=settings.SLACK_API_URL,
+            session=session,
+            run_async=True
+        )
+        params = {'limit': page_size}
+        while True:
+            try:
+                response = await call_with_retry(lambda: client.users_list(**params))
+            except SlackApiError as e:
+                logger.error("Got an error: %s", e)
+                raise e
+            members.extend(response['members'])
+            cursor = response.get('response_metadata', {}).get('next_cursor')
+            if not cursor:
+                return members
+            params['cursor'] = cursor
+
+
+async def post_messages(messages):
+    """Sends (channel, text) messages at the same time over one session.
+
+    At most SLACK_CONCURRENCY are in flight. Returns whether each one was sent.
+    """
+    semaphore = asyncio.Semaphore(settings.SLACK_CONCURRENCY)
+    async with aiohttp.ClientSession() as session:
+        client = WebClient(
+            token=settings.SLACK_API_TOKEN,
+            base_url=settings.SLACK_API_URL,
+            session=session,
+            run_async=True
+        )
+
+        async def post(channel, text):
+            async with semaphore:
+                try:
+                    await call_with_retry(lambda: client.chat_postMessage(channel=channel, text=text))
+                    return True
+                except Exception as e:
+                    logger.error("Error sending to %s: %s", channel, e)
+                    return False
+
+        return await asyncio.gather(*(post(channel, text) for channel, text in messages))
@@ -0,0 +1,123 @@
+import gzip
+import logging
+import re
+
+from django.conf import settings
+from django.contrib.staticfiles.storage import ManifestFilesMixin, StaticFilesStorage, staticfiles_storage
+from django.core.files.base import ContentFile
+from django.utils.cache import patch_vary_headers
+from django.views import static
+
+try:
+    import brotli
+except ImportError:
+    # Only gzip variants are created without the brotli package
+    brotli = None
+
+from .images import IMAGE_FORMATS, image_variant_name, resize_image
+
+
+# This retrieves a Python logging instance (or creates it)
+logger = logging.getLogger(__name__)
+
+IMMUTABLE_CACHE_CONTROL = 'public, max-age=31536000, immutable'
+COMPRESSIBLE_EXTENSIONS = ('.css', '.js', '.svg', '.txt', '.json', '.html')
+# Django adds the first 12 characters of the md5 of the content to the hashed names
+HASHED_NAME = re.compile(r'\.[0-9a-f]{12}\.[^./]+$')
+
+
+def is_hashed(name):
+    return HASHED_NAME.search(name) is not None
+
+
+class HashedStaticFilesMixin(ManifestFilesMixin):
+    """Content hashed names through the manifest, plus resized copies of the images in STATIC_IMAGE_VARIANTS."""
+
+    def stored_name(self, name):
+        # Until collectstatic writes the manifest (development and tests) files keep their own name
+        if not self.hashed_files:
+            return name
+        return super().stored_name(name)
+
+    def post_process(self, paths, dry_run=False, **options):
+        if not dry_run:
+            paths = dict(paths)
+            paths.update(self.create_image_variants(paths))
+        yield from super().post_process(paths, dry_run, **options)
+
+    def create_image_variants(self, paths):
+        variants = {}
+        for name, widths in settings.STATIC_IMAGE_VARIANTS.items():
+            if name not in paths:
+                continue
+            storage, path = paths[name]
+            for width in widths:
+                for extension in IMAGE_FORMATS:
+                    with storage.open(path) as file:
+                        content = resize_image(file, width, extension)
+                    variant = image_variant_name(name, width, extension)
+                    if self.exists(variant):
+                        self.delete(variant)
+                    self.save(variant, ContentFile(content))
+                    variants[variant] = (self, variant)
+        return variants
+
+    def image_srcset(self, name, extension):
+        """srcset of the resized copies of an image, empty until collectstatic created them."""
+        candidates = []
+        for width in settings.STATIC_IMAGE_VARIANTS.get(name, ()):
+            variant = image_variant_name(name, width, extension)
+            if self.hashed_files.get(self.hash_key(variant)):
+                candidates.append(f'{self.url(variant)} {width}w')
+        return ', '.join(candidates)
+
+
+class CompressedManifestStaticFilesStorage(HashedStaticFilesMixin, StaticFilesStorage):
+    """Local storage that also writes gzip and brotli copies of the hashed text files."""
+
+    def post_process(self, paths, dry_run=False, **options):
+        yield from super().post_process(paths, dry_run, **options)
+        if dry_run:
+            return
+        for name in set(self.hashed_files.values()):
+            if name.endswith(COMPRESSIBLE_EXTENSIONS):
+                for compressed_name in self.compress(name):
+                    yield compressed_name, compressed_name, True
+
+    def compress(self, name):
+        with self.open(name) as file:
+            content = file.read()
+        variants = [(f'{name}.gz', gzip.compress(content, compresslevel=9, mtime=0))]
+        if brotli is not None:
+            variants.append((f'{name}.br', brotli.compress(content)))
+        for compressed_name, compressed in variants:
+            # Small files can get bigger
+            if len(compressed) >= len(content):
+                continue
+            if self.exists(compressed_name):
+                self.delete(compressed_name)
+            self.save(compressed_name, ContentFile(compressed))
+            yield compressed_name
+
+
+def serve(request, path):
+    """Serves STATIC_ROOT when Django is not in DEBUG mode.
+
+    Uses the brotli or gzip copy the browser accepts, and lets browsers keep
+    hashed files forever since their names change with their content.
+    """
+    accept_encoding = request.META.get('HTTP_ACCEPT_ENCODING', '')
+    served_path = path
+    for suffix, encoding in (('.br', 'br'), ('.gz', 'gzip')):
+        if encoding in accept_encoding and staticfiles_storage.exists(path + suffix):
+            served_path = path + suffix
+            break
+
+    response = static.serve(request, served_path, document_root=settings.STATIC_ROOT)
+    if path.endswith(COMPRESSIBLE_EXTENSIONS):
+        patch_vary_headers(response, ('Accept-Encoding',))
+    if is_hashed(path):
+        response['Cache-Control'] = IMMUTABLE_CACHE_CONTROL
+    else:
+        response['Cache-Control'] = f'public, max-age={settings.STATIC_CACHE_MAX_AGE}'
+    return response
@@ -0,0 +1,15 @@
+from uuid import uuid4
+
+from django import template
+from django.utils.html import format_html
+
+from ..idempotency import IDEMPOTENCY_FIELD
+
+
+register = template.Library()
+
+
+@register.simple_tag
+def idempotency_field():
+    """Hidden input with a new token each time the form is rendered."""
+    return format_html('<input type="hidden" name="{}" value="{}">', IDEMPOTENCY_FIELD, uuid4().hex)
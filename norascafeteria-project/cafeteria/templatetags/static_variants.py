@@ -0,0 +1,14 @@
+from django import template
+from django.contrib.staticfiles.storage import staticfiles_storage
+
+
+register = template.Library()
+
+
+@register.simple_tag
+def static_srcset(name, extension):
+    """srcset of the resized copies of a static image, or an empty string if there are none."""
+    image_srcset = getattr(staticfiles_storage, 'image_srcset', None)
+    if image_srcset is None:
+        return ''
+    return image_srcset(name, extension)
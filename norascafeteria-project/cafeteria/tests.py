@@ -1,12 +1,57 @@
+import gzip
+import io
+import json
+import logging
+import os
+import shutil
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from datetime import timedelta
 from http import HTTPStatus
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import parse_qs, urlparse
+from unittest import mock
 from uuid import UUID
 
-from django.test import TestCase
-from django.utils.timezone import now, localtime
-from django.db import IntegrityError
-
-from .models import Dish, User, Menu, Order
+from django.contrib.staticfiles.storage import staticfiles_storage
+from django.contrib.auth.models import AnonymousUser
+from django.core.files.uploadedfile import SimpleUploadedFile
+from django.core.management import call_command
+from django.http import Http404, HttpResponse
+from django.test import AsyncClient, AsyncRequestFactory, Client, RequestFactory, TestCase, TransactionTestCase, override_settings
+from django.utils.timezone import now, localtime, localdate
+from django.db import IntegrityError, connection, connections
+from django.test.utils import CaptureQueriesContext
+from PIL import Image
+from slack.errors import SlackApiError
+
+from .models import Dish, IdempotencyKey, User, Menu, MenuDish, Notification, Order, OrderChange, RateLimitBucket
+from . import asyncviews, metrics, notifications, thumbnails, views
+from .dbrouter import ReplicaRouter
 from .forms import DishForm, MenuForm, OrderForm
+from .ratelimit import AdmissionControlMiddleware, take_token
+from .log import QueueLogHandler, RequestIdFilter, SamplingFilter, request_id
+from .slackapi import send_async_notification
+from .staticfiles import IMMUTABLE_CACHE_CONTROL
+from .templatetags.static_variants import static_srcset
+
+
+# The rate limits are only on in RateLimitTest, the other tests post many orders as the same user.
+# The replica is only used in ReplicaRouterTest, the other tests only have the default database
+# The notification worker only delivers what the tests schedule
+_test_settings = override_settings(RATELIMITS={}, REPLICA_DATABASE=None, NOTIFICATION_RETRY_INTERVAL=3600)
+
+
+def setUpModule():
+    _test_settings.enable()
+
+
+def tearDownModule():
+    _test_settings.disable()
 
 
 """All Model tests"""
@@ -87,6 +132,39 @@ class OrderTest(TestCase):
             self.create_order()
             self.assertTrue('UNIQUE constraint failed' in raise_context.exception.message)
 
+    def test_order_date_default(self):
+        order = self.create_order()
+        order.refresh_from_db()
+        # The order date is evaluated on insert, not when the server started
+        self.assertEqual(order.created_at, localdate())
+
+
+class OrderQueryPlanTest(TestCase):
+
+    def setUp(self):
+        self.dish = Dish.objects.create(name="Corn pie, Salad and Dessert")
+        self.date = localdate()
+
+    def assert_uses_index(self, queryset, index_name):
+        plan = queryset.explain()
+        # SQLite reports index usage as "SEARCH ... USING [COVERING] INDEX <name>"
+        self.assertIn('USING', plan)
+        self.assertIn(index_name, plan)
+        self.assertNotIn('SCAN', plan)
+
+    def test_see_orders_uses_index(self):
+        self.assert_uses_index(Order.objects.filter(created_at=self.date), 'order_created_at_idx')
+
+    def test_dish_report_uses_index(self):
+        queryset = Order.objects.filter(dish=self.dish, created_at=self.date)
+        self.assert_uses_index(queryset, 'order_dish_created_at_idx')
+
+    def test_employee_order_uses_index(self):
+        employee = User.objects.create(username='test', password='1234', role='employee')
+        queryset = Order.objects.filter(employee=employee, created_at=self.date)
+        # Lookup by the unique key used by the order view
+        self.assertIn('USING INDEX', queryset.explain())
+
 
 """All Form tests"""
 
@@ -283,6 +361,7 @@ class SeeOrdersViewTest(TestCase):
         self.assertEqual(response.status_code, HTTPStatus.FOUND)
 
 
+@override_settings(ALLOWED_HOUR_TO_ORDER=24)
 class OrderViewTest(TestCase):
 
     def setUp(self):
@@ -342,3 +421,1480 @@ class OrderViewTest(TestCase):
         self.client.logout()
         response = self.client.post(f"/menu/{self.menu.uuid}", data=data)
         self.assertEqual(response.status_code, HTTPStatus.FOUND)
+
+    def test_post_order_view(self):
+        data = {'options': self.dish1.id, 'customizations': 'No tomatoes'}
+        response = self.client.post(f"/menu/{self.menu.uuid}", data=data)
+        self.assertContains(response, "You have ordered Corn pie, Salad and Dessert! | No tomatoes", html=True)
+        data = {'options': self.dish2.id, 'customizations': ''}
+        response = self.client.post(f"/menu/{self.menu.uuid}", data=data)
+        self.assertContains(response, "You order has been updated to: Premium chicken Salad and Dessert", html=True)
+        self.assertEqual(Order.objects.get(employee=self.user).dish, self.dish2)
+
+    @override_settings(ALLOWED_HOUR_TO_ORDER=0)
+    def test_too_late_order_view(self):
+        response = self.client.get(f"/menu/{self.menu.uuid}")
+        self.assertContains(response, "Too late to order")
+        # Forms opened before the allowed hour can not be submitted after it
+        data = {'options': self.dish1.id, 'customizations': ''}
+        response = self.client.post(f"/menu/{self.menu.uuid}", data=data)
+        self.assertContains(response, "Too late to order")
+        self.assertFalse(Order.objects.exists())
+
+
+class ProfilerViewTest(TestCase):
+
+    def setUp(self):
+        self.profile_dir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.profile_dir)
+        self.settings_override = override_settings(PROFILER_DIR=self.profile_dir, PROFILER_MAX_FILES=2)
+        self.settings_override.enable()
+        self.addCleanup(self.settings_override.disable)
+
+        self.user = User.objects.create(username='testuser', password="1234", role="admin", first_name="Name")
+        self.user.set_password('1234')
+        self.user.save()
+        self.client.login(username='testuser', password='1234')
+
+    def test_admin_profile_request(self):
+        response = self.client.get("/?profile=1")
+        self.assertEqual(response.status_code, HTTPStatus.OK)
+        # The profile name is returned so the admin can find it
+        self.assertIn(response['X-Profile'], os.listdir(self.profile_dir))
+
+        response = self.client.get("/see_orders", HTTP_X_PROFILE='1')
+        self.assertEqual(len(os.listdir(self.profile_dir)), 2)
+
+    async def test_asgi_profile_has_the_view(self):
+        client = AsyncClient()
+        client.cookies = self.client.cookies
+        # A slow template, so the view is sampled
+        with mock.patch('cafeteria.views.render', side_effect=lambda *args, **kwargs: time.sleep(0.05) or HttpResponse()):
+            response = await client.get("/see_orders?profile=1")
+        with open(os.path.join(self.profile_dir, response['X-Profile'])) as file:
+            self.assertIn('see_orders (views.py:', file.read())
+
+    def test_profiles_ring_is_bounded(self):
+        for _ in range(3):
+            self.client.get("/?profile=1")
+        # Only the newest PROFILER_MAX_FILES are kept
+        self.assertEqual(len(os.listdir(self.profile_dir)), 2)
+
+    def test_not_profiled_request(self):
+        self.client.get("/")
+        self.assertEqual(os.listdir(self.profile_dir), [])
+
+        # Employees can not trigger the profiler
+        self.user.role = 'employee'
+        self.user.save()
+        response = self.client.get("/?profile=1")
+        self.assertFalse(response.has_header('X-Profile'))
+        self.assertEqual(os.listdir(self.profile_dir), [])
+
+    def test_see_profiles_view(self):
+        name = self.client.get("/?profile=1")['X-Profile']
+        response = self.client.get("/profiles")
+        self.assertEqual(response.status_code, HTTPStatus.OK)
+        self.assertContains(response, name)
+
+        response = self.client.get(f"/profiles/{name}")
+        self.assertEqual(response.status_code, HTTPStatus.OK)
+        response = self.client.get("/profiles/..%2Fsettings.py")
+        self.assertEqual(response.status_code, HTTPStatus.NOT_FOUND)
+
+
+@override_settings(ALLOWED_HOUR_TO_ORDER=24, METRICS_TOKENS=['prometheus'])
+class MetricsViewTest(TestCase):
+
+    def setUp(self):
+        self.metrics_dir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.metrics_dir)
+        self.settings_override = override_settings(METRICS_DIR=self.metrics_dir)
+        self.settings_override.enable()
+        self.addCleanup(self.settings_override.disable)
+        metrics.registry.counters.clear()
+        metrics.registry.histograms.clear()
+
+        self.user = User.objects.create(username='testuser', password="1234", role="employee", first_name="Name")
+        self.user.set_password('1234')
+        self.user.save()
+        self.dish = Dish.objects.create(name="Corn pie, Salad and Dessert")
+        self.menu = Menu.objects.create(detail="Today's menu", date=localtime(now()).date())
+        self.menu.dishes.set([self.dish])
+        self.client.login(username='testuser', password='1234')
+
+    def test_get_metrics_view(self):
+        self.client.get("/")
+        self.client.post(f"/menu/{self.menu.uuid}", data={'options': self.dish.id})
+        self.client.post(f"/menu/{self.menu.uuid}", data={'options': self.dish.id})
+        with override_settings(ALLOWED_HOUR_TO_ORDER=0):
+            self.client.post(f"/menu/{self.menu.uuid}", data={'options': self.dish.id})
+
+        response = self.client.get("/metrics", HTTP_AUTHORIZATION='Bearer prometheus')
+        self.assertEqual(response.status_code, HTTPStatus.OK)
+        content = response.content.decode()
+        self.assertIn('# TYPE cafeteria_request_duration_seconds histogram', content)
+        self.assertIn('cafeteria_request_duration_seconds_count{view="home"} 1', content)
+        self.assertIn('cafeteria_request_duration_seconds_bucket{view="menu",le="+Inf"} 3', content)
+        self.assertIn('cafeteria_requests_total{status="200",view="menu"} 3.0', content)
+        self.assertIn('cafeteria_orders_placed_total 1.0', content)
+        self.assertIn('cafeteria_orders_updated_total 1.0', content)
+        self.assertIn('cafeteria_order_rejections_total{reason="cutoff"} 1.0', content)
+        self.assertIn('cafeteria_db_queries_total{view="menu"}', content)
+
+    def test_metrics_from_other_workers(self):
+        # Another worker already wrote its values
+        with open(os.path.join(self.metrics_dir, '1.json'), 'w') as file:
+            json.dump({'counters': [['cafeteria_orders_placed_total', {}, 2]], 'histograms': []}, file)
+        metrics.inc('cafeteria_orders_placed_total')
+        response = self.client.get("/metrics", HTTP_AUTHORIZATION='Bearer prometheus')
+        self.assertContains(response, 'cafeteria_orders_placed_total 3.0')
+
+    def test_dead_workers_are_archived(self):
+        # No process has this pid, the worker exited
+        for name in ('99999999.json', '99999998.json'):
+            with open(os.path.join(self.metrics_dir, name), 'w') as file:
+                json.dump({'counters': [['cafeteria_orders_placed_total', {}, 2]], 'histograms': []}, file)
+        for _ in range(2):
+            response = self.client.get("/metrics", HTTP_AUTHORIZATION='Bearer prometheus')
+            self.assertContains(response, 'cafeteria_orders_placed_total 4.0')
+        self.assertEqual(sorted(name for name in os.listdir(self.metrics_dir) if name.endswith('.json')),
+                         sorted(['archive.json', f'{os.getpid()}.json']))
+
+    def test_metrics_outside_requests(self):
+        # A command that exits before any flush, like deliver_notifications
+        script = (
+            'import django; django.setup(); from django.conf import settings; '
+            f'settings.METRICS_DIR = {self.metrics_dir!r}; from cafeteria import metrics; '
+            'metrics.inc("cafeteria_employee_notifications_total", 2, result="sent")'
+        )
+        subprocess.run([sys.executable, '-c', script], cwd=os.path.dirname(os.path.dirname(__file__)), check=True,
+                       env={**os.environ, 'DJANGO_SETTINGS_MODULE': 'settings.settings'})
+        response = self.client.get("/metrics", HTTP_AUTHORIZATION='Bearer prometheus')
+        self.assertContains(response, 'cafeteria_employee_notifications_total{result="sent"} 2')
+
+    def test_metrics_access(self):
+        # Employees and wrong tokens can not read them
+        self.assertEqual(self.client.get("/metrics").status_code, HTTPStatus.FORBIDDEN)
+        response = self.client.get("/metrics", HTTP_AUTHORIZATION='Bearer wrong')
+        self.assertEqual(response.status_code, HTTPStatus.FORBIDDEN)
+        admin = User.objects.create(username='nora', role="admin")
+        self.client.force_login(admin)
+        self.assertEqual(self.client.get("/metrics").status_code, HTTPStatus.OK)
+
+    def test_slack_notification_metrics(self):
+        async def post_message(**kwargs):
+            raise SlackApiError('invalid_auth', {'ok': False})
+
+        with mock.patch('cafeteria.slackapi.WebClient') as client:
+            client.return_value.chat_postMessage.side_effect = post_message
+            with self.assertRaises(SlackApiError):
+                send_async_notification('Menu')
+        self.assertEqual(
+            metrics.registry.counters[('cafeteria_menu_notifications_total', (('result', 'failed'),))], 1)
+
+
+class LoggingTest(TestCase):
+
+    def create_logger(self, rates=None, queue_size=100):
+        stream = io.StringIO()
+        handler = QueueLogHandler(stream=stream, queue_size=queue_size)
+        handler.addFilter(SamplingFilter(rates))
+        handler.addFilter(RequestIdFilter())
+        logger = logging.getLogger('cafeteria.tests.logging')
+        logger.propagate = False
+        logger.addHandler(handler)
+        self.addCleanup(logger.removeHandler, handler)
+        self.addCleanup(handler.close)
+        return logger, handler, stream
+
+    def test_json_records(self):
+        logger, handler, stream = self.create_logger()
+        token = request_id.set('abc')
+        logger.error('Error: %s', 'foo')
+        request_id.reset(token)
+        # Writes the records left in the queue
+        handler.stop()
+        record = json.loads(stream.getvalue())
+        self.assertEqual(record['message'], 'Error: foo')
+        self.assertEqual(record['level'], 'ERROR')
+        self.assertEqual(record['request_id'], 'abc')
+
+    def test_sampled_records(self):
+        logger, handler, stream = self.create_logger(rates={'Menu uuid: %s': 0})
+        logger.info('Menu uuid: %s', 'foo')
+        logger.info('User authenticated')
+        # Errors are never sampled
+        logger.error('Menu uuid: %s', 'bar')
+        handler.stop()
+        messages = [json.loads(line)['message'] for line in stream.getvalue().splitlines()]
+        self.assertEqual(messages, ['User authenticated', 'Menu uuid: bar'])
+
+    def test_full_queue_does_not_block(self):
+        logger, handler, stream = self.create_logger(queue_size=1)
+        # The listener can not write while the stream is locked, so the queue fills up
+        logger.info('User authenticated')
+        listener_handler = handler.target
+        listener_handler.acquire()
+        try:
+            for _ in range(10):
+                logger.info('User authenticated')
+        finally:
+            listener_handler.release()
+        self.assertGreater(handler.dropped, 0)
+
+    def test_request_id_header(self):
+        response = self.client.get("/", HTTP_X_REQUEST_ID='abc')
+        self.assertEqual(response['X-Request-ID'], 'abc')
+        self.assertTrue(self.client.get("/")['X-Request-ID'])
+
+    def test_django_request_records_have_request_id(self):
+        records = []
+        handler = logging.Handler()
+        handler.emit = records.append
+        handler.addFilter(RequestIdFilter())
+        logger = logging.getLogger('django.request')
+        logger.addHandler(handler)
+        self.addCleanup(logger.removeHandler, handler)
+
+        self.client.get("/metrics", HTTP_X_REQUEST_ID='abc')
+        self.assertEqual([record.request_id for record in records], ['abc'])
+        # It is cleared once the response is closed
+        self.assertIsNone(request_id.get())
+
+    def test_listener_after_fork(self):
+        path = os.path.join(tempfile.mkdtemp(), 'log')
+        self.addCleanup(shutil.rmtree, os.path.dirname(path))
+        with open(path, 'w') as stream:
+            handler = QueueLogHandler(stream=stream)
+            self.addCleanup(handler.close)
+            logger = logging.getLogger('cafeteria.tests.fork')
+            logger.propagate = False
+            logger.addHandler(handler)
+            self.addCleanup(logger.removeHandler, handler)
+            logger.error('From the parent')
+            while not os.path.getsize(path):
+                time.sleep(0.01)
+
+            pid = os.fork()
+            if pid == 0:
+                # The worker gets its own listener
+                logger.error('From the worker')
+                handler.stop()
+                os._exit(0)
+            os.waitpid(pid, 0)
+            handler.stop()
+        with open(path) as file:
+            messages = sorted(json.loads(line)['message'] for line in file)
+        self.assertEqual(messages, ['From the parent', 'From the worker'])
+
+
+class StaticFilesTest(TestCase):
+
+    @classmethod
+    def setUpClass(cls):
+        # collectstatic runs once for all the tests
+        cls.static_root = tempfile.mkdtemp()
+        cls.settings_override = override_settings(STATIC_ROOT=cls.static_root)
+        cls.settings_override.enable()
+        call_command('collectstatic', interactive=False, verbosity=0)
+        cls.css = staticfiles_storage.stored_name('css/bootstrap.min.css')
+        super().setUpClass()
+
+    @classmethod
+    def tearDownClass(cls):
+        super().tearDownClass()
+        cls.settings_override.disable()
+        shutil.rmtree(cls.static_root)
+
+    def test_hashed_and_compressed_files(self):
+        self.assertRegex(self.css, r'^css/bootstrap\.min\.[0-9a-f]{12}\.css$')
+        self.assertTrue(staticfiles_storage.exists(f'{self.css}.gz'))
+        with staticfiles_storage.open(f'{self.css}.gz') as file:
+            compressed = file.read()
+        with staticfiles_storage.open(self.css) as file:
+            self.assertEqual(gzip.decompress(compressed), file.read())
+
+    def test_resized_images(self):
+        srcset = static_srcset('images/home_img.jpg', 'webp')
+        self.assertIn('480w', srcset)
+        self.assertIn('.webp', srcset)
+        response = self.client.get("/")
+        self.assertContains(response, 'type="image/webp"')
+
+    def test_serve_static_files(self):
+        response = self.client.get(f"/static/{self.css}", HTTP_ACCEPT_ENCODING='gzip, deflate')
+        self.assertEqual(response.status_code, HTTPStatus.OK)
+        self.assertEqual(response['Content-Encoding'], 'gzip')
+        self.assertEqual(response['Content-Type'], 'text/css')
+        self.assertEqual(response['Vary'], 'Accept-Encoding')
+        # Hashed names change with the content so browsers never revalidate them
+        self.assertEqual(response['Cache-Control'], IMMUTABLE_CACHE_CONTROL)
+
+        response = self.client.get("/static/css/bootstrap.min.css")
+        self.assertFalse(response.has_header('Content-Encoding'))
+        self.assertEqual(response['Cache-Control'], 'public, max-age=3600')
+
+
+@override_settings(ALLOWED_HOUR_TO_ORDER=24)
+class CapacityTest(TestCase):
+
+    def setUp(self):
+        self.dish1 = Dish.objects.create(name="Corn pie, Salad and Dessert")
+        self.dish2 = Dish.objects.create(name="Premium chicken Salad and Dessert")
+        self.menu = Menu.objects.create(detail="Today's menu", date=localtime(now()).date())
+        self.menu.dishes.set([self.dish1, self.dish2])
+        MenuDish.set_capacity(self.menu, self.dish1, 1)
+        self.users = [User.objects.create(username=f'test{i}', password='1234', role='employee') for i in range(2)]
+
+    def order(self, user, dish):
+        self.client.force_login(user)
+        return self.client.post(f"/menu/{self.menu.uuid}", data={'options': dish.id})
+
+    def remaining(self, dish):
+        return MenuDish.objects.get(menu=self.menu, dish=dish).remaining
+
+    def test_sold_out_dish(self):
+        self.order(self.users[0], self.dish1)
+        self.assertEqual(self.remaining(self.dish1), 0)
+        response = self.order(self.users[1], self.dish1)
+        self.assertContains(response, "Sorry, Corn pie, Salad and Dessert is sold out, please choose another dish")
+        self.assertFalse(Order.objects.filter(employee=self.users[1]).exists())
+        # Dishes without capacity are never sold out
+        self.assertContains(self.order(self.users[1], self.dish2), "You have ordered")
+        self.assertIsNone(self.remaining(self.dish2))
+
+    def test_changed_order_releases_dish(self):
+        self.order(self.users[0], self.dish1)
+        # Saving the same dish again does not need another portion
+        response = self.order(self.users[0], self.dish1)
+        self.assertContains(response, "You order has been updated to: Corn pie, Salad and Dessert")
+        self.order(self.users[0], self.dish2)
+        self.assertEqual(self.remaining(self.dish1), 1)
+        self.assertContains(self.order(self.users[1], self.dish1), "You have ordered")
+        self.assertContains(self.client.get(f"/menu/{self.menu.uuid}"), "Sold out")
+
+    def test_dish_not_in_menu(self):
+        dish = Dish.objects.create(name="Soup")
+        response = self.order(self.users[0], dish)
+        self.assertContains(response, "Please choose a dish of the menu!")
+
+    def test_menu_form_capacity(self):
+        self.order(self.users[0], self.dish1)
+        admin = User.objects.create(username='admin', password='1234', role='admin')
+        self.client.force_login(admin)
+        data = {
+            'date': self.menu.date,
+            'detail': self.menu.detail,
+            'dishes': [self.dish1.id, self.dish2.id],
+            f'capacity_{self.dish1.id}': 5,
+            f'capacity_{self.dish2.id}': '',
+        }
+        self.client.post(f"/menu_form/{self.menu.uuid}", data=data)
+        # The orders already placed are not available anymore
+        self.assertEqual(self.remaining(self.dish1), 4)
+        self.assertIsNone(self.remaining(self.dish2))
+        self.client.force_login(self.users[1])
+        self.assertContains(self.client.get(f"/menu/{self.menu.uuid}"), "4 left")
+
+
+@override_settings(ALLOWED_HOUR_TO_ORDER=24)
+class CapacityConcurrencyTest(TransactionTestCase):
+
+    def post(self, client, dish):
+        try:
+            response = client.post(f"/menu/{self.menu.uuid}", data={'options': dish.id})
+            return response.status_code, response.content.decode()
+        finally:
+            connection.close()
+
+    def test_parallel_orders(self):
+        capacity = 50
+        dish = Dish.objects.create(name="Corn pie")
+        other_dish = Dish.objects.create(name="Chicken salad")
+        self.menu = Menu.objects.create(detail="Today's menu", date=localtime(now()).date())
+        self.menu.dishes.set([dish, other_dish])
+        MenuDish.set_capacity(self.menu, dish, capacity)
+        MenuDish.set_capacity(self.menu, other_dish, 100)
+        User.objects.bulk_create([User(username=f'test{i}', password='1234', role='employee') for i in range(300)])
+
+        # Sessions are created before, so the threads only submit orders
+        clients = []
+        for user in User.objects.all():
+            client = Client()
+            client.force_login(user)
+            clients.append(client)
+
+        with ThreadPoolExecutor(max_workers=30) as executor:
+            responses = list(executor.map(lambda client: self.post(client, dish), clients))
+        self.assertEqual([status for status, _ in responses], [200] * len(clients))
+        ordered = [client for client, (_, content) in zip(clients, responses) if 'You have ordered Corn pie!' in content]
+        sold_out = [client for client, (_, content) in zip(clients, responses) if 'Corn pie is sold out' in content]
+        self.assertEqual(len(ordered), min(len(clients), capacity))
+        self.assertEqual(len(sold_out), len(clients) - capacity)
+        self.assertEqual(MenuDish.objects.get(menu=self.menu, dish=dish).remaining, 0)
+
+        # Employees swap dishes the opposite way at the same time
+        for client in sold_out[:25]:
+            self.post(client, other_dish)
+        jobs = [(client, other_dish) for client in ordered[:25]] + [(client, dish) for client in sold_out[:25]]
+        with ThreadPoolExecutor(max_workers=30) as executor:
+            responses = list(executor.map(lambda job: self.post(*job), jobs))
+        self.assertEqual([status for status, _ in responses], [200] * len(jobs))
+        # There is always room in the other dish, the corn pie only gets the portions given back
+        self.assertTrue(all('updated to: Chicken salad' in content for _, content in responses[:25]))
+        self.assertTrue(all('updated to: Corn pie' in content or 'Corn pie is sold out' in content
+                            for _, content in responses[25:]))
+
+        # Every portion is either ordered or still available
+        for menu_dish in MenuDish.objects.filter(menu=self.menu):
+            self.assertEqual(Order.objects.filter(dish=menu_dish.dish).count() + menu_dish.remaining,
+                             menu_dish.capacity)
+
+
+@override_settings(ALLOWED_HOUR_TO_ORDER=24)
+class WeekOrderViewTest(TestCase):
+
+    def setUp(self):
+        self.user = User.objects.create(username='testuser', password="1234", role="employee", first_name="Employee")
+        self.dish1 = Dish.objects.create(name="Corn pie, Salad and Dessert")
+        self.dish2 = Dish.objects.create(name="Premium chicken Salad and Dessert")
+        today = localtime(now()).date()
+        self.menus = []
+        for days in (0, 1, 2, 8):
+            menu = Menu.objects.create(detail="Menu", date=today + timedelta(days=days))
+            menu.dishes.set([self.dish1, self.dish2])
+            self.menus.append(menu)
+        self.client.force_login(self.user)
+
+    def test_get_week_order_view(self):
+        response = self.client.get("/week")
+        self.assertEqual(response.status_code, HTTPStatus.OK)
+        self.assertContains(response, "Hello Employee, order for the week", html=True)
+        # Only the menus of the next 7 days are shown
+        for menu in self.menus[:3]:
+            self.assertContains(response, f'name="dish_{menu.uuid}"')
+        self.assertNotContains(response, f'name="dish_{self.menus[3].uuid}"')
+
+    def test_order_placed_while_saving_the_week(self):
+        # A single day order commits after the week read the orders
+        Order.objects.create(dish=self.dish1, employee=self.user, created_at=self.menus[1].date)
+        MenuDish.objects.filter(menu=self.menus[1], dish=self.dish1).update(capacity=5, remaining=4)
+        select_for_update = Order.objects.select_for_update
+        with mock.patch.object(Order.objects, 'select_for_update',
+                               side_effect=[Order.objects.none(), select_for_update()]):
+            response = self.client.post("/week", data={
+                f'dish_{self.menus[0].uuid}': self.dish1.id,
+                f'dish_{self.menus[1].uuid}': self.dish2.id,
+            })
+        self.assertContains(response, "Your orders for 2 days have been saved!")
+        orders = Order.objects.filter(employee=self.user).order_by('created_at')
+        self.assertEqual([order.dish for order in orders], [self.dish1, self.dish2])
+        # The portion of the replaced order was given back once
+        self.assertEqual(MenuDish.objects.get(menu=self.menus[1], dish=self.dish1).remaining, 5)
+
+    def test_post_week_order_view(self):
+        data = {
+            f'dish_{self.menus[0].uuid}': self.dish1.id,
+            f'dish_{self.menus[1].uuid}': self.dish2.id,
+            f'customizations_{self.menus[1].uuid}': 'No tomatoes',
+        }
+        response = self.client.post("/week", data=data)
+        self.assertContains(response, "Your orders for 2 days have been saved!")
+        orders = Order.objects.filter(employee=self.user).order_by('created_at')
+        self.assertEqual([order.created_at for order in orders], [self.menus[0].date, self.menus[1].date])
+        self.assertEqual(orders[1].customizations, 'No tomatoes')
+
+        # The same days are updated, and new ones created
+        data = {
+            f'dish_{self.menus[1].uuid}': self.dish1.id,
+            f'dish_{self.menus[2].uuid}': self.dish1.id,
+        }
+        self.client.post("/week", data=data)
+        self.assertEqual(Order.objects.filter(employee=self.user).count(), 3)
+        self.assertEqual(Order.objects.get(employee=self.user, created_at=self.menus[1].date).dish, self.dish1)
+
+    def test_error_post_week_order_view(self):
+        dish = Dish.objects.create(name="Soup")
+        MenuDish.set_capacity(self.menus[2], self.dish1, 0)
+        data = {
+            f'dish_{self.menus[0].uuid}': self.dish1.id,
+            f'dish_{self.menus[1].uuid}': dish.id,
+            f'dish_{self.menus[2].uuid}': self.dish1.id,
+        }
+        response = self.client.post("/week", data=data)
+        self.assertContains(response, f"{self.menus[1].date}: Please choose a dish of the menu!")
+        self.assertContains(response, f"{self.menus[2].date}: The dish is sold out, please choose another dish")
+        self.assertEqual(Order.objects.filter(employee=self.user).count(), 1)
+
+        response = self.client.post("/week", data={})
+        self.assertContains(response, "Please choose a dish!")
+
+    @override_settings(ALLOWED_HOUR_TO_ORDER=0)
+    def test_too_late_week_order_view(self):
+        data = {
+            f'dish_{self.menus[0].uuid}': self.dish1.id,
+            f'dish_{self.menus[1].uuid}': self.dish1.id,
+        }
+        self.client.post("/week", data=data)
+        # Today can not be ordered anymore, but the next days can
+        self.assertEqual(list(Order.objects.values_list('created_at', flat=True)), [self.menus[1].date])
+
+
+class DishPhotoTest(TransactionTestCase):
+
+    def setUp(self):
+        self.media_root = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.media_root)
+        self.settings_override = override_settings(MEDIA_ROOT=self.media_root, ALLOWED_HOUR_TO_ORDER=24)
+        self.settings_override.enable()
+        self.addCleanup(self.settings_override.disable)
+
+        self.user = User.objects.create(username='testuser', password="1234", role="admin", first_name="Name")
+        self.client.force_login(self.user)
+
+    def create_photo(self, name='dish.jpg'):
+        output = io.BytesIO()
+        Image.new('RGB', (1000, 600), 'red').save(output, 'JPEG')
+        return SimpleUploadedFile(name, output.getvalue(), content_type='image/jpeg')
+
+    def test_post_dish_photo(self):
+        response = self.client.post("/dish_form", data={'name': 'foo', 'photo': self.create_photo()})
+        self.assertContains(response, "Dish foo was added!")
+        # The variants are created in the background after the dish is saved
+        thumbnails.wait_pending()
+        dish = Dish.objects.get(name='foo')
+        self.assertEqual(set(dish.photo_variants), {'webp', 'jpg'})
+        self.assertEqual(set(dish.photo_variants['webp']), {'160', '320', '640'})
+        name = dish.photo_variants['webp']['160']
+        self.assertTrue(dish.photo.storage.exists(name))
+        with Image.open(dish.photo.storage.path(name)) as image:
+            self.assertEqual((image.format, image.width), ('WEBP', 160))
+
+        menu = Menu.objects.create(detail="Today's menu", date=localtime(now()).date())
+        menu.dishes.set([dish])
+        response = self.client.get(f"/menu/{menu.uuid}")
+        self.assertContains(response, f'/media/{name} 160w')
+
+    def test_replaced_dish_photo(self):
+        self.client.post("/dish_form", data={'name': 'foo', 'photo': self.create_photo()})
+        thumbnails.wait_pending()
+        dish = Dish.objects.get(name='foo')
+        old_variant = dish.photo_variants['jpg']['320']
+        old_photo = dish.photo.name
+
+        self.client.post(f"/dish_form/{dish.id}", data={'name': 'foo', 'photo': self.create_photo('new.jpg')})
+        thumbnails.wait_pending()
+        dish.refresh_from_db()
+        self.assertTrue(dish.photo_variants['jpg']['320'].startswith('dishes/new'))
+        # The previous photo and its copies are deleted
+        self.assertFalse(dish.photo.storage.exists(old_variant))
+        self.assertFalse(dish.photo.storage.exists(old_photo))
+        self.assertTrue(dish.photo.storage.exists(dish.photo.name))
+
+    def test_cleared_and_deleted_dish_photo(self):
+        self.client.post("/dish_form", data={'name': 'foo', 'photo': self.create_photo()})
+        thumbnails.wait_pending()
+        dish = Dish.objects.get(name='foo')
+        variant = dish.photo_variants['jpg']['320']
+
+        self.client.post(f"/dish_form/{dish.id}", data={'name': 'foo', 'photo-clear': 'on'})
+        thumbnails.wait_pending()
+        dish.refresh_from_db()
+        self.assertEqual(dish.photo_variants, {})
+        self.assertFalse(dish.photo.storage.exists(variant))
+
+        self.client.post(f"/dish_form/{dish.id}", data={'name': 'foo', 'photo': self.create_photo()})
+        thumbnails.wait_pending()
+        dish.refresh_from_db()
+        variant = dish.photo_variants['webp']['160']
+        dish.delete()
+        self.assertFalse(dish.photo.storage.exists(variant))
+        self.assertFalse(dish.photo.storage.exists(dish.photo.name))
+
+    def test_missing_photo_variants(self):
+        # The worker stopped before creating the copies of the first dish
+        dish = Dish.objects.create(name='foo')
+        dish.photo.save('dish.jpg', self.create_photo())
+        self.client.post("/dish_form", data={'name': 'bar', 'photo': self.create_photo()})
+        thumbnails.wait_pending()
+        self.assertFalse(thumbnails.has_current_variants(dish))
+
+        out = io.StringIO()
+        call_command('create_photo_variants', stdout=out)
+        self.assertEqual(out.getvalue(), "1 dish photos updated\n")
+        dish.refresh_from_db()
+        self.assertTrue(thumbnails.has_current_variants(dish))
+        self.assertTrue(dish.photo.storage.exists(dish.photo_variants['jpg']['640']))
+
+        # A copy removed from the storage is created again
+        dish.photo.storage.delete(dish.photo_variants['jpg']['640'])
+        call_command('create_photo_variants', stdout=out)
+        dish.refresh_from_db()
+        self.assertTrue(thumbnails.has_current_variants(dish))
+
+
+@override_settings(ALLOWED_HOUR_TO_ORDER=24, RATELIMITS={
+    'order': {'ip': (50, 500), 'user': (0.01, 2)},
+    'login': {'ip': (0.01, 4), 'user': (0.01, 2)},
+})
+class RateLimitTest(TestCase):
+
+    def setUp(self):
+        self.user = User.objects.create(username='testuser', role="employee", first_name="Employee")
+        self.user.set_password('1234')
+        self.user.save()
+        self.dish = Dish.objects.create(name="Corn pie, Salad and Dessert")
+        self.menu = Menu.objects.create(detail="Today's menu", date=localtime(now()).date())
+        self.menu.dishes.set([self.dish])
+
+    def test_order_rate_limit(self):
+        self.client.force_login(self.user)
+        data = {'options': self.dish.id, 'customizations': ''}
+        for _ in range(2):
+            response = self.client.post(f"/menu/{self.menu.uuid}", data=data)
+            self.assertEqual(response.status_code, HTTPStatus.OK)
+        # Double clicks over the burst are rejected before the view runs
+        response = self.client.post(f"/menu/{self.menu.uuid}", data=data)
+        self.assertEqual(response.status_code, HTTPStatus.TOO_MANY_REQUESTS)
+        self.assertGreater(int(response['Retry-After']), 0)
+        # Reading the menu is not limited
+        response = self.client.get(f"/menu/{self.menu.uuid}")
+        self.assertEqual(response.status_code, HTTPStatus.OK)
+
+    def test_login_rate_limit(self):
+        data = {'username': 'testuser', 'password': 'wrong'}
+        for _ in range(2):
+            response = self.client.post("/accounts/login/", data=data)
+            self.assertEqual(response.status_code, HTTPStatus.OK)
+        # Limited by the username, even with the right password
+        response = self.client.post("/accounts/login/", data={'username': 'TestUser', 'password': '1234'})
+        self.assertEqual(response.status_code, HTTPStatus.TOO_MANY_REQUESTS)
+        # And by IP for any other username, the rejected post did not take a token of the IP
+        for username in ('other', 'another'):
+            response = self.client.post("/accounts/login/", data={'username': username, 'password': '1234'})
+            self.assertEqual(response.status_code, HTTPStatus.OK)
+        response = self.client.post("/accounts/login/", data={'username': 'third', 'password': '1234'})
+        self.assertEqual(response.status_code, HTTPStatus.TOO_MANY_REQUESTS)
+
+
+@override_settings(ALLOWED_HOUR_TO_ORDER=24, RATELIMITS={'order': {'ip': (50, 500), 'user': (0.01, 2)}})
+class RateLimitConcurrencyTest(TransactionTestCase):
+
+    def test_parallel_tokens(self):
+        barrier = threading.Barrier(20)
+
+        def take(_):
+            barrier.wait()
+            try:
+                return take_token('ratelimit:test', 0.01, 2)
+            finally:
+                connection.close()
+
+        with ThreadPoolExecutor(max_workers=20) as executor:
+            waits = list(executor.map(take, range(20)))
+        self.assertEqual(waits.count(0), 2)
+
+        # Full buckets are removed, the one in use is kept
+        RateLimitBucket.objects.create(key='ratelimit:full', full_at=time.time() - 1)
+        call_command('clear_expired_keys', stdout=io.StringIO())
+        self.assertEqual(list(RateLimitBucket.objects.values_list('key', flat=True)), ['ratelimit:test'])
+
+    def test_parallel_double_clicks(self):
+        user = User.objects.create(username='testuser', role="employee")
+        dish = Dish.objects.create(name="Corn pie")
+        menu = Menu.objects.create(detail="Today's menu", date=localtime(now()).date())
+        menu.dishes.set([dish])
+        clients = []
+        for _ in range(20):
+            client = Client()
+            client.force_login(user)
+            clients.append(client)
+        barrier = threading.Barrier(20)
+
+        def post(client):
+            barrier.wait()
+            try:
+                return client.post(f"/menu/{menu.uuid}", data={'options': dish.id}).status_code
+            finally:
+                connection.close()
+
+        with ThreadPoolExecutor(max_workers=20) as executor:
+            statuses = list(executor.map(post, clients))
+        self.assertEqual(statuses.count(HTTPStatus.OK), 2)
+        self.assertEqual(statuses.count(HTTPStatus.TOO_MANY_REQUESTS), 18)
+        self.assertEqual(Order.objects.filter(employee=user).count(), 1)
+
+
+@override_settings(ADMISSION_MAX_CONCURRENT_REQUESTS=2, ADMISSION_MAX_QUEUE_TIME=10, ADMISSION_RETRY_AFTER=1)
+class AdmissionControlTest(TestCase):
+    # Unit tests of the middleware with a stub view, AdmissionControlOrderTest posts real orders
+    duration = 0.2
+
+    def slow_view(self, request):
+        time.sleep(self.duration)
+        return HttpResponse('ok')
+
+    def test_overload(self):
+        middleware = AdmissionControlMiddleware(self.slow_view)
+        factory = RequestFactory()
+        barrier = threading.Barrier(20)
+
+        def request(_):
+            barrier.wait()
+            start = time.perf_counter()
+            response = middleware(factory.get('/'))
+            return response.status_code, response.get('Retry-After'), time.perf_counter() - start
+
+        with ThreadPoolExecutor(max_workers=20) as executor:
+            results = list(executor.map(request, range(20)))
+
+        statuses = [status for status, _, _ in results]
+        self.assertEqual(statuses.count(HTTPStatus.OK), 2)
+        self.assertEqual(statuses.count(HTTPStatus.SERVICE_UNAVAILABLE), 18)
+        self.assertTrue(all(retry_after == '1' for status, retry_after, _ in results if status != HTTPStatus.OK))
+        # Nothing waits in line: the slowest request takes about one request, not ten
+        latencies = sorted(latency for _, _, latency in results)
+        self.assertLess(latencies[-1], self.duration * 3)
+        rejected = [latency for status, _, latency in results if status != HTTPStatus.OK]
+        self.assertLess(max(rejected), self.duration / 2)
+
+    def test_static_files_are_exempt(self):
+        middleware = AdmissionControlMiddleware(self.slow_view)
+        middleware.slots.acquire()
+        middleware.slots.acquire()
+        self.assertEqual(middleware(RequestFactory().get('/')).status_code, HTTPStatus.SERVICE_UNAVAILABLE)
+        self.assertEqual(middleware(RequestFactory().get('/static/css/bootstrap.min.css')).status_code, HTTPStatus.OK)
+        self.assertEqual(middleware(RequestFactory().get('/media/dishes/dish.jpg')).status_code, HTTPStatus.OK)
+
+    def test_queue_timeout(self):
+        middleware = AdmissionControlMiddleware(self.slow_view)
+        request = RequestFactory().get('/', HTTP_X_REQUEST_START=f't={int((time.time() - 30) * 1000)}')
+        response = middleware(request)
+        self.assertEqual(response.status_code, HTTPStatus.SERVICE_UNAVAILABLE)
+        request = RequestFactory().get('/', HTTP_X_REQUEST_START=f't={int(time.time() * 1000)}')
+        self.assertEqual(middleware(request).status_code, HTTPStatus.OK)
+
+
+@override_settings(ALLOWED_HOUR_TO_ORDER=24, ADMISSION_MAX_CONCURRENT_REQUESTS=4, ADMISSION_MAX_QUEUE_TIME=10)
+class AdmissionControlOrderTest(TransactionTestCase):
+
+    def test_lunch_rush(self):
+        dish = Dish.objects.create(name="Corn pie")
+        menu = Menu.objects.create(detail="Today's menu", date=localtime(now()).date())
+        menu.dishes.set([dish])
+        employees = [User.objects.create(username=f'employee{i}', role='employee') for i in range(20)]
+        # One worker process answering the order page
+        middleware = AdmissionControlMiddleware(lambda request: views.order_uuid(request, str(menu.uuid)))
+        reserve = MenuDish.reserve
+        barrier = threading.Barrier(20)
+
+        def slow_reserve(*args, **kwargs):
+            # A busy database, so the orders overlap
+            time.sleep(0.05)
+            return reserve(*args, **kwargs)
+
+        def post(employee):
+            request = RequestFactory().post(f"/menu/{menu.uuid}", data={'options': dish.id})
+            request.user = employee
+            barrier.wait()
+            try:
+                return middleware(request).status_code
+            finally:
+                connection.close()
+
+        with mock.patch.object(MenuDish, 'reserve', side_effect=slow_reserve), \
+                ThreadPoolExecutor(max_workers=20) as executor:
+            statuses = list(executor.map(post, employees))
+        self.assertEqual(sorted(set(statuses)), [HTTPStatus.OK, HTTPStatus.SERVICE_UNAVAILABLE])
+        self.assertGreaterEqual(statuses.count(HTTPStatus.OK), 4)
+        # Every admitted order was saved, the rejected ones did not touch the database
+        self.assertEqual(Order.objects.count(), statuses.count(HTTPStatus.OK))
+
+
+
+@override_settings(ALLOWED_HOUR_TO_ORDER=24)
+class IdempotencyTest(TestCase):
+
+    def setUp(self):
+        self.user = User.objects.create(username='testuser', role="employee", first_name="Employee")
+        self.dish1 = Dish.objects.create(name="Corn pie, Salad and Dessert")
+        self.dish2 = Dish.objects.create(name="Premium chicken Salad and Dessert")
+        self.menu = Menu.objects.create(detail="Today's menu", date=localtime(now()).date())
+        self.menu.dishes.set([self.dish1, self.dish2])
+        self.client.force_login(self.user)
+
+    def test_form_token(self):
+        response = self.client.get(f"/menu/{self.menu.uuid}")
+        self.assertContains(response, 'name="idempotency_key"')
+        # Each render gets its own token
+        self.assertNotEqual(response.content, self.client.get(f"/menu/{self.menu.uuid}").content)
+
+    def test_replayed_order(self):
+        data = {'options': self.dish1.id, 'customizations': '', 'idempotency_key': 'abc'}
+        first = self.client.post(f"/menu/{self.menu.uuid}", data=data)
+        self.assertContains(first, "You have ordered Corn pie, Salad and Dessert!")
+
+        # The double click gets the same answer without touching the orders
+        data['options'] = self.dish2.id
+        with CaptureQueriesContext(connection) as queries:
+            second = self.client.post(f"/menu/{self.menu.uuid}", data=data)
+        self.assertEqual(second['Idempotent-Replayed'], 'true')
+        self.assertEqual(second.content, first.content)
+        self.assertFalse([query for query in queries if 'cafeteria_order' in query['sql']])
+        self.assertEqual(Order.objects.get(employee=self.user).dish, self.dish1)
+
+        # A new token is a new order
+        data['idempotency_key'] = 'def'
+        response = self.client.post(f"/menu/{self.menu.uuid}", data=data)
+        self.assertContains(response, "You order has been updated to: Premium chicken Salad and Dessert")
+
+    @override_settings(IDEMPOTENCY_WAIT=0)
+    def test_order_in_progress(self):
+        # The first post is still running
+        IdempotencyKey.objects.create(key=f'idempotency:{self.user.pk}:/menu/{self.menu.uuid}:abc')
+        data = {'options': self.dish1.id, 'customizations': '', 'idempotency_key': 'abc'}
+        response = self.client.post(f"/menu/{self.menu.uuid}", data=data)
+        self.assertEqual(response.status_code, HTTPStatus.CONFLICT)
+        self.assertFalse(Order.objects.exists())
+
+    def test_failed_order_is_not_kept(self):
+        data = {'options': self.dish1.id, 'customizations': '', 'idempotency_key': 'abc'}
+        with mock.patch.object(MenuDish, 'reserve', side_effect=IntegrityError):
+            response = self.client.post(f"/menu/{self.menu.uuid}", data=data)
+        self.assertContains(response, "Error ordering your dish, please try again",
+                            status_code=HTTPStatus.INTERNAL_SERVER_ERROR)
+        # The retry with the same token runs again
+        response = self.client.post(f"/menu/{self.menu.uuid}", data=data)
+        self.assertContains(response, "You have ordered Corn pie, Salad and Dessert!")
+        self.assertNotIn('Idempotent-Replayed', response)
+
+    @override_settings(RATELIMITS={'order': {'ip': (50, 500), 'user': (0.01, 1)}})
+    def test_replays_are_not_rate_limited(self):
+        data = {'options': self.dish1.id, 'customizations': '', 'idempotency_key': 'abc'}
+        first = self.client.post(f"/menu/{self.menu.uuid}", data=data)
+        for _ in range(3):
+            response = self.client.post(f"/menu/{self.menu.uuid}", data=data)
+            self.assertEqual(response.status_code, HTTPStatus.OK)
+            self.assertEqual(response.content, first.content)
+        data['idempotency_key'] = 'def'
+        response = self.client.post(f"/menu/{self.menu.uuid}", data=data)
+        self.assertEqual(response.status_code, HTTPStatus.TOO_MANY_REQUESTS)
+
+        # The rate limited post is not kept, its retry runs once the bucket refills
+        RateLimitBucket.objects.all().delete()
+        data['options'] = self.dish2.id
+        response = self.client.post(f"/menu/{self.menu.uuid}", data=data)
+        self.assertContains(response, "You order has been updated to: Premium chicken Salad and Dessert")
+        self.assertNotIn('Idempotent-Replayed', response)
+
+    def test_expired_key(self):
+        key = f'idempotency:{self.user.pk}:/menu/{self.menu.uuid}:abc'
+        IdempotencyKey.objects.create(key=key, created_at=now() - timedelta(seconds=601), status=200)
+        data = {'options': self.dish1.id, 'customizations': '', 'idempotency_key': 'abc'}
+        response = self.client.post(f"/menu/{self.menu.uuid}", data=data)
+        self.assertContains(response, "You have ordered Corn pie, Salad and Dessert!")
+
+        IdempotencyKey.objects.filter(key=key).update(created_at=now() - timedelta(seconds=601))
+        call_command('clear_expired_keys', stdout=io.StringIO())
+        self.assertFalse(IdempotencyKey.objects.exists())
+
+    def test_replayed_week_order(self):
+        data = {f'dish_{self.menu.uuid}': self.dish1.id, 'idempotency_key': 'abc'}
+        first = self.client.post("/week", data=data)
+        self.assertContains(first, "Your orders for 1 days have been saved!")
+        second = self.client.post("/week", data=data)
+        self.assertEqual(second['Idempotent-Replayed'], 'true')
+        self.assertEqual(Order.objects.count(), 1)
+
+
+class IdempotencyClaimTest(TransactionTestCase):
+
+    def test_one_claim_across_processes(self):
+        # Like the gunicorn workers, each process has its own connection
+        connection.close()
+        pids = []
+        for i in range(8):
+            pid = os.fork()
+            if pid == 0:
+                try:
+                    won = IdempotencyKey.claim('idempotency:1:/menu:abc', now() - timedelta(seconds=600))
+                    connection.close()
+                finally:
+                    os._exit(0 if won else 1)
+            pids.append(pid)
+        winners = [os.waitstatus_to_exitcode(os.waitpid(pid, 0)[1]) for pid in pids].count(0)
+        self.assertEqual(winners, 1)
+        self.assertEqual(IdempotencyKey.objects.count(), 1)
+
+
+@override_settings(ALLOWED_HOUR_TO_ORDER=24)
+class AsyncViewTest(TransactionTestCase):
+    # The async views query from the thread pool, so the data has to be committed
+
+    def setUp(self):
+        self.factory = AsyncRequestFactory()
+        self.user = User.objects.create(username='testuser', role="employee", first_name="Employee")
+        self.admin = User.objects.create(username='nora', role="admin", first_name="Nora")
+        self.dish = Dish.objects.create(name="Corn pie, Salad and Dessert")
+        self.menu = Menu.objects.create(detail="Today's menu", date=localtime(now()).date())
+        self.menu.dishes.set([self.dish])
+
+    def get(self, path, user, **extra):
+        request = self.factory.get(path, **extra)
+        request.user = user
+        return request
+
+    async def test_home(self):
+        response = await asyncviews.home(self.get('/', self.user))
+        self.assertContains(response, "Corn pie, Salad and Dessert")
+        self.assertContains(response, "Order a dish?")
+
+    async def test_redirect_uuid(self):
+        response = await asyncviews.redirect_uuid(self.get('/menu', self.user))
+        self.assertEqual(response.status_code, HTTPStatus.FOUND)
+        self.assertEqual(response.url, f'/menu/{self.menu.uuid}')
+        response = await asyncviews.redirect_uuid(self.get('/menu', AnonymousUser()))
+        self.assertTrue(response.url.startswith('/accounts/login/'))
+
+    async def test_order(self):
+        response = await asyncviews.order_uuid(self.get(f'/menu/{self.menu.uuid}', self.user), str(self.menu.uuid))
+        self.assertContains(response, "Hello Employee")
+        with self.assertRaises(Http404):
+            await asyncviews.order_uuid(self.get('/menu/x', self.user), '0371577c-e15a-4466-88a2-f54fcace18a6')
+
+        # Posts are saved by the sync view
+        request = RequestFactory().post(f'/menu/{self.menu.uuid}', data={'options': self.dish.id, 'customizations': ''})
+        request.user = self.user
+        response = await asyncviews.order_uuid(request, str(self.menu.uuid))
+        self.assertContains(response, "You have ordered Corn pie, Salad and Dessert!")
+        response = await asyncviews.order_uuid(self.get(f'/menu/{self.menu.uuid}', self.user), str(self.menu.uuid))
+        self.assertContains(response, "You have ordered Corn pie, Salad and Dessert")
+
+    async def test_slack_notification(self):
+        with mock.patch('cafeteria.asyncviews.notify') as notify:
+            response = await asyncviews.menu_form(self.get('/menu_form?slack=1', self.admin))
+        self.assertEqual(response.status_code, HTTPStatus.FOUND)
+        notify.assert_awaited_once_with(f"Today's menu:\nhttp://localhost:8000/menu/{self.menu.uuid}")
+        self.assertTrue((await asyncviews.in_thread(Menu.objects.get)(pk=self.menu.pk)).notification_sent)
+
+    async def test_slack_notification_error(self):
+        with mock.patch('cafeteria.asyncviews.notify', side_effect=SlackApiError('invalid_auth', {'ok': False})), \
+                mock.patch('cafeteria.views.send_async_notification') as send:
+            response = await asyncviews.menu_form(self.get('/menu_form?slack=1', self.admin))
+        self.assertContains(response, "Confirm your slack both credentials")
+        # The sync view does not send it again
+        send.assert_not_called()
+
+    async def test_async_middleware(self):
+        # The whole middleware chain runs in the event loop
+        response = await AsyncClient().get('/')
+        self.assertEqual(response.status_code, HTTPStatus.OK)
+        self.assertTrue(response['X-Request-ID'])
+
+
+@override_settings(ALLOWED_HOUR_TO_ORDER=24, ORDER_FEED_TOKENS=['payroll'])
+class OrderChangeFeedTest(TestCase):
+
+    def setUp(self):
+        self.user = User.objects.create(username='testuser', role="employee", first_name="Employee")
+        self.dish1 = Dish.objects.create(name="Corn pie, Salad and Dessert")
+        self.dish2 = Dish.objects.create(name="Premium chicken Salad and Dessert")
+        self.menu = Menu.objects.create(detail="Today's menu", date=localtime(now()).date())
+        self.menu.dishes.set([self.dish1, self.dish2])
+        self.client.force_login(self.user)
+
+    def feed(self, **params):
+        # The test transaction never commits, the changes are published by hand
+        OrderChange.publish()
+        return self.client.get("/orders/changes", params, HTTP_AUTHORIZATION='Bearer payroll').json()
+
+    def test_changes_are_logged(self):
+        self.client.post(f"/menu/{self.menu.uuid}", data={'options': self.dish1.id, 'customizations': ''})
+        self.client.post(f"/menu/{self.menu.uuid}", data={'options': self.dish2.id, 'customizations': 'No salt'})
+        tomorrow = Menu.objects.create(detail="Tomorrow's menu", date=self.menu.date + timedelta(days=1))
+        tomorrow.dishes.set([self.dish1])
+        self.client.post("/week", data={f'dish_{tomorrow.uuid}': self.dish1.id})
+
+        order = Order.objects.get(created_at=self.menu.date)
+        data = self.feed()
+        self.assertEqual([(change['action'], change['dish']) for change in data['changes']], [
+            ('created', self.dish1.name),
+            ('updated', self.dish2.name),
+            ('created', self.dish1.name),
+        ])
+        self.assertEqual(data['changes'][1]['order_id'], order.id)
+        self.assertEqual(data['changes'][1]['customizations'], 'No salt')
+        self.assertEqual(data['changes'][2]['date'], str(tomorrow.date))
+        self.assertFalse(data['has_more'])
+
+    def test_failed_order_is_not_logged(self):
+        with mock.patch.object(Order.objects, 'create', side_effect=IntegrityError):
+            self.client.post(f"/menu/{self.menu.uuid}", data={'options': self.dish1.id, 'customizations': ''})
+        self.assertFalse(OrderChange.objects.exists())
+
+    def test_cursor_pagination(self):
+        for customizations in ('a', 'b', 'c'):
+            self.client.post(f"/menu/{self.menu.uuid}", data={'options': self.dish1.id, 'customizations': customizations})
+        data = self.feed(limit=2)
+        self.assertEqual([change['customizations'] for change in data['changes']], ['a', 'b'])
+        self.assertTrue(data['has_more'])
+        data = self.feed(cursor=data['cursor'], limit=2)
+        self.assertEqual([change['customizations'] for change in data['changes']], ['c'])
+        self.assertFalse(data['has_more'])
+        # Nothing new, the consumer keeps its cursor
+        cursor = data['cursor']
+        self.assertEqual(self.feed(cursor=cursor), {'changes': [], 'cursor': cursor, 'has_more': False})
+
+    def test_late_commit_is_not_skipped(self):
+        self.client.post(f"/menu/{self.menu.uuid}", data={'options': self.dish1.id, 'customizations': 'a'})
+        data = self.feed()
+        # A transaction that got a lower id commits after the consumer read the first change
+        late = OrderChange.objects.create(order_id=99, action='created', employee=self.user, dish=self.dish1,
+                                          customizations='late', date=self.menu.date)
+        OrderChange.objects.filter(id=late.id).update(id=0)
+        self.assertEqual([change['customizations'] for change in self.feed(cursor=data['cursor'])['changes']],
+                         ['late'])
+
+    def test_history_survives_deletes(self):
+        self.client.post(f"/menu/{self.menu.uuid}", data={'options': self.dish1.id, 'customizations': ''})
+        Order.objects.all().delete()
+        self.user.delete()
+        self.dish1.delete()
+        change = self.feed()['changes'][0]
+        self.assertEqual((change['employee'], change['dish'], change['dish_id']), ('testuser', self.dish1.name, None))
+
+    def test_feed_access(self):
+        # Employees and unknown tokens can not read the feed
+        self.assertEqual(self.client.get("/orders/changes").status_code, HTTPStatus.FORBIDDEN)
+        response = self.client.get("/orders/changes", HTTP_AUTHORIZATION='Bearer other')
+        self.assertEqual(response.status_code, HTTPStatus.FORBIDDEN)
+        response = self.client.get("/orders/changes", {'cursor': 'x'}, HTTP_AUTHORIZATION='Bearer payroll')
+        self.assertEqual(response.status_code, HTTPStatus.BAD_REQUEST)
+        self.client.force_login(User.objects.create(username='nora', role="admin"))
+        self.assertEqual(self.client.get("/orders/changes").status_code, HTTPStatus.OK)
+
+    def test_compaction(self):
+        for customizations in ('a', 'b'):
+            self.client.post(f"/menu/{self.menu.uuid}", data={'options': self.dish1.id, 'customizations': customizations})
+        other = Order.objects.create(dish=self.dish1, employee=User.objects.create(username='other'),
+                                     created_at=self.menu.date)
+        OrderChange.record([other], 'created')
+        OrderChange.record([other], 'deleted')
+        OrderChange.objects.update(changed_at=now() - timedelta(days=40))
+        # A recent change of the first order is kept with its last old change gone
+        self.client.post(f"/menu/{self.menu.uuid}", data={'options': self.dish1.id, 'customizations': 'c'})
+
+        out = io.StringIO()
+        call_command('compact_order_changes', stdout=out)
+        self.assertIn('3 order changes removed', out.getvalue())
+        # The delete of the other order is kept, consumers that far behind still remove it
+        self.assertEqual([(change['action'], change['order_id'], change['customizations'])
+                          for change in self.feed()['changes']],
+                         [('deleted', other.id, ''), ('updated', Order.objects.get(employee=self.user).id, 'c')])
+
+    def test_cascade_deletes_are_logged(self):
+        self.client.post(f"/menu/{self.menu.uuid}", data={'options': self.dish1.id, 'customizations': ''})
+        other = User.objects.create(username='other')
+        Order.objects.create(dish=self.dish2, employee=other, created_at=self.menu.date)
+        self.user.delete()
+        self.dish2.delete()
+        changes = self.feed()['changes']
+        self.assertEqual([(change['action'], change['employee'], change['dish']) for change in changes], [
+            ('created', 'testuser', self.dish1.name),
+            ('deleted', 'testuser', self.dish1.name),
+            ('deleted', 'other', self.dish2.name),
+        ])
+        self.assertFalse(Order.objects.exists())
+
+
+class FakeSlack(BaseHTTPRequestHandler):
+    """users.list and chat.postMessage of a local fake Slack.
+
+    ``server.members`` is the workspace, the posted messages are added to
+    ``server.messages`` and every post to ``server.posts``, after calling
+    ``server.before_post`` if set. The channel UFAIL does not exist and the
+    channel ULIMIT is always rate limited.
+    """
+
+    def do_POST(self):
+        data = json.loads(self.rfile.read(int(self.headers['Content-Length'])))
+        self.server.posts.append(data['channel'])
+        if getattr(self.server, 'before_post', None):
+            self.server.before_post()
+        if data['channel'] == 'UFAIL':
+            return self.reply(200, {'ok': False, 'error': 'channel_not_found'})
+        if data['channel'] == 'ULIMIT':
+            return self.reply(429, {'ok': False, 'error': 'ratelimited'}, {'Retry-After': '0'})
+        self.server.messages.append((data['channel'], data['text']))
+        self.reply(200, {'ok': True})
+
+    def do_GET(self):
+        url = urlparse(self.path)
+        params = parse_qs(url.query)
+        self.server.requests.append(params)
+        if url.path != '/api/users.list' or self.headers['Authorization'] != 'Bearer xoxb-test':
+            return self.reply(404, {'ok': False, 'error': 'unknown_method'})
+        # The first page after the first one is rate limited
+        if len(self.server.requests) == 2:
+            return self.reply(429, {'ok': False, 'error': 'ratelimited'}, {'Retry-After': '0'})
+
+        start = int(params.get('cursor', ['0'])[0])
+        limit = int(params['limit'][0])
+        end = start + limit
+        self.reply(200, {
+            'ok': True,
+            'members': self.server.members[start:end],
+            'response_metadata': {'next_cursor': str(end) if end < len(self.server.members) else ''},
+        })
+
+    def reply(self, status, data, headers=None):
+        content = json.dumps(data).encode()
+        self.send_response(status)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(content)))
+        for name, value in (headers or {}).items():
+            self.send_header(name, value)
+        self.end_headers()
+        self.wfile.write(content)
+
+    def log_message(self, *args):
+        pass
+
+
+def slack_member(_id, name, email='', deleted=False, is_bot=False, confirmed=True):
+    return {'id': _id, 'name': name, 'deleted': deleted, 'is_bot': is_bot, 'is_email_confirmed': confirmed,
+            'profile': {'first_name': name.title(), 'last_name': 'Slack', 'email': email}}
+
+
+class SlackUserSyncTest(TestCase):
+
+    def setUp(self):
+        self.server = ThreadingHTTPServer(('127.0.0.1', 0), FakeSlack)
+        self.server.members = []
+        self.server.requests = []
+        self.server.messages = []
+        self.server.posts = []
+        threading.Thread(target=self.server.serve_forever, daemon=True).start()
+        self.addCleanup(self.server.server_close)
+        self.addCleanup(self.server.shutdown)
+        self.settings_override = override_settings(
+            SLACK_API_URL=f'http://127.0.0.1:{self.server.server_port}/api/',
+            SLACK_API_TOKEN='xoxb-test',
+        )
+        self.settings_override.enable()
+        self.addCleanup(self.settings_override.disable)
+
+    def sync(self, **options):
+        out = io.StringIO()
+        self.errors = io.StringIO()
+        call_command('sync_slack_users', stdout=out, stderr=self.errors, **options)
+        return out.getvalue()
+
+    def test_sync(self):
+        User.objects.create(username='nora', role='admin', email='Nora@cafeteria.com')
+        User.objects.create(username='pepe', role='employee')
+        User.objects.create(username='old', role='employee')
+        User.objects.create(username='maria', role='employee', email='maria@cafeteria.com')
+        User.objects.create(username='gone', role='employee', slack_id='U9')
+        self.server.members = [
+            slack_member('U1', 'nora.admin', email='nora@cafeteria.com'),
+            slack_member('U2', 'pepe'),
+            slack_member('U3', 'ale', email='ale@cafeteria.com'),
+            slack_member('U4', 'old', deleted=True),
+            slack_member('U5', 'maria.r', email='maria@cafeteria.com', confirmed=False),
+            slack_member('B1', 'lunchbot', is_bot=True),
+        ]
+        output = self.sync(page_size=2)
+        self.assertIn('5 Slack members: 1 users created, 1 updated, 1 deactivated, 2 skipped', output)
+        # Three pages plus the rate limited retry
+        self.assertEqual(len(self.server.requests), 4)
+        self.assertEqual(self.server.requests[2], self.server.requests[1])
+
+        # Existing users are linked by confirmed email and keep their login and role
+        nora = User.objects.get(slack_id='U1')
+        self.assertEqual((nora.username, nora.role, nora.first_name), ('nora', 'admin', 'Nora.Admin'))
+        ale = User.objects.get(slack_id='U3')
+        self.assertEqual((ale.username, ale.role, ale.is_active), ('ale', 'employee', True))
+        self.assertFalse(ale.has_usable_password())
+        self.assertFalse(User.objects.get(username='gone').is_active)
+        self.assertFalse(User.objects.filter(username__in=['lunchbot', 'maria.r']).exists())
+        # Handles and unconfirmed emails are reported, not linked
+        self.assertIn('Username pepe is taken', self.errors.getvalue())
+        self.assertIn('Slack member U5 has the email of users maria', self.errors.getvalue())
+        self.assertEqual(User.objects.filter(username__in=['pepe', 'maria'], slack_id__isnull=True).count(), 2)
+        # A deleted member with the same handle does not deactivate the user
+        self.assertTrue(User.objects.get(username='old').is_active)
+
+        # Nothing changed, nothing is saved
+        self.server.requests.clear()
+        self.assertIn('0 users created, 0 updated, 0 deactivated', self.sync(page_size=10))
+
+        # Members deleted from the workspace are deactivated
+        self.server.members[2]['deleted'] = True
+        self.assertIn('0 users created, 0 updated, 1 deactivated', self.sync())
+        self.assertFalse(User.objects.get(slack_id='U3').is_active)
+
+    def test_large_workspace(self):
+        self.server.members = [slack_member(f'U{i}', f'user{i}') for i in range(5000)]
+        with CaptureQueriesContext(connection) as queries:
+            output = self.sync(page_size=1000, batch_size=1000)
+        self.assertIn('5000 Slack members: 5000 users created', output)
+        self.assertEqual(User.objects.count(), 5000)
+        # One read of the users and the inserts in batches, SQLite caps the rows of an insert by its parameter limit
+        self.assertLess(len(queries), 100)
+
+
+@override_settings(ALLOWED_HOUR_TO_ORDER=24, SLACK_API_TOKEN='xoxb-test')
+class PullDishTest(TransactionTestCase):
+    # The notifications are queued on commit and sent by another thread
+
+    def setUp(self):
+        self.server = ThreadingHTTPServer(('127.0.0.1', 0), FakeSlack)
+        self.server.messages = []
+        self.server.posts = []
+        threading.Thread(target=self.server.serve_forever, daemon=True).start()
+        self.addCleanup(self.server.server_close)
+        self.addCleanup(self.server.shutdown)
+        self.settings_override = override_settings(SLACK_API_URL=f'http://127.0.0.1:{self.server.server_port}/api/')
+        self.settings_override.enable()
+        self.addCleanup(self.settings_override.disable)
+
+        self.client.force_login(User.objects.create(username='nora', role="admin", first_name="Nora"))
+        self.dish1 = Dish.objects.create(name="Corn pie")
+        self.dish2 = Dish.objects.create(name="Chicken salad")
+        self.menu = Menu.objects.create(detail="Today's menu", date=localtime(now()).date())
+        self.menu.dishes.set([self.dish1, self.dish2])
+        for name, slack_id in (('pepe', 'U1'), ('ale', 'U2'), ('manual', None)):
+            employee = User.objects.create(username=name, role='employee', slack_id=slack_id)
+            Order.objects.create(dish=self.dish1, employee=employee, created_at=self.menu.date)
+
+    def test_reassign_orders(self):
+        with CaptureQueriesContext(connection) as queries:
+            response = self.client.post("/see_orders", data={
+                'dish': self.dish1.id, 'action': 'reassign', 'new_dish': self.dish2.id})
+        self.assertContains(response, "3 orders of Corn pie were changed to Chicken salad")
+        # One set based UPDATE for all the orders
+        self.assertEqual(len([query for query in queries if query['sql'].startswith('UPDATE "cafeteria_order"')]), 1)
+        self.assertEqual(Order.objects.filter(dish=self.dish2).count(), 3)
+        self.assertEqual(MenuDish.objects.get(menu=self.menu, dish=self.dish1).remaining, 0)
+        self.assertEqual(list(OrderChange.objects.values_list('action', 'dish_id').distinct()),
+                         [('updated', self.dish2.id)])
+
+        # Users without Slack id are not notified
+        notifications.wait_pending()
+        self.assertEqual(sorted(channel for channel, _ in self.server.messages), ['U1', 'U2'])
+        self.assertIn("Corn pie ran out, your order for", self.server.messages[0][1])
+        self.assertFalse(Notification.objects.filter(sent_at__isnull=True).exists())
+
+    def test_orders_are_locked_before_the_dishes(self):
+        # In the same order as the orders of the employees, so they can not deadlock
+        with CaptureQueriesContext(connection) as queries:
+            self.client.post("/see_orders", data={'dish': self.dish1.id, 'action': 'cancel'})
+        tables = [table for query in queries for table in ('"cafeteria_order"', '"cafeteria_menu_dishes"')
+                  if query['sql'].startswith('SELECT') and f'FROM {table}' in query['sql']]
+        self.assertLess(tables.index('"cafeteria_order"'), tables.index('"cafeteria_menu_dishes"'))
+        notifications.wait_pending()
+
+    def test_not_enough_portions(self):
+        MenuDish.set_capacity(self.menu, self.dish2, 2)
+        response = self.client.post("/see_orders", data={
+            'dish': self.dish1.id, 'action': 'reassign', 'new_dish': self.dish2.id})
+        self.assertContains(response, "There are not enough portions of Chicken salad for 3 orders")
+        # Nothing changed
+        self.assertEqual(Order.objects.filter(dish=self.dish1).count(), 3)
+        self.assertIsNone(MenuDish.objects.get(menu=self.menu, dish=self.dish1).remaining)
+        self.assertFalse(Notification.objects.exists())
+
+    def test_cancel_orders(self):
+        response = self.client.post("/see_orders", data={'dish': self.dish1.id, 'action': 'cancel'})
+        self.assertContains(response, "3 orders of Corn pie were cancelled")
+        self.assertFalse(Order.objects.exists())
+        self.assertEqual(OrderChange.objects.filter(action='deleted').count(), 3)
+        notifications.wait_pending()
+        self.assertIn(f'/menu/{self.menu.uuid}', self.server.messages[0][1])
+
+    def test_failed_notifications(self):
+        User.objects.filter(slack_id='U2').update(slack_id='UFAIL')
+        self.client.post("/see_orders", data={'dish': self.dish1.id, 'action': 'cancel'})
+        notifications.wait_pending()
+        self.assertEqual([channel for channel, _ in self.server.messages], ['U1'])
+        # The failed one is kept for a delivery after the retry delay
+        failed = Notification.objects.get(sent_at__isnull=True)
+        self.assertEqual((failed.user.slack_id, failed.attempts, failed.claimed_by), ('UFAIL', 1, None))
+        self.assertGreater(failed.next_attempt_at, now() + timedelta(seconds=50))
+        notifications.deliver_pending()
+        self.assertEqual(sorted(self.server.posts), ['U1', 'UFAIL'])
+
+        # The delay doubles after each attempt
+        Notification.objects.filter(id=failed.id).update(next_attempt_at=now())
+        notifications.deliver_pending()
+        failed.refresh_from_db()
+        self.assertEqual(failed.attempts, 2)
+        self.assertGreater(failed.next_attempt_at, now() + timedelta(seconds=110))
+
+        # Until it is given up
+        Notification.objects.filter(id=failed.id).update(attempts=5, next_attempt_at=now())
+        out = io.StringIO()
+        call_command('deliver_notifications', stdout=out)
+        self.assertEqual(sorted(self.server.posts), ['U1', 'UFAIL', 'UFAIL'])
+        self.assertEqual(out.getvalue(), "0 notifications pending, 1 given up\n")
+
+    def test_failed_notifications_are_retried_on_a_timer(self):
+        User.objects.filter(slack_id='U2').update(slack_id='UFAIL')
+        with self.settings(NOTIFICATION_RETRY_INTERVAL=0.1):
+            self.client.post("/see_orders", data={'dish': self.dish1.id, 'action': 'cancel'})
+            notifications.wait_pending()
+            User.objects.filter(slack_id='UFAIL').update(slack_id='U2')
+            Notification.objects.filter(sent_at__isnull=True).update(next_attempt_at=now())
+            # Nothing new is scheduled, the worker sends it by itself
+            for _ in range(50):
+                if not Notification.objects.filter(sent_at__isnull=True).exists():
+                    break
+                time.sleep(0.1)
+        self.assertEqual(sorted(channel for channel, _ in self.server.messages), ['U1', 'U2'])
+        # Back to the interval of the tests
+        notifications.schedule_delivery()
+        notifications.wait_pending()
+
+    def test_fewest_attempts_first(self):
+        ale, pepe = User.objects.get(username='ale'), User.objects.get(username='pepe')
+        Notification.objects.create(user=ale, message="Retried", attempts=2)
+        Notification.objects.create(user=pepe, message="New")
+        with self.settings(NOTIFICATION_BATCH_SIZE=1):
+            notifications.deliver_pending()
+        self.assertEqual([text for _, text in self.server.messages], ["New", "Retried"])
+
+    def test_rate_limited_notifications(self):
+        User.objects.filter(slack_id='U2').update(slack_id='ULIMIT')
+        with self.settings(SLACK_MAX_RETRIES=2):
+            self.client.post("/see_orders", data={'dish': self.dish1.id, 'action': 'cancel'})
+            notifications.wait_pending()
+        # The first post and 2 retries
+        self.assertEqual(sorted(self.server.posts), ['U1', 'ULIMIT', 'ULIMIT', 'ULIMIT'])
+        self.assertEqual(Notification.objects.get(sent_at__isnull=True).attempts, 1)
+
+    def test_slack_is_called_outside_transactions(self):
+        # A write of another connection while the messages are sent does not wait for the delivery
+        written = []
+
+        def write():
+            written.append(Dish.objects.create(name=f"Dish {threading.get_ident()}"))
+            connection.close()
+
+        self.server.before_post = write
+        self.client.post("/see_orders", data={'dish': self.dish1.id, 'action': 'cancel'})
+        notifications.wait_pending()
+        self.assertEqual(len(written), 2)
+        self.assertEqual(len(self.server.messages), 2)
+
+    def test_new_dish_defaults_to_another_dish(self):
+        response = self.client.get("/see_orders")
+        # The dish that ran out defaults to the first one
+        second = self.menu.menudish_set.order_by('id')[1].dish
+        self.assertContains(response, f'<option value="{second.id}" selected>{second.name}</option>', html=True)
+        self.menu.dishes.set([self.dish1])
+        response = self.client.get("/see_orders")
+        self.assertContains(response, '<option value="cancel" selected>cancel its orders</option>', html=True)
+
+    def test_invalid_choices(self):
+        response = self.client.post("/see_orders", data={'dish': self.dish1.id, 'action': 'reassign'})
+        self.assertContains(response, "Please choose the new dish of the orders!")
+        response = self.client.post("/see_orders", data={
+            'dish': self.dish1.id, 'action': 'reassign', 'new_dish': self.dish1.id})
+        self.assertContains(response, "Please choose another dish of the menu for the orders!")
+        self.assertEqual(Order.objects.filter(dish=self.dish1).count(), 3)
+
+
+@override_settings(ALLOWED_HOUR_TO_ORDER=24, REPLICA_DATABASE='replica')
+class ReplicaRouterTest(TestCase):
+    # The replica is another file, it only gets what replicate() copies
+    databases = {'default', 'replica'}
+
+    def setUp(self):
+        self.admin = User.objects.create(username='nora', role="admin", first_name="Nora")
+        self.dish = Dish.objects.create(name="Corn pie")
+        self.menu = Menu.objects.create(detail="Today's menu", date=localtime(now()).date())
+        self.menu.dishes.set([self.dish])
+        self.order = Order.objects.create(
+            dish=self.dish, employee=User.objects.create(username='pepe'), created_at=self.menu.date)
+        OrderChange.record([self.order], 'created')
+        OrderChange.publish()
+        self.replicate()
+        # Changes the replica has not got yet
+        self.late_order = Order.objects.create(
+            dish=self.dish, employee=User.objects.create(username='ale'), created_at=self.menu.date)
+        OrderChange.record([self.late_order], 'created')
+        OrderChange.publish()
+
+    def replicate(self):
+        """Copies the primary to the replica, as the replication does after the lag."""
+        models = [User, Dish, Menu, MenuDish, Order, OrderChange]
+        for model in reversed(models):
+            model.objects.using('replica').all().delete()
+        for model in models:
+            model.objects.using('replica').bulk_create(model.objects.using('default').all())
+
+    def see_orders(self):
+        response = self.client.get("/see_orders")
+        return [order.employee.username for order in response.context['orders']]
+
+    def test_reports_read_the_replica(self):
+        # The admin user only exists in the primary, users and sessions are read from there
+        self.client.force_login(User.objects.create(username='admin2', role="admin"))
+        self.assertEqual(self.see_orders(), ['pepe'])
+        response = self.client.get("/orders/changes")
+        self.assertEqual([change['employee'] for change in response.json()['changes']], ['pepe'])
+
+        self.replicate()
+        self.assertEqual(self.see_orders(), ['pepe', 'ale'])
+
+    def test_replica_queries_are_counted(self):
+        self.client.force_login(self.admin)
+        metrics.registry.counters.clear()
+        with CaptureQueriesContext(connections['default']) as primary, \
+                CaptureQueriesContext(connections['replica']) as replica:
+            self.see_orders()
+        self.assertGreater(len(replica), 0)
+        self.assertEqual(metrics.registry.counters[('cafeteria_db_queries_total', (('view', 'see_orders'),))],
+                         len(primary) + len(replica))
+
+    def test_writes_pin_the_primary(self):
+        self.client.force_login(self.admin)
+        response = self.client.post("/see_orders", data={'dish': self.dish.id, 'action': 'cancel'})
+        # The same request lists the orders from the primary
+        self.assertContains(response, "2 orders of Corn pie were cancelled")
+        self.assertEqual(list(response.context['orders']), [])
+        self.assertEqual(response.cookies['primary_pin']['max-age'], 5)
+
+        # The next requests too, while the replica still has the orders
+        self.assertEqual(self.see_orders(), [])
+        self.assertEqual(Order.objects.using('replica').count(), 1)
+
+        # Once the pin expires the report tolerates the lag again
+        del self.client.cookies['primary_pin']
+        self.assertEqual(self.see_orders(), ['pepe'])
+
+    def test_orders_pin_the_reports(self):
+        self.client.force_login(self.admin)
+        response = self.client.post(f"/menu/{self.menu.uuid}", data={'options': self.dish.id, 'customizations': ''})
+        self.assertIn('primary_pin', response.cookies)
+        OrderChange.publish()
+
+        # The reports of the same browser show the new order, the replica does not have it yet
+        self.assertEqual(self.see_orders(), ['pepe', 'ale', 'nora'])
+        response = self.client.get("/orders/changes")
+        self.assertEqual([change['employee'] for change in response.json()['changes']], ['pepe', 'ale', 'nora'])
+        self.assertFalse(Order.objects.using('replica').filter(employee=self.admin).exists())
+
+        del self.client.cookies['primary_pin']
+        self.assertEqual(self.see_orders(), ['pepe'])
+
+    def test_only_the_primary_is_migrated(self):
+        router = ReplicaRouter()
+        self.assertTrue(router.allow_migrate('default', 'cafeteria'))
+        # The test database of the replica gets the schema, the real replica does not
+        self.assertTrue(router.allow_migrate('replica', 'cafeteria'))
+        with mock.patch.dict(connections['replica'].settings_dict, NAME='db.sqlite3'):
+            self.assertFalse(router.allow_migrate('replica', 'cafeteria'))
+            self.assertFalse(router.allow_migrate('replica', 'auth', model_name='group'))
@@ -0,0 +1,103 @@
+import atexit
+import logging
+import multiprocessing
+import os
+import threading
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor, wait
+
+from django.conf import settings
+from django.core.files.base import ContentFile
+from django.db import connection
+from django.db.models import Q
+
+from .images import IMAGE_FORMATS, image_variant_name, resize_image_content
+from .models import Dish
+
+
+# This retrieves a Python logging instance (or creates it)
+logger = logging.getLogger(__name__)
+
+# One thread saves the results, the resizing runs in the process pool
+_worker = ThreadPoolExecutor(max_workers=1, thread_name_prefix='thumbnails')
+_processes = None
+_processes_lock = threading.Lock()
+_pending = set()
+
+
+def get_process_pool():
+    global _processes
+    with _processes_lock:
+        if _processes is None:
+            # The workers are threaded (logging, notifications, this module), forking them is not safe
+            _processes = ProcessPoolExecutor(max_workers=settings.THUMBNAIL_PROCESSES,
+                                             mp_context=multiprocessing.get_context('spawn'))
+        return _processes
+
+
+def create_variants(dish_id):
+    """Creates the resized copies of the dish photo and saves them in the photo storage.
+
+    If the photo was cleared, the copies of the previous one are deleted.
+    """
+    try:
+        dish = Dish.objects.get(pk=dish_id)
+        if not dish.photo:
+            if Dish.objects.filter(Q(photo='') | Q(photo__isnull=True), pk=dish_id).update(photo_variants={}):
+                dish.delete_photo_variants()
+            return
+        with dish.photo.open('rb') as file:
+            content = file.read()
+
+        pool = get_process_pool()
+        futures = {
+            (width, extension): pool.submit(resize_image_content, content, width, extension)
+            for width in settings.DISH_PHOTO_WIDTHS
+            for extension in IMAGE_FORMATS
+        }
+        variants = {}
+        storage = dish.photo.storage
+        for (width, extension), future in futures.items():
+            name = storage.save(image_variant_name(dish.photo.name, width, extension), ContentFile(future.result()))
+            variants.setdefault(extension, {})[str(width)] = name
+
+        # The copies are only kept if the photo was not replaced meanwhile
+        if Dish.objects.filter(pk=dish_id, photo=dish.photo.name).update(photo_variants=variants):
+            # A copy that was missing gets its old name again
+            dish.delete_photo_variants(keep=variants)
+        else:
+            dish.delete_photo_variants(variants)
+    except Exception as e:
+        logger.error("Error creating the photo variants of dish %s: %s", dish_id, e)
+    finally:
+        # The worker thread has its own database connection
+        connection.close()
+
+
+def has_current_variants(dish):
+    """Whether the dish has every resized copy of its current photo in the storage, or no photo and no copies."""
+    if not dish.photo:
+        return not dish.photo_variants
+    root, _ = os.path.splitext(dish.photo.name)
+    for extension in IMAGE_FORMATS:
+        variants = dish.photo_variants.get(extension, {})
+        for width in settings.DISH_PHOTO_WIDTHS:
+            name = variants.get(str(width))
+            if name is None or not name.startswith(root) or not dish.photo.storage.exists(name):
+                return False
+    return True
+
+
+def schedule_variants(dish_id):
+    """Creates the photo variants in the background and returns the future."""
+    future = _worker.submit(create_variants, dish_id)
+    _pending.add(future)
+    future.add_done_callback(_pending.discard)
+    return future
+
+
+def wait_pending(timeout=None):
+    """Waits for the scheduled variants, used by the tests and on exit."""
+    wait(list(_pending), timeout=timeout)
+
+
+atexit.register(wait_pending)
@@ -1,14 +1,24 @@
+import hmac
 import logging
+from datetime import datetime, timedelta, timezone
 from uuid import UUID
 
 from django.conf import settings
 from django.contrib.auth.decorators import login_required
 from django.core.exceptions import ObjectDoesNotExist, MultipleObjectsReturned
+from django.db import IntegrityError, transaction
+from django.db.models import Prefetch, Q
+from django.http import FileResponse, Http404, JsonResponse
 from django.shortcuts import render, redirect, get_object_or_404
 from django.utils.timezone import now, localtime
 
+from . import metrics, notifications, thumbnails
 from .forms import DishForm, MenuForm, OrderForm
-from .models import Dish, User, Menu, Order
+from .models import Dish, User, Menu, MenuDish, Order, OrderChange
+from .dbrouter import replica_reads
+from .idempotency import idempotent
+from .profiler import list_profiles, profile_path
+from .ratelimit import ratelimit
 from .slackapi import send_async_notification
 
 
@@ -22,9 +32,9 @@ def home(request):
     try:
         # Display today's menu if exists
         menu = Menu.objects.get(date=date)
-        logger.info(f'Menu uuid: {menu.uuid}')
+        logger.info('Menu uuid: %s', menu.uuid)
     except Exception as e:
-        logger.error(f"Error: {e}")
+        logger.error("Error: %s", e)
 
     is_authenticated = False
     is_admin = False
@@ -53,10 +63,12 @@ def dish_form(request):
     form = DishForm()
     all_dishes = Dish.objects.all()
     if request.method == 'POST':
-        filled_form = DishForm(request.POST)
+        filled_form = DishForm(request.POST, request.FILES)
         if filled_form.is_valid():
             created_dish = filled_form.save()
             created_dish_pk = created_dish.id
+            if created_dish.photo:
+                schedule_photo_variants(created_dish)
             note = f"Dish {filled_form.cleaned_data['name']} was added!"
             # Clean the dish form to add another dish
             filled_form = DishForm()
@@ -72,6 +84,11 @@ def dish_form(request):
     return render(request, 'cafeteria/dish_form.html', {'dish_form': form, 'all_dishes': all_dishes})
 
 
+def schedule_photo_variants(dish):
+    # The resized copies are created in the background once the dish is saved
+    transaction.on_commit(lambda: thumbnails.schedule_variants(dish.pk))
+
+
 # Admin
 # This is managed by Nora's cafeteria
 @login_required
@@ -84,9 +101,17 @@ def edit_dish(request, pk):
     dish = get_object_or_404(Dish, pk=pk)
     form = DishForm(instance=dish)
     if request.method == 'POST':
-        filled_form = DishForm(request.POST, instance=dish)
+        # The form changes the dish, the previous photo is kept to delete its file
+        previous_photo = dish.photo.name if dish.photo else None
+        filled_form = DishForm(request.POST, request.FILES, instance=dish)
         if filled_form.is_valid():
             filled_form.save()
+            # A cleared photo also loses its resized copies
+            if 'photo' in filled_form.changed_data:
+                schedule_photo_variants(dish)
+                if previous_photo and previous_photo != dish.photo.name:
+                    storage = dish.photo.storage
+                    transaction.on_commit(lambda: storage.delete(previous_photo))
             form = filled_form
             note = 'Dish was edited successfully!'
         else:
@@ -95,7 +120,7 @@ def edit_dish(request, pk):
 
 
 @login_required
-def menu_form(request):
+def menu_form(request, slack_error=None):
     role = request.user.role.lower()
     if role != 'admin':
         return home(request)
@@ -113,18 +138,21 @@ def menu_form(request):
         if menu.notification_sent:
             note = "Employees has been notified with today's menu"
 
-        # Send async slack notification if user press the button to send it
-        if request.method == 'GET' and request.GET.get('slack'):
+        # Send async slack notification if user press the button to send it,
+        # the async view sends it itself and only passes the error here
+        if request.method == 'GET' and request.GET.get('slack') and slack_error is None:
             try:
-                send_async_notification(f"{menu.detail}:\n{settings.HOST_URL}/menu/{menu.uuid}")
+                send_async_notification(menu_notification(menu))
                 menu.notification_sent = True
                 menu.save()
-                return redirect(menu_form)
+                return redirect('menu_form')
             except Exception as e:
-                logger.error(e)
-                have_errors = True
-                note = f'Confirm your slack both credentials | Verify your both is in the {settings.CHANNEL} channel' \
-                       f' | Or contact support team '
+                slack_error = e
+        if slack_error is not None:
+            logger.error(slack_error)
+            have_errors = True
+            note = f'Confirm your slack both credentials | Verify your both is in the {settings.CHANNEL} channel' \
+                   f' | Or contact support team '
 
     except ObjectDoesNotExist as e:
         pass
@@ -154,6 +182,10 @@ def menu_form(request):
     })
 
 
+def menu_notification(menu):
+    return f"{menu.detail}:\n{settings.HOST_URL}/menu/{menu.uuid}"
+
+
 @login_required
 def edit_menu(request, pk):
     role = request.user.role.lower()
@@ -191,6 +223,7 @@ def edit_menu(request, pk):
 
 
 @login_required
+@replica_reads
 def see_orders(request):
     role = request.user.role.lower()
     if role != 'admin':
@@ -198,12 +231,159 @@ def see_orders(request):
 
     date = localtime(now()).date()
     orders = None
-    if request.method == 'GET':
-        try:
-            orders = Order.objects.filter(created_at=date.strftime("%Y-%m-%d"))
-        except Exception as e:
-            logger.error(f"Error: {e}")
-    return render(request, 'cafeteria/orders.html', {'orders': orders})
+    note = None
+    have_errors = False
+    menu = Menu.objects.filter(date=date).first()
+
+    # The kitchen ran out of a dish, its orders are moved to another dish or cancelled
+    if request.method == 'POST':
+        dish_id = request.POST.get('dish', '')
+        new_dish_id = request.POST.get('new_dish', '')
+        action = request.POST.get('action')
+        have_errors = True
+        if menu is None or not dish_id.isdigit():
+            note = 'Please choose the dish that ran out!'
+        elif action == 'reassign' and not new_dish_id.isdigit():
+            note = 'Please choose the new dish of the orders!'
+        elif action not in ('reassign', 'cancel'):
+            note = 'Please choose what to do with the orders!'
+        else:
+            try:
+                note = pull_dish(menu, int(dish_id), int(new_dish_id) if action == 'reassign' else None)
+                have_errors = False
+            except ValueError as e:
+                note = str(e)
+            except Exception as e:
+                logger.error("Error: %s", e)
+                note = 'Orders were not changed, please try again'
+
+    try:
+        orders = Order.objects.filter(created_at=date).select_related('employee', 'dish')
+    except Exception as e:
+        logger.error("Error: %s", e)
+    return render(request, 'cafeteria/orders.html', {
+        'orders': orders,
+        'menu_dishes': menu.menudish_set.select_related('dish').order_by('id') if menu else [],
+        'note': note,
+        'have_errors': have_errors
+    })
+
+
+def pull_dish(menu, dish_id, new_dish_id=None):
+    """Moves all the orders of a dish to another dish of the menu, or cancels them.
+
+    The orders change with one UPDATE or DELETE, the dish is sold out from
+    now on, and the employees are notified in the background. Returns the
+    note for the admin, raises ValueError with the note if nothing changed.
+    """
+    with transaction.atomic():
+        orders = Order.objects.filter(created_at=menu.date, dish_id=dish_id)
+        # The orders are locked before the dishes, and both dishes in id order, like the orders of the employees do
+        list(orders.select_for_update().order_by('id').values_list('id', flat=True))
+        menu_dishes = {
+            menu_dish.dish_id: menu_dish
+            for menu_dish in menu.menudish_set.select_for_update(of=('self',)).select_related('dish').filter(
+                dish_id__in=[dish_id, new_dish_id]).order_by('id')
+        }
+        if dish_id not in menu_dishes:
+            raise ValueError('Please choose a dish of the menu!')
+        if new_dish_id is not None and (new_dish_id not in menu_dishes or new_dish_id == dish_id):
+            raise ValueError('Please choose another dish of the menu for the orders!')
+        dish = menu_dishes[dish_id].dish
+
+        # Nobody else can order it, the orders made before the dish was locked are read again
+        MenuDish.objects.filter(menu=menu, dish_id=dish_id).update(capacity=0, remaining=0)
+        pulled = list(orders.select_for_update(of=('self',)).select_related('employee').order_by('id'))
+        if not pulled:
+            return f'{dish.name} is sold out, there were no orders of it'
+
+        if new_dish_id is not None:
+            new_dish = menu_dishes[new_dish_id].dish
+            if not MenuDish.reserve(menu, new_dish_id, len(pulled)):
+                raise ValueError(f'There are not enough portions of {new_dish.name} for {len(pulled)} orders')
+            orders.update(dish_id=new_dish_id)
+            for pulled_order in pulled:
+                pulled_order.dish_id = new_dish_id
+            OrderChange.record(pulled, 'updated')
+            message = f'{dish.name} ran out, your order for {menu.date} is now {new_dish.name}'
+            note = f'{len(pulled)} orders of {dish.name} were changed to {new_dish.name}'
+        else:
+            orders.delete()
+            OrderChange.record(pulled, 'deleted')
+            message = f'{dish.name} ran out, your order for {menu.date} was cancelled. ' \
+                      f'You can order another dish: {settings.HOST_URL}/menu/{menu.uuid}'
+            note = f'{len(pulled)} orders of {dish.name} were cancelled'
+        notifications.enqueue((pulled_order.employee, message) for pulled_order in pulled)
+    return note
+
+
+def order_feed_allowed(request):
+    # Downstream systems send one of the ORDER_FEED_TOKENS, admins can use their session
+    authorization = request.META.get('HTTP_AUTHORIZATION', '')
+    if authorization.startswith('Bearer '):
+        token = authorization[len('Bearer '):]
+        return any(hmac.compare_digest(token, allowed) for allowed in settings.ORDER_FEED_TOKENS)
+    return request.user.is_authenticated and request.user.role.lower() == 'admin'
+
+
+@replica_reads
+def order_changes(request):
+    """Order changes after the ``cursor`` position, in commit order.
+
+    Consumers keep the returned cursor and pass it on the next call, they
+    ask again at once while ``has_more`` is true.
+    """
+    if not order_feed_allowed(request):
+        return JsonResponse({'error': 'Not allowed'}, status=403)
+    try:
+        cursor = int(request.GET.get('cursor', 0))
+        limit = max(1, min(int(request.GET.get('limit', settings.ORDER_FEED_PAGE_SIZE)), settings.ORDER_FEED_PAGE_SIZE))
+    except ValueError:
+        return JsonResponse({'error': 'cursor and limit must be numbers'}, status=400)
+
+    # Changes get their position after they commit, those still without one are not published yet
+    changes = list(OrderChange.objects.filter(position__gt=cursor).order_by('position')[:limit + 1])
+    has_more = len(changes) > limit
+    changes = changes[:limit]
+    return JsonResponse({
+        'changes': [{
+            'id': change.id,
+            'action': change.action,
+            'order_id': change.order_id,
+            'date': change.date,
+            'employee': change.employee_username,
+            'dish_id': change.dish_id,
+            'dish': change.dish_name,
+            'customizations': change.customizations,
+            'changed_at': change.changed_at,
+        } for change in changes],
+        'cursor': changes[-1].position if changes else cursor,
+        'has_more': has_more,
+    })
+
+
+@login_required
+def see_profiles(request):
+    role = request.user.role.lower()
+    if role != 'admin':
+        return home(request)
+
+    profiles = list_profiles()
+    for profile in profiles:
+        profile['created_at'] = localtime(datetime.fromtimestamp(profile['created_at'], tz=timezone.utc))
+    return render(request, 'cafeteria/profiles.html', {'profiles': profiles})
+
+
+@login_required
+def download_profile(request, name):
+    role = request.user.role.lower()
+    if role != 'admin':
+        return home(request)
+
+    path = profile_path(name)
+    if path is None:
+        raise Http404('Profile not found')
+    return FileResponse(open(path, 'rb'), as_attachment=True, filename=name, content_type='text/plain')
 
 
 # Employee content
@@ -227,12 +407,14 @@ def redirect_uuid(request):
         logger.error(e)
         pass
     finally:
-        return redirect(order_uuid, pk)
+        return redirect('menu', pk)
     # Employee will be redirected to an url with the uuid menu is exists for the current day
-    return redirect(order_uuid, pk)
+    return redirect('menu', pk)
 
 
 @login_required
+@idempotent
+@ratelimit('order')
 def order_uuid(request, pk):
     username = request.user.username
     user = User.objects.get(username=username)
@@ -275,6 +457,8 @@ def order(request, user, menu, pk):
     note = None
     have_errors = False
     created_order = None
+    # Failed posts answer 500 so they are not kept as the response of their idempotency key
+    status = 200
 
     if menu is None:
         note = 'The menu has not been created yet!'
@@ -284,7 +468,7 @@ def order(request, user, menu, pk):
 
     if request.method == 'GET':
         try:
-            created_order = Order.objects.get(employee=user, created_at=date.strftime("%Y-%m-%d"))
+            created_order = Order.objects.get(employee=user, created_at=date)
             form = OrderForm(instance=created_order)
             # Employees will see what they ordered
             note = f'You have ordered {created_order.dish.name}'
@@ -297,10 +481,16 @@ def order(request, user, menu, pk):
             have_errors = True
 
         # User will notice if they arrive to the order page after the allowed time
-        if enable_form is None and created_order is None:
+        if not enable_form and created_order is None:
             note = f'{_time.time().strftime("%H:%M:%S")} - Too late to order :('
             have_errors = True
 
+    elif request.method == 'POST' and not enable_form:
+        # The form is disabled after the allowed hour, this catches pages opened before it
+        note = f'{_time.time().strftime("%H:%M:%S")} - Too late to order :('
+        have_errors = True
+        metrics.inc('cafeteria_order_rejections_total', reason='cutoff')
+
     elif request.method == 'POST':
         form = OrderForm(request.POST)
         if request.POST.get('options'):
@@ -309,43 +499,61 @@ def order(request, user, menu, pk):
 
             form.employee = user
             form.dish = dish
+            customizations = request.POST.get('customizations')
 
-            # Users can edit they order before the limit allowed hour
             try:
-                created_order = Order.objects.get(employee=user, created_at=date.strftime("%Y-%m-%d"))
-                created_order.dish = dish
-                created_order.customizations = request.POST.get('customizations')
-                created_order.save()
-                note = f'You order has been updated to: {dish.name}'
-                if created_order.customizations and created_order.customizations.strip() != '':
+                with transaction.atomic():
+                    # Users can edit they order before the limit allowed hour
+                    created_order = Order.objects.select_for_update().filter(employee=user, created_at=date).first()
+                    previous_dish_id = created_order.dish_id if created_order else None
+
+                    # Both dishes are locked in id order, employees swapping dishes the other way do not deadlock
+                    list(MenuDish.objects.select_for_update().filter(
+                        menu=menu, dish_id__in=[dish.id, previous_dish_id]).order_by('id'))
+                    # One portion is taken with a conditional update, so the dish can never be oversold.
+                    # Keeping the same dish does not take another portion
+                    reserved = previous_dish_id == dish.id or MenuDish.reserve(menu, dish)
+
+                    if not reserved:
+                        have_errors = True
+                        if menu is not None and menu.dishes.filter(pk=dish.id).exists():
+                            note = f'Sorry, {dish.name} is sold out, please choose another dish'
+                            metrics.inc('cafeteria_order_rejections_total', reason='sold_out')
+                        else:
+                            note = 'Please choose a dish of the menu!'
+
+                    elif created_order is not None:
+                        if previous_dish_id != dish.id:
+                            # The portion of the previous dish can be ordered by someone else
+                            MenuDish.release(menu, previous_dish_id)
+                        created_order.dish = dish
+                        created_order.customizations = customizations
+                        created_order.save()
+                        OrderChange.record([created_order], 'updated')
+                        metrics.inc('cafeteria_orders_updated_total')
+                        note = f'You order has been updated to: {dish.name}'
+
+                    # The users order will be created
+                    else:
+                        created_order = Order.objects.create(
+                            dish=dish,
+                            employee=user,
+                            created_at=date,
+                            customizations=customizations
+                        )
+                        OrderChange.record([created_order], 'created')
+                        metrics.inc('cafeteria_orders_placed_total')
+                        note = f'You have ordered {dish.name}!'
+
+                # Display what the user just ordered with all customizations
+                if not have_errors and created_order.customizations and created_order.customizations.strip() != '':
                     note = f'{note} | {created_order.customizations.strip()}'
-            except ObjectDoesNotExist as e:
-                pass
-            except MultipleObjectsReturned as e:
-                note = 'There are more than 1 order, please contact Nora'
-                have_errors = True
-                logger.error(f"Error: {e}")
             except Exception as e:
-                note = 'Error updating your dish, please try again'
+                note = 'Error ordering your dish, please try again'
                 have_errors = True
-                logger.error(f"Error: {e}")
-
-            # The users order will be created
-            if created_order is None:
-                try:
-                    created_order = Order.objects.create(
-                        dish=dish,
-                        employee=user,
-                        customizations=request.POST.get('customizations')
-                    )
-                    note = f'You have ordered {dish.name}!'
-                    # Display what the user just ordered with all customizations
-                    if created_order.customizations and created_order.customizations.strip() != '':
-                        note = f'{note} | {created_order.customizations.strip()}'
-                except Exception as e:
-                    note = 'Error ordering your dish, please try again'
-                    have_errors = True
-                    logger.error(f"Error: {e}")
+                status = 500
+                created_order = None
+                logger.error("Error: %s", e)
         else:
             note = f'Please choose a dish!'
             have_errors = True
@@ -355,7 +563,145 @@ def order(request, user, menu, pk):
         'user': user,
         'menu': menu,
         'created_order': created_order,
+        'menu_dishes': menu.menudish_set.select_related('dish').order_by('id') if menu else [],
         'have_errors': have_errors,
         'enable_form': enable_form,
         'pk': pk
-    })
+    }, status=status)
+
+
+def save_week_orders(user, choices):
+    """Saves the orders of several days at once.
+
+    ``choices`` maps each menu to the chosen dish id and customizations.
+    Returns the notes of the days that could not be ordered. An order of
+    one of the days placed by another request after they were read makes
+    the insert fail, they are then read and saved again.
+    """
+    try:
+        new_orders, changed_orders, errors = write_week_orders(user, choices)
+    except IntegrityError:
+        logger.info("Orders of %s changed while saving the week, saving again", user.username)
+        new_orders, changed_orders, errors = write_week_orders(user, choices)
+    metrics.inc('cafeteria_orders_placed_total', len(new_orders))
+    metrics.inc('cafeteria_orders_updated_total', len(changed_orders))
+    return errors
+
+
+def write_week_orders(user, choices):
+    """Saves the week in one transaction, returns the new and changed orders and the errors."""
+    errors = []
+    with transaction.atomic():
+        # All the chosen dishes are validated against their menus in one query
+        chosen = Q()
+        for menu, (dish_id, customizations) in choices.items():
+            chosen |= Q(menu=menu, dish_id=dish_id)
+        valid = set(MenuDish.objects.filter(chosen).values_list('menu_id', 'dish_id'))
+        orders = {
+            created_order.created_at: created_order
+            for created_order in Order.objects.select_for_update().filter(
+                employee=user, created_at__in=[menu.date for menu in choices])
+        }
+        # The chosen and the previous dishes are locked in id order, so concurrent changes do not deadlock
+        previous = Q()
+        for menu in choices:
+            if menu.date in orders:
+                previous |= Q(menu=menu, dish_id=orders[menu.date].dish_id)
+        list(MenuDish.objects.select_for_update().filter(chosen | previous).order_by('id'))
+
+        new_orders = []
+        changed_orders = []
+        for menu, (dish_id, customizations) in choices.items():
+            if (menu.uuid, dish_id) not in valid:
+                errors.append(f'{menu.date}: Please choose a dish of the menu!')
+                continue
+            created_order = orders.get(menu.date)
+            previous_dish_id = created_order.dish_id if created_order else None
+            if previous_dish_id != dish_id:
+                if not MenuDish.reserve(menu, dish_id):
+                    errors.append(f'{menu.date}: The dish is sold out, please choose another dish')
+                    metrics.inc('cafeteria_order_rejections_total', reason='sold_out')
+                    continue
+                if previous_dish_id is not None:
+                    MenuDish.release(menu, previous_dish_id)
+
+            if created_order is None:
+                new_orders.append(Order(
+                    dish_id=dish_id,
+                    employee=user,
+                    created_at=menu.date,
+                    customizations=customizations
+                ))
+            else:
+                created_order.dish_id = dish_id
+                created_order.customizations = customizations
+                changed_orders.append(created_order)
+
+        Order.objects.bulk_create(new_orders)
+        Order.objects.bulk_update(changed_orders, ['dish', 'customizations'])
+        if new_orders:
+            # bulk_create does not set the ids on every database
+            OrderChange.record(Order.objects.filter(
+                employee=user, created_at__in=[new_order.created_at for new_order in new_orders]), 'created')
+        OrderChange.record(changed_orders, 'updated')
+    return new_orders, changed_orders, errors
+
+
+@login_required
+@idempotent
+@ratelimit('order')
+def week_order(request):
+    user = request.user
+    date = localtime(now()).date()
+    note = None
+    errors = []
+    have_errors = False
+    status = 200
+
+    # Menus of today and the next 6 days
+    menus = list(Menu.objects.filter(
+        date__gte=date,
+        date__lt=date + timedelta(days=7)
+    ).order_by('date').prefetch_related(
+        Prefetch('menudish_set', queryset=MenuDish.objects.select_related('dish').order_by('id'))
+    ))
+    # Today's menu can not be ordered after the allowed hour
+    enable_today = allow_order(settings.ALLOWED_HOUR_TO_ORDER)
+    for menu in menus:
+        menu.enable_form = menu.date != date or enable_today
+
+    if request.method == 'POST':
+        choices = {}
+        for menu in menus:
+            dish_id = request.POST.get(f'dish_{menu.uuid}', '')
+            if menu.enable_form and dish_id.isdigit():
+                customizations = request.POST.get(f'customizations_{menu.uuid}', '')[:256]
+                choices[menu] = (int(dish_id), customizations)
+        if choices:
+            try:
+                errors = save_week_orders(user, choices)
+                have_errors = bool(errors)
+                note = f'Your orders for {len(choices) - len(errors)} days have been saved!'
+            except Exception as e:
+                note = 'Error ordering your dishes, please try again'
+                have_errors = True
+                status = 500
+                logger.error("Error: %s", e)
+        else:
+            note = 'Please choose a dish!'
+            have_errors = True
+
+    orders = {
+        created_order.created_at: created_order
+        for created_order in Order.objects.filter(employee=user, created_at__in=[menu.date for menu in menus])
+    }
+    for menu in menus:
+        menu.created_order = orders.get(menu.date)
+
+    return render(request, 'employee/week_order.html', {
+        'menus': menus,
+        'note': note,
+        'errors': errors,
+        'have_errors': have_errors,
+        'user': user
+    }, status=status)
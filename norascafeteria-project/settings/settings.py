@@ -16,6 +16,23 @@ HOST_URL = 'http://localhost:8000'
 # Replace correct values of your token here
 SLACK_API_TOKEN = 'put your slack token here'
 CHANNEL = '#general'
+SLACK_API_URL = 'https://www.slack.com/api/'
+# Members asked in each users.list page by sync_slack_users, and users saved in each query
+SLACK_USERS_PAGE_SIZE = 1000
+SLACK_SYNC_BATCH_SIZE = 1000
+# Employee notifications sent in each batch, and at the same time
+NOTIFICATION_BATCH_SIZE = 100
+SLACK_CONCURRENCY = 10
+# Retries of a Slack call answered 429, after waiting its Retry-After
+SLACK_MAX_RETRIES = 3
+# Attempts before a notification is given up, seconds before the first retry (doubled after each one),
+# seconds a worker keeps the batch it is sending and seconds the exit waits for the deliveries
+NOTIFICATION_MAX_ATTEMPTS = 5
+NOTIFICATION_RETRY_DELAY = 60
+NOTIFICATION_CLAIM_TIMEOUT = 300
+NOTIFICATION_EXIT_TIMEOUT = 10
+# Seconds between the deliveries each worker runs by itself, for the failed notifications
+NOTIFICATION_RETRY_INTERVAL = 60
 
 # Application definition
 
@@ -31,6 +48,10 @@ INSTALLED_APPS = [
 ]
 
 MIDDLEWARE = [
+    'cafeteria.log.RequestIdMiddleware',
+    'cafeteria.dbrouter.ReplicaPinMiddleware',
+    'cafeteria.ratelimit.AdmissionControlMiddleware',
+    'cafeteria.metrics.MetricsMiddleware',
     'django.middleware.security.SecurityMiddleware',
     'django.contrib.sessions.middleware.SessionMiddleware',
     'django.middleware.common.CommonMiddleware',
@@ -38,6 +59,7 @@ MIDDLEWARE = [
     'django.contrib.auth.middleware.AuthenticationMiddleware',
     'django.contrib.messages.middleware.MessageMiddleware',
     'django.middleware.clickjacking.XFrameOptionsMiddleware',
+    'cafeteria.profiler.ProfilerMiddleware',
 ]
 
 ROOT_URLCONF = 'settings.urls'
@@ -59,6 +81,10 @@ TEMPLATES = [
 ]
 
 WSGI_APPLICATION = 'settings.wsgi.application'
+ASGI_APPLICATION = 'settings.asgi.application'
+
+# The ASGI entry point (uvicorn settings.asgi:application) turns on the async views
+ASYNC_VIEWS = os.environ.get('DJANGO_ASYNC_VIEWS') == 'True'
 
 
 # Database
@@ -66,11 +92,39 @@ WSGI_APPLICATION = 'settings.wsgi.application'
 
 DATABASES = {
     'default': {
-        'ENGINE': 'django.db.backends.sqlite3',
+        # SQLite with BEGIN IMMEDIATE transactions, use django.db.backends.postgresql in production
+        'ENGINE': 'cafeteria.backends.sqlite3',
+        'NAME': BASE_DIR / 'db.sqlite3',
+        # Seconds a transaction waits for the write lock
+        'OPTIONS': {
+            'timeout': 20,
+        },
+        # A file instead of memory, so the concurrency tests get one connection per thread
+        'TEST': {
+            'NAME': BASE_DIR / 'test_db.sqlite3',
+        },
+    },
+    # Read replica of the reports, in Heroku the credentials of a Postgres follower.
+    # SQLite has no replication, locally it is the same file
+    'replica': {
+        'ENGINE': 'cafeteria.backends.sqlite3',
         'NAME': BASE_DIR / 'db.sqlite3',
-    }
+        'OPTIONS': {
+            'timeout': 20,
+        },
+        # Its own file in the tests, so they can make it lag
+        'TEST': {
+            'NAME': BASE_DIR / 'test_db_replica.sqlite3',
+        },
+    },
 }
 
+DATABASE_ROUTERS = ['cafeteria.dbrouter.ReplicaRouter']
+# Alias the report views read from, None reads everything from the primary
+REPLICA_DATABASE = 'replica'
+# Seconds a browser reads from the primary after it changed something, longer than the replica lag
+REPLICA_PIN_SECONDS = 5
+
 
 # Password validation
 # https://docs.djangoproject.com/en/3.1/ref/settings/#auth-password-validators
@@ -115,3 +169,94 @@ LOGOUT_REDIRECT_URL = 'home'
 
 STATIC_URL = '/static/'
 STATIC_ROOT = os.path.join(BASE_DIR, 'static')
+# Uploaded files, like the dish photos
+MEDIA_URL = '/media/'
+MEDIA_ROOT = os.path.join(BASE_DIR, 'media')
+# Widths of the resized copies of the dish photos, and processes that create them
+DISH_PHOTO_WIDTHS = (160, 320, 640)
+THUMBNAIL_PROCESSES = 2
+
+# collectstatic writes content hashed names, gzip/brotli copies and the resized images below
+STATICFILES_STORAGE = 'cafeteria.staticfiles.CompressedManifestStaticFilesStorage'
+STATIC_IMAGE_VARIANTS = {
+    'images/home_img.jpg': (480, 960, 1350),
+}
+# Hashed files are cached forever, this is for the rest
+STATIC_CACHE_MAX_AGE = 3600
+
+# Request profiler, only admins can trigger it with ?profile=1 or the X-Profile header
+PROFILER_DIR = BASE_DIR / 'profiles'
+PROFILER_MAX_FILES = 50
+PROFILER_INTERVAL = 0.001
+
+# Prometheus metrics, each worker process writes its values in this directory
+METRICS_DIR = BASE_DIR / 'metrics'
+METRICS_FLUSH_INTERVAL = 5
+# Tokens Prometheus sends as 'Authorization: Bearer <token>' to read /metrics, admins can use their session
+METRICS_TOKENS = []
+
+# Logging goes through a queue written by a background thread, so views never wait for the output
+LOGGING = {
+    'version': 1,
+    'disable_existing_loggers': False,
+    'filters': {
+        'request_id': {
+            '()': 'cafeteria.log.RequestIdFilter',
+        },
+        # Fraction of records kept by message, the home page logs these on every visit
+        'sampling': {
+            '()': 'cafeteria.log.SamplingFilter',
+            'rates': {
+                'Menu uuid: %s': 0.01,
+                'User authenticated': 0.01,
+            },
+        },
+    },
+    'handlers': {
+        'queue': {
+            '()': 'cafeteria.log.QueueLogHandler',
+            'stream': 'ext://sys.stderr',
+            'queue_size': 10000,
+            'filters': ['sampling', 'request_id'],
+        },
+    },
+    'root': {
+        'handlers': ['queue'],
+        'level': 'INFO',
+    },
+    'loggers': {
+        # Replaces the synchronous console handler Django adds under DEBUG
+        'django': {
+            'handlers': ['queue'],
+            'level': 'INFO',
+            'propagate': False,
+        },
+    },
+}
+
+# Token buckets by group, (tokens per second, burst) per IP and per user, stored in the database.
+# All the office can share one IP, so its limits are higher
+RATELIMIT_IP_META = 'REMOTE_ADDR'
+RATELIMITS = {
+    'order': {'ip': (50, 500), 'user': (1, 10)},
+    'login': {'ip': (1, 30), 'user': (0.1, 5)},
+}
+
+# Requests handled at the same time by each worker process, the rest get a 503 at once. It is not
+# shared: the site handles workers x this, 2 workers x 8 stay under the 20 connections of the
+# Heroku Postgres hobby plan. A gunicorn sync worker never runs more than its --threads
+ADMISSION_MAX_CONCURRENT_REQUESTS = 8
+# Seconds a request can wait in the proxy queue (X-Request-Start header)
+ADMISSION_MAX_QUEUE_TIME = 10
+ADMISSION_RETRY_AFTER = 1
+
+# Responses of the order posts are kept by idempotency key in the database, repeated posts get them back
+IDEMPOTENCY_KEY_TTL = 600
+# Seconds a repeated post waits for the first one to finish
+IDEMPOTENCY_WAIT = 5
+
+# Order change feed (orders/changes), tokens of the systems allowed to read it
+ORDER_FEED_TOKENS = []
+ORDER_FEED_PAGE_SIZE = 500
+# Days after which compact_order_changes only keeps the last change of each order
+ORDER_CHANGES_COMPACT_DAYS = 30
@@ -1,15 +1,31 @@
+from django.conf import settings
+from django.conf.urls.static import static
 from django.contrib import admin
-from django.urls import include, path
-from cafeteria import views
+from django.contrib.auth import views as auth_views
+from django.urls import include, path, re_path
+from cafeteria import asyncviews, metrics, staticfiles, views
+from cafeteria.ratelimit import ratelimit
+
+# Under ASGI the read views and the Slack notification are async views
+read_views = asyncviews if settings.ASYNC_VIEWS else views
 
 urlpatterns = [
+    # Same login view as django.contrib.auth.urls, with a rate limit
+    path('accounts/login/', ratelimit('login', username_field='username')(auth_views.LoginView.as_view()), name='login'),
     path('accounts/', include('django.contrib.auth.urls')),
-    path('', views.home, name='home'),
+    path('', read_views.home, name='home'),
     path('dish_form', views.dish_form, name='dish_form'),
     path('dish_form/<int:pk>', views.edit_dish, name='edit_dish'),
-    path('menu_form', views.menu_form, name='menu_form'),
+    path('menu_form', read_views.menu_form, name='menu_form'),
     path('menu_form/<str:pk>', views.edit_menu, name='edit_menu'),
     path('see_orders', views.see_orders, name='see_orders'),
-    path('menu', views.redirect_uuid, name='menu'),
-    path('menu/<str:pk>', views.order_uuid, name='menu'),
-]
+    path('orders/changes', views.order_changes, name='order_changes'),
+    path('profiles', views.see_profiles, name='see_profiles'),
+    path('profiles/<str:name>', views.download_profile, name='download_profile'),
+    path('menu', read_views.redirect_uuid, name='menu'),
+    path('week', views.week_order, name='week_order'),
+    path('menu/<str:pk>', read_views.order_uuid, name='menu'),
+    path('metrics', metrics.metrics_view, name='metrics'),
+    # Only reached without DEBUG, runserver serves the static files before this in development
+    re_path(r'^static/(?P<path>.*)$', staticfiles.serve, name='static'),
+] + static(settings.MEDIA_URL, document_root=settings.MEDIA_ROOT)
@@ -1,5 +1,24 @@
 from django.conf import settings
 from storages.backends.s3boto3 import S3Boto3Storage
 
-class StaticStorage(S3Boto3Storage):
+from cafeteria.staticfiles import HashedStaticFilesMixin, IMMUTABLE_CACHE_CONTROL, is_hashed
+
+
+class StaticStorage(HashedStaticFilesMixin, S3Boto3Storage):
     location = settings.STATICFILES_LOCATION
+    # S3 can not choose an encoding per request, so text files are stored gzipped for every browser
+    gzip = True
+
+    def get_object_parameters(self, name):
+        params = super().get_object_parameters(name)
+        if is_hashed(name):
+            params['CacheControl'] = IMMUTABLE_CACHE_CONTROL
+        else:
+            params['CacheControl'] = f'public, max-age={settings.STATIC_CACHE_MAX_AGE}'
+        return params
+
+
+class MediaStorage(S3Boto3Storage):
+    """Uploaded files, like the dish photos and their resized copies."""
+    location = settings.MEDIAFILES_LOCATION
+    file_overwrite = False